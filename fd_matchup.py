@@ -428,8 +428,14 @@ def check_time_relative(parser, tim_min, tim_max):
 def send_CMRreq(url):
     """ function to submit a given URL request to the CMR; return JSON output """
     import requests
+    from modules.http_cache import get_default_cache
 
-    req = requests.get(url)
+    # repeated searches are revalidated rather than fetched again
+    cache = get_default_cache()
+    if cache is None:
+        req = requests.get(url)
+    else:
+        req = cache.fetch(requests, url)
     content = req.json()
 
     return content
@@ -9,8 +9,12 @@ __version__ = '1.3-2018-12-21'
 __author__ = 'melliott'
 
 import calendar
+import csv
 import datetime
+import json
+import modules.file_type_cache
 import modules.MetaUtils
+import multiprocessing
 import optparse
 import os
 import re
@@ -58,6 +62,9 @@ def get_usage_text():
     usage_text = \
         """usage: %prog [options] FILE_NAME [FILE_NAME ...]
 
+  Use "-" as a FILE_NAME (or the --list-file option) to read the names of
+  the files to be typed from standard input (or a list file).
+
   The following file types are recognized:
     Instruments: CZCS, GOCI, HICO, Landsat OLI, MODIS Aqua,
                  MODIS Terra, OCM2, OCTS, SeaWiFS, VIIRSN, VIIRSJ1
@@ -71,11 +78,16 @@ class ObpgFileTyper(object):
     MODIS L2b, SeaWiFS L1A, Aquarius L3m, etc.
     """
 
-    def __init__(self, fpath):
+    def __init__(self, fpath, cache=None):
         """
         Save the path of the file in question and set up default
-        values for several thing still to be found.
+        values for several thing still to be found.  If cache (a
+        FileTypeCache) is given, previously found results are reused for
+        files which have not changed since they were typed.
         """
+        self.cache = cache
+        self.cache_path = fpath
+        self.cached_times = None
         if os.path.exists(fpath):
             if tarfile.is_tarfile(fpath):
                 # self.file_path = self._extract_viirs_sdr(fpath)
@@ -434,6 +446,8 @@ class ObpgFileTyper(object):
         """
         Returns the start and end time for a file.
         """
+        if self.cached_times:
+            return self.cached_times
 #        print 'self.instrument: "' + self.instrument + '"'
         start_time = 'unable to determine start time'
         end_time = 'unable to determine end time'
@@ -494,6 +508,10 @@ class ObpgFileTyper(object):
                     raise
         elif self.file_type.find('Level 0') != -1:
             start_time, end_time = self._get_l0_times()
+        if self.cache:
+            self.cached_times = (start_time, end_time)
+            self.cache.put(self.cache_path, self.file_type, self.instrument,
+                           start_time, end_time, self.attributes)
         return start_time, end_time
 
     def _get_type_using_platform(self):
@@ -613,6 +631,8 @@ class ObpgFileTyper(object):
         Returns what type (L1A, L2, etc.) a file is and what
         platform/sensor/instrument made the observations.
         """
+        if self.cache and self._load_from_cache():
+            return self.file_type, self.instrument
         orig_path = None
         self._read_metadata()
         if self.attributes:
@@ -625,8 +645,33 @@ class ObpgFileTyper(object):
             self.instrument = 'MODIS Terra'
         if orig_path:
             self.file_path = orig_path
+        if self.cache:
+            if self.l0_data:
+                # The L0 times come from the l0cnst_write_modis output, which
+                # is not kept in the cache, so store them now.
+                self.get_file_times()
+            else:
+                self.cache.put(self.cache_path, self.file_type,
+                               self.instrument, attributes=self.attributes)
         return self.file_type, self.instrument
 
+    def _load_from_cache(self):
+        """
+        Sets the file type, instrument, attributes and (if they were stored)
+        times from the cache.  Returns False if the file is not cached.
+        """
+        entry = self.cache.get(self.cache_path)
+        if entry is None:
+            return False
+        self.file_type = entry['file_type']
+        self.instrument = entry['instrument']
+        self.attributes = entry['attributes']
+        if entry['start_time'] is not None:
+            self.start_time = entry['start_time']
+            self.end_time = entry['end_time']
+            self.cached_times = (self.start_time, self.end_time)
+        return True
+
     def _get_file_type_landsat(self):
         """
         Sets the file type and instrument for Landsat OLI data files
@@ -930,6 +975,99 @@ class ObpgFileTyper(object):
 
 #######################################################################
 
+def format_text_output(result, show_times):
+    """
+    Returns the colon delimited description of a file typing result.
+    """
+    fname = os.path.basename(result['file'])
+    obpg_file_type = result['type']
+    instrument = result['instrument']
+    if 'error' in result:
+        return '{0}: error: {1}'.format(fname, result['error'])
+    output = '{0}: {1}: {2}'.format(fname, instrument, obpg_file_type)
+    if show_times:
+        if obpg_file_type != 'unknown' and instrument != 'unknown':
+            output += ': {0} : {1}'.format(result['start_time'],
+                                           result['end_time'])
+        else:
+            output += ': unable to determine file start and end times'
+    return output
+
+def get_input_file_names(args, list_file):
+    """
+    Generator yielding the names of the files to be typed.  These come from
+    the command line arguments, from list_file (if given) and from standard
+    input when an argument (or list_file) is '-'.
+    """
+    sources = list(args)
+    if list_file:
+        sources.append('@' + list_file)
+    for src in sources:
+        if src == '-' or src == '@-':
+            for line in sys.stdin:
+                fname = line.strip()
+                if fname:
+                    yield fname
+        elif src.startswith('@'):
+            with open(src[1:], 'rt') as lst_file:
+                for line in lst_file:
+                    fname = line.split('#')[0].strip()
+                    if fname:
+                        yield fname
+        else:
+            yield src
+
+def type_file(fname, get_times=False, use_cache=True, refresh_cache=False):
+    """
+    Types a single file and returns the results in a dictionary.  This is a
+    module level function so that it can be run in worker processes.
+    """
+    result = {'file': fname, 'type': 'unknown', 'instrument': 'unknown',
+              'start_time': None, 'end_time': None}
+    cache = None
+    if use_cache:
+        cache = modules.file_type_cache.get_default_cache(refresh_cache)
+    try:
+        file_typer = ObpgFileTyper(fname, cache)
+        (result['type'], result['instrument']) = file_typer.get_file_type()
+        if get_times and result['type'] != 'unknown' and \
+           result['instrument'] != 'unknown':
+            (result['start_time'], result['end_time']) = \
+                file_typer.get_file_times()
+    except SystemExit as sys_exit:
+        # ObpgFileTyper exits on files it cannot open.
+        result['error'] = str(sys_exit.code)
+    except Exception:
+        result['error'] = str(sys.exc_info()[1])
+    return result
+
+def _type_file_worker(job):
+    """
+    Unpacks the arguments for type_file when run via a process pool.
+    """
+    return type_file(*job)
+
+def type_files(fnames, jobs=1, get_times=False, use_cache=True,
+               refresh_cache=False):
+    """
+    Generator yielding the typing results for each of the files in fnames,
+    in order.  If jobs is greater than 1, the files are typed in that many
+    worker processes.
+    """
+    if jobs <= 1:
+        for fname in fnames:
+            yield type_file(fname, get_times, use_cache, refresh_cache)
+    else:
+        job_args = ((fname, get_times, use_cache, refresh_cache)
+                    for fname in fnames)
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for result in pool.imap(_type_file_worker, job_args, 16):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
 def main():
     """
     Main function to drive the program when invoked as a program.
@@ -939,33 +1077,27 @@ def main():
     cl_parser = optparse.OptionParser(usage=use_msg, version=ver_msg)
     (opts, args) = process_command_line(cl_parser)
 
-    if len(args) > 0:
-        for arg in args:
-            fname = arg
-            file_typer = ObpgFileTyper(fname)
-            (obpg_file_type, instrument) = file_typer.get_file_type()
-            output = ''
-            if obpg_file_type == 'unknown':
-                if instrument != 'unknown':
-                    output = '{0}: {1}: unknown'.format(
-                                            os.path.basename(fname), instrument)
-                else:
-                    output = '{0}: unknown: unknown'.format(
-                                os.path.basename(fname))
-            else:
-                if instrument != 'unknown':
-                    output = '{0}: {1}: {2}'.format(os.path.basename(fname),
-                                                    instrument, obpg_file_type)
-                else:
-                    output = '{0}: unknown: {1}'.format(
-                                        os.path.basename(fname), obpg_file_type)
-            if opts.times:
-                if obpg_file_type != 'unknown' and instrument != 'unknown':
-                    start_time, end_time = file_typer.get_file_times()
-                    output += ': {0} : {1}'.format(start_time, end_time)
-                else:
-                    output += ': unable to determine file start and end times'
-            print(output)
+    if len(args) > 0 or opts.list_file:
+        # Times are always part of the machine-readable formats.
+        get_times = opts.times or opts.format != 'text'
+        results = type_files(get_input_file_names(args, opts.list_file),
+                             opts.jobs, get_times, not opts.no_cache,
+                             opts.refresh_cache)
+        if opts.format == 'json':
+            sys.stdout.write('[')
+            for ndx, result in enumerate(results):
+                if ndx > 0:
+                    sys.stdout.write(',')
+                sys.stdout.write('\n' + json.dumps(result))
+            sys.stdout.write('\n]\n')
+        elif opts.format == 'csv':
+            csv_writer = csv.writer(sys.stdout)
+            csv_writer.writerow(CSV_FIELDS)
+            for result in results:
+                csv_writer.writerow([result.get(fld, '') for fld in CSV_FIELDS])
+        else:
+            for result in results:
+                print(format_text_output(result, opts.times))
     else:
         print('\nError!  No file specified for type identification.\n')
         cl_parser.print_help()
@@ -975,10 +1107,28 @@ def process_command_line(cl_parser):
     """
     Uses optparse to get the command line options & arguments.
     """
+    cl_parser.add_option('-f', '--format', action='store', type='choice',
+                         dest='format', default='text',
+                         choices=['text', 'json', 'csv'],
+                         help='output format: text, json or csv (default = text)')
+    cl_parser.add_option('-j', '--jobs', action='store', type='int',
+                         dest='jobs', default=1,
+                         help='number of files to type concurrently (default = 1)')
+    cl_parser.add_option('-l', '--list-file', action='store', type='string',
+                         dest='list_file',
+                         help='file containing the names of the files to type, one per line ("-" for stdin)')
     cl_parser.add_option('-t', '--times', action='store_true',
                          dest='times', default=False,
                          help='output start and end times for the file(s)')
+    cl_parser.add_option('--no-cache', action='store_true',
+                         dest='no_cache', default=False,
+                         help='do not use the file type cache')
+    cl_parser.add_option('--refresh-cache', action='store_true',
+                         dest='refresh_cache', default=False,
+                         help='ignore and replace cached file type results')
     (opts, args) = cl_parser.parse_args()
+    if opts.jobs < 1:
+        cl_parser.error('the jobs option must be at least 1')
     return opts, args
 
 #######################################################################
@@ -989,6 +1139,8 @@ KNOWN_SENSORS = ['Aquarius', 'CZCS', 'HICO',
                  'MOS', 'OCM2', 'OCTS',
                  'OSMI','SeaWiFS', 'VIIRSN', 'VIIRSJ1']
 
+CSV_FIELDS = ['file', 'instrument', 'type', 'start_time', 'end_time', 'error']
+
 MONTH_ABBRS = dict((v.upper(), k) for k, v in enumerate(calendar.month_abbr))
 
 if __name__ == '__main__':
@@ -7,7 +7,9 @@ as appropriate.
 import sys
 from optparse import OptionParser
 
+import modules.anc_query_cache as anc_query_cache
 import modules.anc_utils as ga
+import modules.http_cache as http_cache
 from modules.setupenv import env
 
 def main():
@@ -39,8 +41,12 @@ def main():
     %prog [OPTIONS] FILE
           or
     -s,--start YYYYDDDHHMMSS [-e,--end YYYDDDHHMMSS]  [OPTIONS]
+          or
+    --filelist FILELIST [OPTIONS]
 
-      FILE  Input L1A or L1B file
+      FILE      Input L1A or L1B file
+      FILELIST  Text file listing many input files, one per line; the
+                ancillary files for all of them are resolved in one pass
 
     NOTE: Currently NO2 climatological data is used for OBPG operational
           processing, so to match OBPG distributed data products, the default
@@ -72,6 +78,9 @@ def main():
 
     e.g. STATUS=11 indicates there are missing optimal MET, OZONE, and NO2 files
 
+    With --filelist, the exit status is the highest status of any of the
+    listed files.
+
     """
 
     parser = OptionParser(usage=usage, version=version)
@@ -125,6 +134,32 @@ def main():
                       help="Suppress printing the resulting list of files to the screen")
     parser.add_option("--timeout", dest='timeout', metavar="TIMEOUT",
                       help="set the network timeout in seconds")
+    parser.add_option("--filelist", dest='filelist', metavar="FILELIST",
+                      help="Resolve the ancillary files for every input file listed in FILELIST")
+    parser.add_option("--offline", action="store_true", dest='offline',
+                      default=False,
+                      help="Choose the ancillary files from the local ancillary directory tree, without querying the server")
+    parser.add_option("--no-anc-index", action="store_false", dest='use_index',
+                      default=True,
+                      help="Check for each ancillary file on disk, bypassing the index of the local ancillary directory")
+    parser.add_option("--stale-if-error", action="store_true", dest='stale_if_error',
+                      default=False,
+                      help="Use the last stored server response if the server cannot be reached")
+    parser.add_option("--no-query-cache", action="store_false", dest='query_cache',
+                      default=True,
+                      help="Always query the server, bypassing the cache of recent server responses")
+    parser.add_option("--list-query-cache", action="store_true", dest='list_query_cache',
+                      default=False,
+                      help="List the cached server responses and exit")
+    parser.add_option("--purge-query-cache", dest='purge_query_cache', metavar="WHICH", type='choice',
+                      choices=['all', 'expired'],
+                      help="Remove 'all' or the 'expired' cached server responses and exit")
+    parser.add_option("--list-http-cache", action="store_true", dest='list_http_cache',
+                      default=False,
+                      help="List the stored HTTP responses (listings, API queries) and exit")
+    parser.add_option("--purge-http-cache", action="store_true", dest='purge_http_cache',
+                      default=False,
+                      help="Remove the stored HTTP responses and exit")
 
     (options, args) = parser.parse_args()
 
@@ -154,43 +189,79 @@ def main():
         printlist = options.printlist
     if options.timeout:
         timeout = float(options.timeout)
+    if options.stale_if_error:
+        http_cache.get_default_cache(stale_if_error=True)
+
+    if options.list_query_cache or options.purge_query_cache:
+        g = ga.getanc(ancdb=ancdb, verbose=verbose)
+        env(g)
+        cache = anc_query_cache.AncQueryCache(g.query_cache_file())
+        if options.purge_query_cache:
+            count = cache.purge(expired_only=(options.purge_query_cache == 'expired'))
+            print("Removed %d cached responses from %s" % (count, cache.dbfile))
+        if options.list_query_cache:
+            anc_query_cache.print_entries(cache)
+        cache.close()
+        return 0
+
+    if options.list_http_cache or options.purge_http_cache:
+        cache = http_cache.get_default_cache()
+        if cache is None:
+            print("No HTTP cache: OCVARROOT is not set")
+            return 1
+        if options.purge_http_cache:
+            count = cache.purge()
+            print("Removed %d stored responses from %s" % (count, cache.cache_dir))
+        if options.list_http_cache:
+            http_cache.print_entries(cache)
+        return 0
 
-    if filename is None and start is None:
+    if filename is None and start is None and options.filelist is None:
         parser.print_help()
         sys.exit(0)
 
-    g = ga.getanc(file=filename,
-                  start=start,
-                  stop=stop,
-                  ancdir=ancdir,
-                  ancdb=ancdb,
-                  curdir=curdir,
-                  sensor=sensor,
-                  opt_flag=opt_flag,
-                  verbose=verbose,
-                  printlist=printlist,
-                  download=download,
-                  timeout=timeout,
-                  refreshDB=refreshDB)
-
-    if options.sst is False:
-        g.set_opt_flag('sst', off=True)
-    if options.no2:
-        g.set_opt_flag('no2')
-    if options.ice is False:
-        g.set_opt_flag('ice', off=True)
-
-    env(g)
-    g.chk()
-    if (filename and g.finddb()) or (start and g.finddb()):
-        g.setup()
+    def make_getanc(filename, start):
+        g = ga.getanc(file=filename,
+                      start=start,
+                      stop=stop,
+                      ancdir=ancdir,
+                      ancdb=ancdb,
+                      curdir=curdir,
+                      sensor=sensor,
+                      opt_flag=opt_flag,
+                      verbose=verbose,
+                      printlist=printlist,
+                      download=download,
+                      timeout=timeout,
+                      refreshDB=refreshDB,
+                      query_cache=options.query_cache,
+                      offline=options.offline,
+                      use_index=options.use_index)
+
+        if options.sst is False:
+            g.set_opt_flag('sst', off=True)
+        if options.no2:
+            g.set_opt_flag('no2')
+        if options.ice is False:
+            g.set_opt_flag('ice', off=True)
+        return g
+
+    if options.filelist:
+        granules = []
+        with open(options.filelist, 'r') as flist:
+            for line in flist:
+                fname = line.split('#')[0].strip()
+                if fname:
+                    granules.append(make_getanc(fname, None))
+        statuses = ga.resolve_many(granules, forcedl=force)
+        status = max(statuses) if statuses else 0
     else:
-        g.setup()
-        g.findweb()
-    g.locate(forcedl=force)
-    g.write_anc_par()
-    g.cleanup()
-    return(g.db_status)
+        g = make_getanc(filename, start)
+        status = ga.resolve(g, forcedl=force)
+
+    if verbose:
+        http_cache.print_stats()
+    return status
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -2,6 +2,7 @@
 
 
 import modules.anc_utils as ga
+import modules.http_cache as http_cache
 from optparse import OptionParser
 from modules.setupenv import env
 import os
@@ -127,5 +128,7 @@ if __name__ == "__main__":
     m.locate(forcedl=force)
     m.write_anc_par()
     m.cleanup()
+    if verbose:
+        http_cache.print_stats()
 
     exit(m.db_status)
@@ -5,6 +5,11 @@ import time
 import json
 
 from ProcUtils import getSession, httpdl
+try:
+    # the same module (and default cache) as anc_utils and the scripts use
+    from modules.http_cache import get_default_cache
+except ImportError:  # run from the modules directory
+    from http_cache import get_default_cache
 
 # URL parsing utils:
 
@@ -102,10 +107,34 @@ def getlinks_json(content):
     return linkdict(json.loads(content)['rows'])
 
 
+def head_size_mtime(url, timeout=5):
+    """
+    Returns the size and timestamp (as seconds since the epoch) of the
+    remote file, from the url's header, or (None, None) if it can't be had.
+    """
+    try:
+        response = getSession().head(url, allow_redirects=True,
+                                     timeout=timeout)
+    except IOError:
+        # requests' exceptions are IOErrors
+        return None, None
+    if not response.ok or 'Content-Length' not in response.headers:
+        return None, None
+    try:
+        urltime = time.strptime(response.headers['Last-Modified'],
+                                "%a, %d %b %Y %H:%M:%S %Z")
+        mtime = time.mktime(urltime)
+    except (KeyError, ValueError):
+        mtime = sys.maxsize
+    return int(response.headers['Content-Length']), mtime
+
+
 def needs_download(link, filepath, check_times=False):
     """
     Returns False if filepath is present and size matches remote url;
     True otherwise.  Optionally check timestamp as well.
+    Where the link lacks the size or time (None, as in a crawler manifest),
+    they are taken from the url's header.
     """
 
     # only download files
@@ -116,17 +145,37 @@ def needs_download(link, filepath, check_times=False):
     if not os.path.isfile(filepath):
         return True
 
+    size, mtime = link['size'], link['mtime']
+    # fall back to the header if the listing lacks what's needed
+    if size is None or (check_times and mtime is None):
+        size, mtime = head_size_mtime(link['href'])
+        if size is None:
+            return False
+
     # check file size
-    diffsize = os.path.getsize(filepath) != link['size']
+    diffsize = os.path.getsize(filepath) != size
     if not check_times:
         return diffsize
 
     # optionally check timestamp
     else:
-        older = os.path.getmtime(filepath) < link['mtime']
+        older = os.path.getmtime(filepath) < mtime
         return diffsize or older
 
 
+def filter_links(url, linklist, regex=''):
+    """
+    Returns the links in linklist matching regex;
+    default is to keep only links starting with url.
+    """
+    if regex != '':
+        import re
+        regex = re.compile(regex)
+        return [link for link in linklist if regex.search(link['href'])]
+    else:
+        return [link for link in linklist if base_url(url) in link['href']]
+
+
 # HTTPResponse utils:
 def is_json(response):
     return response and ('json' in response.headers.get('Content-Type'))
@@ -146,6 +195,10 @@ class SessionUtils:
         self.status = 0
 
     def download_file(self, url, filepath):
+        """
+        Download url into the directory of filepath.
+        Returns 0 on success, nonzero otherwise.
+        """
         try:
             parts = urlsplit(url)
             outputdir = os.path.dirname(filepath)
@@ -156,18 +209,23 @@ class SessionUtils:
                 print('Error downloading {}'.format(filepath))
         except Exception as e:
             self.status = 1
+            status = 1
             print('Exception: {:}'.format(e))
-        return
+        return status
 
-    def get_links(self, url, regex=''):
+    def list_links(self, url):
         """
-        Returns a unique set of links from a given url.
-        Optionally specify regex to filter for acceptable files;
-        default is to list only links starting with url.
+        Returns all of the links from a given url, fully-qualified,
+        from a single fetch of its listing.
         """
         linklist = []
         session = getSession(verbose=self.verbose, ntries=self.max_tries)
-        with session.get(url, stream=True, timeout=self.timeout) as response:
+        cache = get_default_cache()
+        if cache is None:
+            response = session.get(url, stream=True, timeout=self.timeout)
+        else:
+            response = cache.fetch(session, url, timeout=self.timeout)
+        with response:
             if is_json(response):
                 linklist = getlinks_json(response.content)
             else:
@@ -177,16 +235,16 @@ class SessionUtils:
         for link in linklist:
             link['href'] = full_url(url, link['href'])
 
-        # filter for regex
-        if regex != '':
-            import re
-            regex = re.compile(regex)
-            linklist = [link for link in linklist if regex.search(link['href'])]
-        else:  # if no filter, return only links containing url
-            linklist = [link for link in linklist if base_url(url) in link['href']]
-
         return linklist
 
+    def get_links(self, url, regex=''):
+        """
+        Returns a unique set of links from a given url.
+        Optionally specify regex to filter for acceptable files;
+        default is to list only links starting with url.
+        """
+        return filter_links(url, self.list_links(url), regex=regex)
+
     def download_allfiles(self, url, dirpath, regex='', check_times=False,
                           clobber=False, dry_run=False):
         """
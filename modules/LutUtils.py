@@ -1,10 +1,17 @@
 from __future__ import print_function
 
 import os
+from collections import OrderedDict
 
 import JsonUtils as Session
 import SensorUtils
 
+# number of listings/downloads run at once
+DEFAULT_WORKERS = 4
+
+# the common directory holds some large files which are not updated
+COMMON_REGEX = "(?m)^(?!.*(?:gbr100|gbrReflectance|LandWater15ARC|VIIRS_DARKTARGET_LUT)).*$"
+
 
 def lut_version(lut_name):
     import re
@@ -58,13 +65,109 @@ def purge_luts(newfiles, verbose=False):
                 os.remove(f)
 
 
+def choose_links(url, linklist, rules):
+    """
+    Returns (link, check_times) for each link in linklist matching one of
+    the (regex, check_times) rules; a link matching several is checked as
+    the first of them says.
+    """
+    chosen = OrderedDict()
+    for regex, check_times in rules:
+        for link in Session.filter_links(url, linklist, regex=regex):
+            if link['href'] not in chosen:
+                chosen[link['href']] = (link, check_times)
+    return list(chosen.values())
+
+
+def _fetch_lut(luts, link, filepath):
+    """
+    Download one LUT, returning filepath if it was retrieved.
+    A failed download leaves any existing copy alone (and its time unset).
+    """
+    if luts.session.download_file(link['href'], filepath) or \
+       not os.path.isfile(filepath):
+        return None
+    Session.set_mtime(filepath, link['mtime'])
+    return filepath
+
+
+def sync_luts(lut_sets, workers=DEFAULT_WORKERS):
+    """
+    Update the LUT directories of every LutUtils object in lut_sets together.
+    The remote listing of each directory is fetched once, and the listings
+    and downloads share one pool of workers (and the one HTTP session).
+    Returns a list of the new files in each directory that has any.
+    """
+    import concurrent.futures
+
+    query = '?format=json'
+
+    # each directory is only updated once, e.g. 'modis' for modisa and modist
+    dirs = OrderedDict()
+    for luts in lut_sets:
+        for d in luts.lut_dirs():
+            if d not in dirs:
+                dirs[d] = luts
+    urls = dict((d, os.path.join(luts.site_root, d, '') + query)
+                for d, luts in dirs.items())
+
+    downloaded = []
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as pool:
+        listings = dict(zip(dirs, pool.map(
+            lambda d: dirs[d].session.list_links(urls[d]), dirs)))
+
+        # queue the downloads for every directory before waiting on any
+        fetches = OrderedDict()
+        for d, luts in dirs.items():
+            dirpath = os.path.join(luts.localroot, d)
+            if luts.verbose:
+                print()
+                print('Downloading files into ' + dirpath)
+                if luts.dry_run:
+                    print('Dry run:')
+            if not os.path.exists(dirpath) and not luts.dry_run:
+                os.makedirs(dirpath)
+
+            fetches[d] = []
+            for link, check_times in choose_links(urls[d], listings[d],
+                                                  luts.lut_rules()):
+                f = os.path.basename(link['href'])
+                filepath = os.path.join(dirpath, f)
+                if luts.clobber or Session.needs_download(
+                        link, filepath, check_times=check_times):
+                    if luts.verbose:
+                        print('+ ' + f)
+                    if not luts.dry_run:
+                        fetches[d].append(pool.submit(_fetch_lut, luts, link,
+                                                      filepath))
+
+        for d, luts in dirs.items():
+            newfiles = [future.result() for future in fetches[d]]
+            newfiles = [f for f in newfiles if f]
+            if len(newfiles) == 0:
+                if luts.verbose:
+                    print('...no new files in ' + d)
+            else:
+                downloaded.append(newfiles)
+
+                # remove outdated LUTs from OPER
+                if 'OPER' in d:
+                    purge_luts(newfiles, verbose=luts.verbose)
+
+    for luts in lut_sets:
+        if luts.session.status:
+            luts.status = 1
+    return downloaded
+
+
 class LutUtils:
     """
     Utilities to update various LUT files for processing
     """
 
     def __init__(self, mission=None, verbose=False, evalluts=False,
-                 timeout=10, clobber=False, dry_run=False):
+                 timeout=10, clobber=False, dry_run=False,
+                 workers=DEFAULT_WORKERS):
 
         self.mission = mission
         self.verbose = verbose
@@ -72,6 +175,7 @@ class LutUtils:
         self.timeout = timeout
         self.clobber = clobber
         self.dry_run = dry_run
+        self.workers = workers
         self.status = 0
         self.site_root = 'https://oceandata.sci.gsfc.nasa.gov/Ancillary/LUTs'
         self.localroot = os.getenv('OCVARROOT')
@@ -110,60 +214,24 @@ class LutUtils:
         '''
         return dirs
 
-    def get_luts(self):
-
+    def lut_rules(self):
+        """
+        Returns the (regex, check_times) rules choosing the files to update
+        in each directory
+        """
         # regex for all valid suffixes
         # suffix = '\.(hdf|h5|nc|dat|txt)$'
         suffix = ''  # take whatever's there
-        query = '?format=json'
-
-        downloaded = []
-        for d in self.lut_dirs():
-            url = os.path.join(self.site_root, d, '') + query
-            dirpath = os.path.join(self.localroot, d)
-            if self.verbose:
-                print()
-                print('Downloading files into ' + dirpath)
-
-            newfiles = []
-            if self.mission == "common":
-                newfiles = self.session.download_allfiles(
-                    url, dirpath,
-                    dry_run=self.dry_run, clobber=self.clobber,
-                    regex="(?m)^(?!.*(?:gbr100|gbrReflectance|LandWater15ARC|VIIRS_DARKTARGET_LUT)).*$", 
-                    check_times=True)
-                if self.session.status:
-                    self.status = 1
-            else:
-                # check times for non-versioned files
-                new1 = self.session.download_allfiles(
-                    url, dirpath,
-                    dry_run=self.dry_run, clobber=self.clobber,
-                    regex='^((?!\d+).)*' + suffix, check_times=True)
-                if self.session.status:
-                    self.status = 1
-    
-                # check only filesize for others
-                new2 = self.session.download_allfiles(
-                    url, dirpath,
-                    dry_run=self.dry_run, clobber=self.clobber,
-                    regex=suffix, check_times=False)
-                if self.session.status:
-                    self.status = 1
-    
-                newfiles = new1 + new2
 
+        if self.mission == "common":
+            return [(COMMON_REGEX, True)]
 
-            if len(newfiles) == 0:
-                if self.verbose:
-                    print('...no new files.')
-            else:
-                downloaded.append(newfiles)
+        # check times for non-versioned files,
+        # and only filesize for others
+        return [('^((?!\d+).)*' + suffix, True),
+                (suffix, False)]
 
-                # remove outdated LUTs from OPER
-                if 'OPER' in d:
-                    purge_luts(newfiles, verbose=self.verbose)
-
-        return downloaded
+    def get_luts(self):
+        return sync_luts([self], workers=self.workers)
 
 # end of class LutUtils
@@ -10,6 +10,23 @@ import re
 import subprocess
 import sys
 
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+try:
+    import h5py
+except ImportError:
+    h5py = None
+try:
+    from pyhdf.SD import SD, SDC
+except ImportError:
+    SD = None
+
+HDF4_SIGNATURE = b'\x0e\x03\x13\x01'
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+NETCDF_SIGNATURE = b'CDF'
+
 def get_hdf4_content(filename):
     """
     Returns the header content from an HDF 4 file, which is obtained via
@@ -192,10 +209,172 @@ def dump_metadata(filename):
         except UnicodeDecodeError:
             return []
 
+def get_file_format(filename):
+    """
+    Returns 'hdf4', 'hdf5' or 'netcdf' according to the signature ("magic
+    bytes") found in the file, or None if none of those is found.  HDF 5
+    signatures are searched for at the offsets allowed for a user block.
+    """
+    try:
+        with open(filename, 'rb') as in_file:
+            header = in_file.read(8)
+            if header[0:4] == HDF4_SIGNATURE:
+                return 'hdf4'
+            if header[0:3] == NETCDF_SIGNATURE:
+                return 'netcdf'
+            offset = 0
+            file_size = os.path.getsize(filename)
+            while offset + 8 <= file_size:
+                if header == HDF5_SIGNATURE:
+                    return 'hdf5'
+                offset = 512 if offset == 0 else offset * 2
+                in_file.seek(offset)
+                header = in_file.read(8)
+    except (IOError, OSError):
+        pass
+    return None
+
+def attr_value_to_text(value):
+    """
+    Returns the text form of an attribute value read by netCDF4 or h5py, as
+    it would appear in h5dump output.
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace').strip().strip('"').strip()
+    if isinstance(value, str):
+        return value.strip().strip('"').strip()
+    if hasattr(value, 'tolist'):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return ' '.join([attr_value_to_text(val) for val in value])
+    return str(value)
+
+def get_hdf5_attrs_nc(filename):
+    """
+    Reads the attributes of an HDF 5/netCDF4 file, its groups and its
+    variables using netCDF4.  Like the XML parsing done for h5dump output,
+    all attributes go in one dictionary, with later (more deeply nested)
+    attributes replacing earlier ones having the same name.
+    """
+    attrs = {}
+    nc_file = netCDF4.Dataset(filename, 'r')
+    try:
+        add_nc_group(nc_file, attrs)
+    finally:
+        nc_file.close()
+    return attrs
+
+def add_nc_group(group, attrs):
+    """
+    add netCDF4 attributes to attrs and descend groups
+    """
+    for attr_name in group.ncattrs():
+        attrs[attr_name] = attr_value_to_text(group.getncattr(attr_name))
+    for grp_name in sorted(group.groups):
+        add_nc_group(group.groups[grp_name], attrs)
+    for var_name in sorted(group.variables):
+        var = group.variables[var_name]
+        for attr_name in var.ncattrs():
+            attrs[attr_name] = attr_value_to_text(var.getncattr(attr_name))
+
+def get_hdf5_attrs_h5py(filename):
+    """
+    Reads the attributes of an HDF 5 file using h5py, following the same
+    conventions as get_hdf5_attrs_nc.
+    """
+    attrs = {}
+    h5_file = h5py.File(filename, 'r')
+    try:
+        add_h5_group(h5_file, attrs)
+    finally:
+        h5_file.close()
+    return attrs
+
+def add_h5_group(group, attrs):
+    """
+    add h5py attributes to attrs and descend groups
+    """
+    for attr_name in group.attrs:
+        attrs[attr_name] = attr_value_to_text(group.attrs[attr_name])
+    if isinstance(group, h5py.Group):
+        for member_name in sorted(group.keys()):
+            member = group.get(member_name)
+            if member is not None:
+                add_h5_group(member, attrs)
+
+def get_hdf4_attrs_sd(filename):
+    """
+    Reads the file attributes of an HDF 4 file using pyhdf, returning them in
+    the form readMetadata produces from 'hdp dumpsds' output.
+    """
+    sd_file = SD(filename, SDC.READ)
+    try:
+        file_attrs = sd_file.attributes()
+        has_datasets = sd_file.info()[0] > 0
+    finally:
+        sd_file.end()
+    attrs = {}
+    for name, value in file_attrs.items():
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        if has_datasets:
+            if isinstance(value, str):
+                value = re.sub(r'\s*=\s*', '=', value.replace('\x00', ''))
+            elif isinstance(value, list):
+                value = tuple(value)
+            if 'Metadata.' in name:
+                value = parse_odl(value)
+        else:
+            if isinstance(value, (list, tuple)):
+                value = ' '.join([str(val) for val in value])
+            value = str(value).replace('\x00', '').strip()
+            if name == 'Input Parameters':
+                params = {}
+                for param in value.split('|'):
+                    parts = param.split('=')
+                    if len(parts) == 2:
+                        params[parts[0].strip()] = parts[1].strip()
+                value = params
+        attrs[name] = value
+    if has_datasets:
+        prune_odl(attrs)
+    return attrs
+
+def read_metadata_in_process(filename):
+    """
+    Reads the file attributes of HDF 4, HDF 5 and netCDF4 files directly
+    (via pyhdf, netCDF4 or h5py), without running hdp or h5dump.  Returns
+    None when the file's format or the modules needed to read it are not
+    available, or the file cannot be read, so that the caller can fall back
+    to dump_metadata.
+    """
+    file_format = get_file_format(filename)
+    readers = []
+    if file_format == 'hdf5':
+        if netCDF4:
+            readers.append(get_hdf5_attrs_nc)
+        if h5py:
+            readers.append(get_hdf5_attrs_h5py)
+    elif file_format == 'hdf4' and SD:
+        readers.append(get_hdf4_attrs_sd)
+    for reader in readers:
+        try:
+            return reader(filename)
+        except Exception:
+            continue
+    return None
+
 def readMetadata(filename):
     """
     Returns a dictionary containing the metadata for the file named by filename.
     """
+    # Try reading the attributes directly first; only dump the header with
+    # the external HDF/netCDF utilities if that isn't possible.
+    if os.path.isfile(filename):
+        attrs = read_metadata_in_process(filename)
+        if attrs is not None:
+            return attrs
+
     # todo: MERIS N1 files?
     text = dump_metadata(filename)
     # Added text == [] & changed exit() to sys.exit()    -Matt, Feb. 15, 2012
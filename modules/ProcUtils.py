@@ -13,6 +13,7 @@ import time
 import datetime
 import logging
 import requests
+import urllib3
 from requests.adapters import HTTPAdapter
 
 from modules.MetaUtils import readMetadata
@@ -22,7 +23,7 @@ from modules.MetaUtils import readMetadata
 #
 # The next 3 functions:
 #    getSession
-#    httpdl
+#    httpdl (with httpdl_url, _stream_to_part and decompress_part)
 #    uncompressFile
 #
 # exist in two places:
@@ -33,6 +34,8 @@ from modules.MetaUtils import readMetadata
 #
 
 DEFAULT_CHUNK_SIZE = 131072
+MIN_CHUNK_SIZE = 65536
+MAX_CHUNK_SIZE = 8388608
 
 # requests session object used to keep connections around
 obpgSession = None
@@ -61,49 +64,329 @@ def getSession(verbose=0, ntries=5):
 # See comment above
 def httpdl(server, request, localpath='.', outputfilename=None, ntries=5,
            uncompress=False, timeout=30., verbose=0, 
-           chunk_size=DEFAULT_CHUNK_SIZE):
+           chunk_size=DEFAULT_CHUNK_SIZE, resume=True, checksum=None,
+           http_cache=None):
+    """
+    Download https://<server><request>; see httpdl_url for the details.
+    """
+    urlStr = 'https://' + server + request
+    return httpdl_url(urlStr, localpath=localpath,
+                      outputfilename=outputfilename, ntries=ntries,
+                      uncompress=uncompress, timeout=timeout, verbose=verbose,
+                      chunk_size=chunk_size, resume=resume, checksum=checksum,
+                      http_cache=http_cache)
+
+
+def httpdl_url(urlStr, localpath='.', outputfilename=None, ntries=5,
+               uncompress=False, timeout=30., verbose=0,
+               chunk_size=DEFAULT_CHUNK_SIZE, resume=True, checksum=None,
+               session=None, http_cache=None):
+    """
+    Download urlStr into localpath.
+
+    The data are written to <outputfilename>.part, which is only renamed to
+    the final name once the transfer is complete and verified (against the
+    Content-Length, or checksum if given as e.g. 'md5:<hexdigest>').  If the
+    transfer is interrupted it is retried, up to ntries times, resuming from
+    the end of the .part file with an HTTP Range request; with resume set, a
+    .part file left by an earlier run is resumed the same way.  The remote
+    file's ETag (or Last-Modified time) is kept in a .part.validator file and
+    sent as If-Range, so a file changed on the server is downloaded again
+    from the start rather than spliced onto the old part.
+
+    The read size starts at chunk_size and adapts to the transfer rate.
+    With uncompress set, .gz and .bz2 files are decompressed in-process
+    (.Z files still use uncompressFile).
+
+    Small responses (listings, API queries) may instead be fetched through
+    http_cache (an http_cache.HttpCache), which revalidates a stored copy
+    with a conditional request; these are neither resumed nor decompressed.
+
+    Returns 0 on success, the HTTP status for a failed request, or 1 if the
+    download could not be completed or verified.
+    """
+    if session is None:
+        session = getSession(verbose=verbose, ntries=ntries)
+
+    if http_cache is not None:
+        return _httpdl_cached(http_cache, session, urlStr, localpath,
+                              outputfilename, timeout, verbose)
 
     status = 0
-    urlStr = 'https://' + server + request
+    ofile = None
+    if outputfilename:
+        ofile = os.path.join(localpath, outputfilename)
+    tries = max(ntries, 1)
+
+    while True:
+        offset = 0
+        headers = {}
+        if ofile and os.path.exists(ofile + '.part'):
+            validator = _read_validator(ofile + '.part')
+            if resume and validator:
+                offset = os.path.getsize(ofile + '.part')
+                headers['Range'] = 'bytes={0}-'.format(offset)
+                headers['If-Range'] = validator
+            else:
+                # without a validator the part can't be shown to belong to
+                # the current remote file
+                _remove_part(ofile + '.part')
+
+        try:
+            with session.get(urlStr, stream=True, timeout=timeout,
+                             headers=headers) as req:
+                if req.status_code == 416 and offset:
+                    # the partial file does not match the remote file;
+                    # start over
+                    _remove_part(ofile + '.part')
+                    continue
+
+                ctype = req.headers.get('Content-Type')
+                if req.status_code in (400, 401, 403, 404, 416):
+                    return req.status_code
+                elif ctype and ctype.startswith('text/html'):
+                    return 401
+                elif not req.ok:
+                    return req.status_code
+
+                if not ofile:
+                    cd = req.headers.get('Content-Disposition')
+                    if cd:
+                        outputfilename = re.findall("filename=(.+)", cd)[0].strip('"')
+                    else:
+                        outputfilename = urlStr.split('?')[0].split('/')[-1]
+                    ofile = os.path.join(localpath, outputfilename)
+                    if resume and os.path.exists(ofile + '.part'):
+                        # now that the name is known, resume the earlier run
+                        continue
+
+                if not os.path.exists(localpath):
+                    os.umask(0o02)
+                    try:
+                        os.makedirs(localpath, mode=0o2775)
+                    except OSError:
+                        if not os.path.isdir(localpath):
+                            raise
+
+                if req.status_code != 206:
+                    # a new transfer (or the remote file changed)
+                    _save_validator(ofile + '.part', req)
+                status = _stream_to_part(req, ofile + '.part', offset,
+                                         chunk_size, checksum, verbose)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout,
+                urllib3.exceptions.HTTPError) as e:
+            if verbose:
+                print('Transfer of {0} interrupted: {1}'.format(urlStr, e))
+            status = 1
+
+        if not status:
+            break
+        tries -= 1
+        if tries <= 0 or not resume or not ofile:
+            if ofile and not resume:
+                _remove_part(ofile + '.part')
+            return status
+        if verbose:
+            print('Retrying {0}; {1} tries left.'.format(urlStr, tries))
 
-    global obpgSession
+    remove(ofile + '.part.validator')
+    if uncompress and re.search(".(Z|gz|bz2)$", ofile):
+        if ofile.endswith('.Z'):
+            os.rename(ofile + '.part', ofile)
+            return uncompressFile(ofile)
+        return decompress_part(ofile + '.part', ofile, verbose)
 
-    getSession(verbose=verbose, ntries=ntries)
+    os.rename(ofile + '.part', ofile)
+    return 0
+
+
+def _read_validator(partfile):
+    """
+    Return the validator saved for partfile, or None
+    """
+    try:
+        with open(partfile + '.validator', 'r') as fd:
+            return fd.read().strip() or None
+    except (IOError, OSError):
+        return None
 
-    with obpgSession.get(urlStr, stream=True, timeout=timeout) as req:
 
-        ctype = req.headers.get('Content-Type')
-        if req.status_code in (400, 401, 403, 404, 416):
-            status = req.status_code
-        elif ctype and ctype.startswith('text/html'):
-            status = 401
+def _save_validator(partfile, req):
+    """
+    Save the validator of the response req (a strong ETag, or else the
+    Last-Modified time) for a later If-Range request to resume partfile
+    """
+    etag = req.headers.get('ETag')
+    if etag and etag.startswith('W/'):
+        # If-Range needs a strong validator
+        etag = None
+    validator = etag or req.headers.get('Last-Modified')
+    if not validator:
+        remove(partfile + '.validator')
+        return
+    with open(partfile + '.validator', 'w') as fd:
+        fd.write(validator + '\n')
+
+
+def _remove_part(partfile):
+    """
+    Remove a partial download and its validator
+    """
+    remove(partfile)
+    remove(partfile + '.validator')
+
+
+def _httpdl_cached(http_cache, session, urlStr, localpath, outputfilename,
+                   timeout, verbose):
+    """
+    Fetch urlStr through http_cache and write the body into localpath.
+    Returns 0 on success, the HTTP status for a failed request, or 1 if the
+    server could not be reached.
+    """
+    try:
+        req = http_cache.fetch(session, urlStr, timeout=timeout)
+    except (requests.exceptions.RequestException,
+            urllib3.exceptions.HTTPError) as e:
+        if verbose:
+            print('Request for {0} failed: {1}'.format(urlStr, e))
+        return 1
+    if verbose and getattr(req, 'stale', False):
+        print('Server unavailable; using the cached response for ' + urlStr)
+
+    ctype = req.headers.get('Content-Type')
+    if req.status_code in (400, 401, 403, 404, 416):
+        return req.status_code
+    elif ctype and ctype.startswith('text/html'):
+        return 401
+    elif not req.ok:
+        return req.status_code
+
+    if not outputfilename:
+        cd = req.headers.get('Content-Disposition')
+        if cd:
+            outputfilename = re.findall("filename=(.+)", cd)[0].strip('"')
         else:
-            if not os.path.exists(localpath):
-                os.umask(0o02)
-                os.makedirs(localpath, mode=0o2775)
-    
-            if not outputfilename:
-                cd = req.headers.get('Content-Disposition')
-                if cd:
-                    outputfilename = re.findall("filename=(.+)", cd)[0]
-                else:
-                    outputfilename = urlStr.split('/')[-1]
-    
-            ofile = os.path.join(localpath, outputfilename)
-        
-            with open(ofile, 'wb') as fd:
-                for chunk in req.iter_content(chunk_size=chunk_size):
-                    if chunk: # filter out keep-alive new chunks
-                        fd.write(chunk)
-    
-            if uncompress and re.search(".(Z|gz|bz2)$", ofile):
-                compressStatus = uncompressFile(ofile)
-                if compressStatus:
-                    status = compressStatus
-            else:
-                status = 0
+            outputfilename = urlStr.split('?')[0].split('/')[-1]
+    ofile = os.path.join(localpath, outputfilename)
+    if not os.path.exists(localpath):
+        os.umask(0o02)
+        try:
+            os.makedirs(localpath, mode=0o2775)
+        except OSError:
+            if not os.path.isdir(localpath):
+                raise
+    with open(ofile + '.part', 'wb') as fd:
+        fd.write(req.content)
+    os.rename(ofile + '.part', ofile)
+    return 0
+
+
+def _stream_to_part(req, partfile, offset, chunk_size, checksum, verbose):
+    """
+    Write the body of the streamed response req to partfile, appending if
+    the server honored a Range request from offset.  Returns 0 if the file
+    is complete and matches the expected size and checksum, 1 otherwise.
+    """
+    import hashlib
 
-    return status
+    if req.status_code == 206:
+        crange = req.headers.get('Content-Range', '')
+        match = re.match(r'bytes (\d+)-', crange)
+        if not match or int(match.group(1)) != offset:
+            offset = 0
+    else:
+        offset = 0
+
+    hasher = None
+    if checksum:
+        algorithm = checksum.split(':')[0]
+        hasher = hashlib.new(algorithm)
+        if offset:
+            with open(partfile, 'rb') as fd:
+                for block in iter(lambda: fd.read(MAX_CHUNK_SIZE), b''):
+                    hasher.update(block)
+
+    expected = None
+    clength = req.headers.get('Content-Length')
+    # with Content-Encoding the decoded size differs from Content-Length
+    if clength and not req.headers.get('Content-Encoding'):
+        expected = offset + int(clength)
+
+    if verbose and offset:
+        print('Resuming download at byte {0}'.format(offset))
+
+    size = chunk_size
+    with open(partfile, 'ab' if offset else 'wb') as fd:
+        while True:
+            t0 = time.time()
+            chunk = req.raw.read(size, decode_content=True)
+            if not chunk:
+                break
+            fd.write(chunk)
+            if hasher:
+                hasher.update(chunk)
+            # adapt the read size so each read takes roughly 0.1-1 second
+            elapsed = time.time() - t0
+            if elapsed < 0.1 and size < MAX_CHUNK_SIZE:
+                size = min(size * 2, MAX_CHUNK_SIZE)
+            elif elapsed > 1. and size > MIN_CHUNK_SIZE:
+                size = max(size // 2, MIN_CHUNK_SIZE)
+
+    if expected is not None and os.path.getsize(partfile) != expected:
+        print('Incomplete download of {0}: {1} of {2} bytes'.format(
+            partfile, os.path.getsize(partfile), expected))
+        return 1
+    if hasher and hasher.hexdigest() != checksum.split(':', 1)[1].lower():
+        print('Checksum mismatch for {0}'.format(partfile))
+        os.remove(partfile)
+        return 1
+    return 0
+
+
+def decompress_part(partfile, ofile, verbose=0):
+    """
+    Decompress the gzip or bzip2 file partfile, downloaded for ofile, into
+    ofile without its .gz/.bz2 extension, then remove partfile.
+    Returns 0 on success, 1 otherwise; partfile is removed either way.
+    """
+    import bz2
+    import zlib
+
+    target = os.path.splitext(ofile)[0]
+    tmpfile = target + '.part'
+
+    def new_decompressor():
+        if ofile.endswith('.bz2'):
+            return bz2.BZ2Decompressor()
+        # wbits 16 + MAX_WBITS reads the gzip header and trailer
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    try:
+        decompressor = new_decompressor()
+        with open(partfile, 'rb') as src, open(tmpfile, 'wb') as dst:
+            for block in iter(lambda: src.read(MAX_CHUNK_SIZE), b''):
+                while block:
+                    # files may hold several concatenated streams
+                    if decompressor.eof:
+                        decompressor = new_decompressor()
+                    dst.write(decompressor.decompress(block))
+                    block = decompressor.unused_data
+            if not decompressor.eof:
+                raise EOFError('compressed data ended before the end-of-stream marker')
+    except (IOError, OSError, EOFError, zlib.error) as e:
+        print("Warning! Unable to decompress %s: %s" % (ofile, e))
+        # the data are corrupt; don't leave them under the final name
+        remove(tmpfile)
+        remove(partfile)
+        return 1
+
+    os.rename(tmpfile, target)
+    os.remove(partfile)
+    if verbose:
+        print('Decompressed {0}'.format(target))
+    return 0
 
 
 #  ------------------ DANGER -------------------
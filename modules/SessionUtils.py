@@ -4,6 +4,12 @@ import sys
 import time
 import re
 import requests
+from ProcUtils import httpdl_url
+try:
+    # the same module (and default cache) as anc_utils and the scripts use
+    from modules.http_cache import get_default_cache
+except ImportError:  # run from the modules directory
+    from http_cache import get_default_cache
 
 python2 = sys.version_info.major < 3
 
@@ -11,8 +17,14 @@ python2 = sys.version_info.major < 3
 
 if python2:
     from urlparse import urljoin, urlsplit, urlunsplit
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
 else:  # python 3
     from urllib.parse import urljoin, urlsplit, urlunsplit
+    from html import unescape
+
+# bytes read at a time from a streamed page
+PAGE_CHUNK_SIZE = 65536
 
 
 def base_url(url):
@@ -86,7 +98,58 @@ def set_mtime(filepath, mtime):
 
 # URL content parsing utils:
 
+# <a ...> tags, and the href attribute within one
+ANCHOR_TAG = re.compile(r'<a\s[^>]*>', re.IGNORECASE)
+HREF_ATTR = re.compile(r'''\shref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''',
+                       re.IGNORECASE)
+
+
+def iterlinks_html(chunks, regex='', encoding=None):
+    """
+    Yields the links matching regex from a page arriving in chunks
+    (e.g. from response.iter_content), as each chunk is scanned,
+    so the whole page is never held in memory.
+    Only the <a> tags are looked at; a tag split between chunks
+    is held back until the rest of it arrives.
+    """
+    import codecs
+    decoder = codecs.getincrementaldecoder(encoding or 'utf-8')('replace')
+    regex = re.compile(regex)
+    pending = ''
+    chunks = iter(chunks)
+    while True:
+        chunk = next(chunks, None)
+        if chunk is None:
+            text = pending + decoder.decode(b'', True)
+            end = len(text)
+        else:
+            if isinstance(chunk, bytes):
+                chunk = decoder.decode(chunk)
+            text = pending + chunk
+            # stop before a tag which isn't complete yet
+            end = text.rfind('<')
+            if end == -1 or text.find('>', end) != -1:
+                end = len(text)
+        for tag in ANCHOR_TAG.finditer(text, 0, end):
+            href = HREF_ATTR.search(tag.group(0))
+            if href:
+                link = unescape(href.group(1) or href.group(2) or href.group(3) or '')
+                if regex.search(link):
+                    yield link
+        if chunk is None:
+            return
+        pending = text[end:]
+
+
 def getlinks_html(content, regex=''):
+    return list(iterlinks_html([content], regex))
+
+
+def getlinks_soup(content, regex=''):
+    """
+    The former BeautifulSoup version of getlinks_html,
+    kept for comparison in benchmark_getlinks (python 2 only).
+    """
     from BeautifulSoup import BeautifulSoup, SoupStrainer
     soup = BeautifulSoup(content, parseOnlyThese=SoupStrainer('a'))
     linklist = soup.findAll('a', attrs={'href': re.compile(regex)})
@@ -94,6 +157,41 @@ def getlinks_html(content, regex=''):
     return linklist
 
 
+def benchmark_getlinks(nlinks=50000, repeat=3):
+    """
+    Times link extraction from a synthetic directory index page
+    of nlinks files, with getlinks_html and with getlinks_soup.
+    """
+    rows = ['<tr><td><a href="file_{0:06d}.nc">file_{0:06d}.nc</a></td>'
+            '<td>2020-01-01 00:00</td><td>{1}</td></tr>'.format(i, 1000 + i)
+            for i in range(nlinks)]
+    page = '<html><body><table>\n' + '\n'.join(rows) + '\n</table></body></html>'
+    data = page.encode('utf-8')
+    print('Synthetic index page: {} links, {} bytes'.format(nlinks, len(data)))
+
+    def chunked():
+        for start in range(0, len(data), PAGE_CHUNK_SIZE):
+            yield data[start:start + PAGE_CHUNK_SIZE]
+
+    tests = [('getlinks_html', lambda: getlinks_html(page, r'\.nc$')),
+             ('iterlinks_html (streamed)',
+              lambda: list(iterlinks_html(chunked(), r'\.nc$'))),
+             ('getlinks_soup', lambda: getlinks_soup(page, r'\.nc$'))]
+    for name, func in tests:
+        try:
+            best = None
+            for _ in range(repeat):
+                start = time.time()
+                links = func()
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+        except (ImportError, SyntaxError) as e:
+            print('{:<26} unavailable: {}'.format(name, e))
+            continue
+        print('{:<26} {:8.3f} s  ({} links)'.format(name, best, len(links)))
+
+
 def getlinks_json(content, regex=''):
     import json
     parsed_json = json.loads(content)['rows']
@@ -105,6 +203,40 @@ def getlinks_json(content, regex=''):
     return linklist
 
 
+def getlinkinfo_json(content):
+    """
+    Returns {link: (mtime, size)} from the rows of a json listing;
+    mtime or size is None if the listing doesn't give it.
+    """
+    import json
+    parsed_json = json.loads(content)['rows']
+    linkinfo = {}
+    for row in parsed_json:
+        mtime = None
+        size = None
+        if len(row) > 1:
+            mtime = listing_mtime(row[1])
+        if len(row) > 2:
+            try:
+                size = int(row[2])
+            except (TypeError, ValueError):
+                pass
+        linkinfo[str(row[0])] = (mtime, size)
+    return linkinfo
+
+
+def listing_mtime(mtime):
+    """
+    Returns timestamp from a json listing as seconds since the epoch,
+    or None if it can't be parsed.
+    """
+    try:
+        urltime = time.strptime(mtime, "%Y-%m-%d %H:%M:%S")
+        return time.mktime(urltime)
+    except (TypeError, ValueError):
+        return None
+
+
 # requests.Response utils:
 
 def print_response(response):
@@ -137,26 +269,37 @@ def url_mtime(response):
 
 class SessionUtils:
 
-    def __init__(self, timeout=5, max_tries=5, verbose=False, clobber=False):
+    def __init__(self, timeout=5, max_tries=5, verbose=False, clobber=False,
+                 use_cache=True):
         self.timeout = timeout
         self.max_tries = max_tries
         self.verbose = verbose
         self.clobber = clobber
         self.session = requests.Session()
+        # page listings are revalidated rather than fetched again
+        self.cache = None
+        if use_cache:
+            self.cache = get_default_cache()
 
-    def open_url(self, url, ntries=None, get=False):
+    def open_url(self, url, ntries=None, get=False, stream=False):
         """
         Return requests.Session object for specified url.
         Retries up to self.max_tries times if server is busy.
-        By default, retrieves header only.
+        By default, retrieves header only; with get and stream set, the
+        body is left to be read (and is written to the cache as it is).
         """
         if not ntries:
             ntries = self.max_tries
         response = None
 
         try:
-            if get:
-                response = self.session.get(url, timeout=self.timeout)
+            if get and self.cache:
+                response = self.cache.fetch(self.session, url,
+                                            timeout=self.timeout,
+                                            stream=stream)
+            elif get:
+                response = self.session.get(url, timeout=self.timeout,
+                                            stream=stream)
             else:
                 response = self.session.head(url, timeout=self.timeout)
             # if self.verbose:
@@ -179,7 +322,8 @@ class SessionUtils:
             elif (response.status_code > 499) and (ntries > 0):
                 if self.verbose:
                     print('Server busy; will retry {}'.format(url))
-                response = retry(self.open_url, url, ntries=ntries, get=get)
+                response = retry(self.open_url, url, ntries=ntries, get=get,
+                                 stream=stream)
 
             # give up if too many tries
             elif ntries == 0:
@@ -194,7 +338,8 @@ class SessionUtils:
             if ntries > 0:
                 if self.verbose:
                     print('Server timeout; will retry {}'.format(url))
-                response = retry(self.open_url, url, ntries=ntries, get=get)
+                response = retry(self.open_url, url, ntries=ntries, get=get,
+                                 stream=stream)
                 pass
 
         except Exception as e:
@@ -203,10 +348,13 @@ class SessionUtils:
         finally:
             return response
 
-    def needs_download(self, url, filepath, check_times=False, response=None):
+    def needs_download(self, url, filepath, check_times=False, response=None,
+                       mtime=None, size=None):
         """
         Returns False if filepath is present and size matches remote url;
         True otherwise.  Optionally check timestamp as well.
+        The remote size and mtime are taken from the directory listing
+        when given, otherwise from the url's header.
         """
 
         # only download files
@@ -218,29 +366,41 @@ class SessionUtils:
             #     print('Local file not found:', filepath)
             return True
 
-        if not response:
-            response = self.open_url(url)
-        if not (response and response.ok):
-            return False
+        # fall back to the header if the listing lacks what's needed
+        if size is None or (check_times and mtime is None):
+            if not response:
+                response = self.open_url(url)
+            if not (response and response.ok):
+                return False
+            size = int(response.headers['Content-Length'])
+            mtime = url_mtime(response)
 
         # check file size
-        diffsize = os.path.getsize(filepath) != int(response.headers['Content-Length'])
+        diffsize = os.path.getsize(filepath) != size
         if not check_times:
             return diffsize
 
         # optionally check timestamp
         else:
-            older = os.path.getmtime(filepath) < url_mtime(response)
+            older = os.path.getmtime(filepath) < mtime
             return diffsize or older
 
-    def download_file(self, url, filepath):
+    def download_file(self, url, filepath, mtime=None):
+        """
+        Download url to filepath, setting its modification time to mtime
+        (from the directory listing) or else to the url's Last-Modified.
+        """
         try:
-            r = self.session.get(url, timeout=self.timeout, stream=True)
-            with open(filepath, 'wb') as fd:
-                for chunk in r.iter_content(chunk_size=512):
-                    fd.write(chunk)
-            response = self.open_url(url)
-            set_mtime(filepath, url_mtime(response))
+            status = httpdl_url(url, localpath=os.path.dirname(filepath) or '.',
+                                outputfilename=os.path.basename(filepath),
+                                ntries=self.max_tries, timeout=self.timeout,
+                                verbose=self.verbose, session=self.session)
+            if status:
+                print('Error downloading {}'.format(filepath))
+                return
+            if mtime is None:
+                mtime = url_mtime(self.open_url(url))
+            set_mtime(filepath, mtime)
         except Exception as e:
             print('Exception: {:}'.format(e))
 
@@ -250,15 +410,31 @@ class SessionUtils:
         Optionally specify regex to filter for acceptable files;
         default is to list only links starting with url.
         """
-        response = self.open_url(url, get=True)
+        return [link for link, mtime, size in
+                self.list_pagelinks(url, regex=regex)]
+
+    def list_pagelinks(self, url, regex=''):
+        """
+        Like list_pageurls, but returns (link, mtime, size) for each link.
+        mtime and size come from a json listing; they're None for an html
+        listing, or if the listing doesn't give them.
+        """
+        response = self.open_url(url, get=True, stream=True)
+        linkinfo = {}
         if is_html(response):
-            linklist = getlinks_html(response.text, regex)
+            # parse the page as it arrives
+            linklist = list(iterlinks_html(
+                response.iter_content(PAGE_CHUNK_SIZE), regex,
+                response.encoding))
         elif is_json(response):
             linklist = getlinks_json(response.text, regex)
+            linkinfo = getlinkinfo_json(response.text)
         else:
             return []
 
         # get full url
+        linkinfo = dict((full_url(url, link), info)
+                        for link, info in linkinfo.items())
         linklist = [full_url(url, link) for link in linklist]
 
         # if no filter, return only links containing url
@@ -267,7 +443,8 @@ class SessionUtils:
             linklist = [link for link in linklist if base_url(url) in link]
 
         # return sorted, unique list
-        return sorted(set(linklist))
+        return [(link,) + linkinfo.get(link, (None, None))
+                for link in sorted(set(linklist))]
 
     def download_allfiles(self, url, dirpath, regex='', check_times=False,
                           response=None, clobber=False, dry_run=False):
@@ -276,65 +453,110 @@ class SessionUtils:
         Default is to download only if local file doesn't match remote size;
         set clobber=True to always download.
         """
-        if not response:
-            response = self.open_url(url)
-        if not (response and response.ok):
+        # the listing itself shows whether url is reachable,
+        # so only check a response that was passed in
+        if response is not None and not response.ok:
             return []
 
+        pagelinks = self.list_pagelinks(url, regex=regex)
+
         downloaded = []
         if dry_run and self.verbose:
             print('Dry run:')
         if not os.path.exists(dirpath) and not dry_run:
             os.makedirs(dirpath)
 
-        for link in self.list_pageurls(url, regex=regex):
+        for link, mtime, size in pagelinks:
             f = os.path.basename(link)
             filepath = os.path.join(dirpath, f)
             if clobber or self.needs_download(
-                    link, filepath, check_times=check_times):
+                    link, filepath, check_times=check_times,
+                    mtime=mtime, size=size):
+                if not dry_run:
+                    self.download_file(link, filepath, mtime=mtime)
+                    downloaded.append(filepath)
+                if self.verbose:
+                    print('+ ' + f)
+
+        return downloaded
+
+    def download_manifest(self, manifest, root_url, dirpath, check_times=False,
+                          clobber=False, dry_run=False):
+        """
+        Downloads the files in a crawler manifest (see url_crawler) into
+        dirpath, keeping their paths below root_url.
+        Default is to download only if local file doesn't match remote size;
+        set clobber=True to always download.
+        """
+        downloaded = []
+        if dry_run and self.verbose:
+            print('Dry run:')
+        root = base_url(root_url)
+
+        for link in manifest:
+            url = link['href']
+            if url.startswith(root):
+                f = url[len(root):].lstrip('/')
+            else:
+                f = os.path.basename(url)
+            filepath = os.path.join(dirpath, f)
+            if clobber or self.needs_download(
+                    url, filepath, check_times=check_times,
+                    mtime=link.get('mtime'), size=link.get('size')):
                 if not dry_run:
-                    self.download_file(link, filepath)
+                    if not os.path.exists(os.path.dirname(filepath)):
+                        os.makedirs(os.path.dirname(filepath))
+                    self.download_file(url, filepath, mtime=link.get('mtime'))
                     downloaded.append(filepath)
                 if self.verbose:
                     print('+ ' + f)
 
         return downloaded
 
+    def crawl(self, url, include=None, exclude=None, workers=None,
+              per_host=None, state_file=None, on_visit=None):
+        """
+        Crawls the pages below url breadth first, returning a manifest of
+        the files found; see url_crawler.Crawler for the arguments.
+        """
+        import url_crawler
+        crawler = url_crawler.Crawler(
+            self, include=include, exclude=exclude,
+            workers=workers or url_crawler.DEFAULT_WORKERS,
+            per_host=per_host or url_crawler.DEFAULT_PER_HOST,
+            state_file=state_file, on_visit=on_visit)
+        return crawler.crawl(url)
+
     def spider(self, url, level=0, visited=None):
         """
-        Demo crawler
+        Demo crawler: prints and returns the urls found below url
         """
         if visited is None:
             visited = []
-        try:
-            response = self.open_url(url)
-            if response.ok:
-                if self.verbose:
-                    print('{}\t{}\t{}'.
-                          format(level, url, response.headers['Content-Type']))
-                else:
-                    print(url)
-                visited.append(url)
-
-                if is_page(url):
-                    for link in self.list_pageurls(url):
-                        if (base_url(url) in link) and (link not in visited):
-                            visited = self.spider(link, level=level + 1,
-                                                  visited=visited)
+
+        def on_visit(link, depth):
+            if self.verbose:
+                print('{}\t{}'.format(level + depth, link))
             else:
-                print('spider {} {}:\t{}'.
-                      format(response.status_code, response.reason, url))
+                print(link)
+            visited.append(link)
 
+        try:
+            self.crawl(url, on_visit=on_visit)
         except Exception as e:
             print('Exception: {:}'.format(e))
 
-        finally:
-            return visited
+        return visited
 
 # end of class SessionUtils
 
 
 if __name__ == '__main__':
+    # time the html link extraction instead of crawling
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark':
+        benchmark_getlinks()
+        sys.exit(0)
+
     # parameters
     if len(sys.argv) > 1:
         url = sys.argv[1]
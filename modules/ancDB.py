@@ -1,36 +1,280 @@
 
+import atexit
+import functools
+import os
 import sqlite3
 import re
+import threading
+
+# Version of the schema, stored in the database's user_version.  Databases
+# created with an older version are migrated when they are opened.
+#   0 - original tables, no indexes
+#   1 - indexes on the columns used for lookups
+SCHEMA_VERSION = 1
+
+# Process-wide connections, keyed on the real path of the database file and
+# whether the connection is read-only.
+_shared_connections = {}
+_shared_lock = threading.Lock()
+
+# File systems on which SQLite's WAL mode is not safe: it needs shared memory
+# (the -shm file) which every process using the database can map, so it only
+# works when they are all on the same host.
+NETWORK_FILESYSTEMS = ['nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'lustre',
+                       'gpfs', 'ceph', 'glusterfs', 'fuse.sshfs', '9p']
+
+
+class SharedConnection:
+    """
+    A connection to an ancillary database shared by every ancDB object in the
+    process which opens that file with shared=True.  The lock serializes use
+    of the connection across threads.
+    """
+    def __init__(self, dbfile, wal=None, readonly=False):
+        if readonly:
+            self.conn = connect_readonly(dbfile)
+        else:
+            self.conn = sqlite3.connect(dbfile, timeout=30, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.pid = os.getpid()
+        if not readonly:
+            configure_connection(self.conn, use_wal(dbfile, wal))
+
+
+def connect_readonly(dbfile):
+    """
+    Open dbfile read-only
+    """
+    uri = 'file:' + os.path.abspath(dbfile) + '?mode=ro'
+    return sqlite3.connect(uri, timeout=30, uri=True, check_same_thread=False)
+
+
+def get_filesystem_type(path):
+    """
+    Return the type of the file system holding path, from /proc/mounts, or
+    None if it cannot be determined
+    """
+    path = os.path.realpath(path)
+    best = ''
+    fs_type = None
+    try:
+        with open('/proc/mounts', 'r') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if (path == mount_point or
+                        path.startswith(mount_point.rstrip('/') + '/')) and \
+                        len(mount_point) > len(best):
+                    best = mount_point
+                    fs_type = fields[2]
+    except (IOError, OSError):
+        return None
+    return fs_type
+
+
+def use_wal(dbfile, wal=None):
+    """
+    Decide whether to use WAL mode for dbfile: wal if it is set, otherwise
+    only when the database is known to be on a local file system
+    """
+    if wal is not None:
+        return wal
+    fs_type = get_filesystem_type(os.path.dirname(os.path.abspath(dbfile)))
+    return fs_type is not None and fs_type not in NETWORK_FILESYSTEMS
+
+
+def configure_connection(conn, wal=False):
+    """
+    Set the pragmas used for every read-write connection
+    """
+    c = conn.cursor()
+    c.execute('''PRAGMA foreign_keys = ON''')
+    c.execute('''PRAGMA busy_timeout = 30000''')
+    c.execute('''PRAGMA temp_store = MEMORY''')
+    try:
+        if wal:
+            # WAL lets readers proceed while another process writes.
+            c.execute('''PRAGMA journal_mode = WAL''')
+            c.execute('''PRAGMA synchronous = NORMAL''')
+        elif c.execute('''PRAGMA journal_mode''').fetchone()[0] == 'wal':
+            # left in WAL mode by an earlier run, e.g. before the database
+            # was moved to a network file system
+            c.execute('''PRAGMA journal_mode = DELETE''')
+    except sqlite3.OperationalError:
+        # e.g. the database is busy; the journal mode is left as it is
+        pass
+    c.close()
+
+
+def get_shared_connection(dbfile, wal=None, readonly=False):
+    """
+    Return the process-wide SharedConnection for dbfile, opening it if needed.
+    A connection inherited from a parent process (after a fork) is not reused.
+    """
+    key = (os.path.realpath(dbfile), readonly)
+    with _shared_lock:
+        shared = _shared_connections.get(key)
+        if shared is None or shared.pid != os.getpid():
+            shared = SharedConnection(dbfile, wal, readonly)
+            _shared_connections[key] = shared
+        return shared
+
+
+def close_shared_connections():
+    """
+    Commit and close all of the process-wide connections
+    """
+    with _shared_lock:
+        for key in list(_shared_connections.keys()):
+            shared = _shared_connections.pop(key)
+            if shared.pid != os.getpid():
+                continue
+            with shared.lock:
+                try:
+                    shared.conn.commit()
+                    shared.conn.close()
+                except sqlite3.Error:
+                    pass
+
+atexit.register(close_shared_connections)
+
+
+def synchronized(method):
+    """
+    Decorator holding the ancDB object's lock while the method runs
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class ancDB:
-    def __init__(self, dbfile=None, local=False):
+    def __init__(self, dbfile=None, local=False, wal=None, shared=False):
         """A small set of functions to generate, update, and read from a local SQLite database of ancillary
-        file information"""
+        file information
+
+        WAL mode is used if wal is True, or, if it is None, when the
+        database is on a local file system (WAL is not safe over NFS).
+
+        If shared is True, the process-wide connection to dbfile is used (and
+        left open by closeDB), so repeated lookups in a long-running process
+        do not reconnect each time.  The object may also be used as a context
+        manager, which holds the connection's lock and commits (or rolls back
+        on an exception) on exit."""
         self.dbfile = dbfile
         self.local = local
+        self.wal = wal
+        self.shared = shared
+        self.readonly = False
         self.conn = None
         self.cursor = None
+        self.lock = threading.RLock()
+        self._context_opened = []
 
-    def openDB(self):
+    def __enter__(self):
+        if self.conn is None:
+            self.openDB()
+            self._context_opened.append(True)
+        else:
+            self._context_opened.append(False)
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.lock.release()
+            if self._context_opened.pop():
+                self.closeDB()
+        return False
+
+    def openDB(self, readonly=False):
         """
         Open connection to the ancillary DB and initiate a cursor
+
+        With readonly set, the database is opened read-only (through a
+        shared read-only connection if shared is set): no pragmas are written
+        and no migration is attempted, which is all that is needed to look
+        up files already recorded.
         """
-        conn = sqlite3.connect(self.dbfile, timeout=30)
+        self.readonly = readonly
+        if self.shared:
+            shared = get_shared_connection(self.dbfile, self.wal, readonly)
+            self.lock = shared.lock
+            with self.lock:
+                self.conn = shared.conn
+                self.cursor = self.conn.cursor()
+                if not readonly:
+                    self.migrate_db()
+            return
+
+        if readonly:
+            conn = connect_readonly(self.dbfile)
+            self.conn = conn
+            self.cursor = conn.cursor()
+            return
+
+        conn = sqlite3.connect(self.dbfile, timeout=30, check_same_thread=False)
+        configure_connection(conn, use_wal(self.dbfile, self.wal))
         self.conn = conn
-        c = conn.cursor()
-        c.execute('''PRAGMA foreign_keys = ON''')
-        self.cursor = c
+        self.cursor = conn.cursor()
+        self.migrate_db()
         return
 
+    @synchronized
+    def migrate_db(self):
+        """
+        Bring an existing database up to SCHEMA_VERSION
+        """
+        if self.conn is None:
+            print("No connection to database!")
+            return 110
+
+        c = self.cursor
+        version = c.execute('''PRAGMA user_version''').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return 0
+        tables = c.execute("select name from sqlite_master where type = 'table' and name = 'satfiles'")
+        if tables.fetchone() is None:
+            # empty database; create_db will build the current schema
+            return 0
+
+        c.execute('''CREATE INDEX IF NOT EXISTS satfiles_filename ON satfiles (filename)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS satfiles_starttime ON satfiles (starttime)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS ancfiles_filename_type ON ancfiles (filename, type)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS ancfiles_type ON ancfiles (type)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS satancinfo_satid_ancid ON satancinfo (satid, ancid)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS satancinfo_ancid ON satancinfo (ancid)''')
+        c.execute('''PRAGMA user_version = %d''' % SCHEMA_VERSION)
+        self.conn.commit()
+        return 0
+
+    @synchronized
     def closeDB(self):
         """
         Close the DB connection, committing changes.
+        A shared connection is committed but left open for reuse.
         """
         conn = self.conn
         cursor = self.cursor
-        conn.commit()
+        if not self.readonly:
+            conn.commit()
         cursor.close()
+        if self.shared or self.readonly:
+            self.conn = None
+            self.cursor = None
+        if self.readonly and not self.shared:
+            conn.close()
 
+    @synchronized
     def create_db(self):
         """
         Create the ancillary DB
@@ -64,10 +308,17 @@ class ancDB:
             FOREIGN KEY(satID) REFERENCES satfiles(satid),
             FOREIGN KEY(ancID) REFERENCES ancfiles(ancid))''')
 
+        self.migrate_db()
+
+    @synchronized
     def insert_record(self, satfile=None, starttime=None, stoptime=None, dbstat=0,
-                      ancfile=None, ancpath=None, anctype=None, atteph=False):
+                      ancfile=None, ancpath=None, anctype=None, atteph=False,
+                      commit=True):
         """
         Insert record into ancillary DB
+        If commit is False the changes are left in the current transaction,
+        so several records can be inserted and committed together (e.g. by
+        closeDB).
         """
         if self.conn is None:
             print("No connection to database!")
@@ -86,8 +337,7 @@ class ancDB:
 
             c.execute('INSERT INTO satfiles VALUES (NULL,?,?,?,?,?)',
                 [satfile, starttime, stoptime, inputdbstat, attephstat])
-            self.conn.commit()
-            satid = ancDB.check_file(self, satfile, starttime=starttime)
+            satid = c.lastrowid
 
         else:
             if atteph:
@@ -97,12 +347,9 @@ class ancDB:
                 c.execute('''UPDATE satfiles SET status = ?
                                  WHERE satid = ?''', [dbstat, satid])
 
-            self.conn.commit()
-
         if ancid is None:
             c.execute('INSERT INTO ancfiles VALUES (NULL,?,?,?)', [ancfile, ancpath, anctype])
-            self.conn.commit()
-            ancid = ancDB.check_file(self, ancfile, anctype=anctype)
+            ancid = c.lastrowid
 
         opt = self.check_dbrtn_status(dbstat, anctype)
 
@@ -112,7 +359,10 @@ class ancDB:
         if r is None:
             c.execute('INSERT INTO satancinfo VALUES (?,?,?)', [satid, ancid, opt])
 
+        if commit:
+            self.conn.commit()
 
+    @synchronized
     def delete_record(self, filename, anctype=None, starttime=None):
         """
         Deletes records from ancillary DB
@@ -192,6 +442,7 @@ class ancDB:
             return 1
 
 
+    @synchronized
     def check_file(self, filename, anctype=None, starttime=None):
         """
         Check database for existing file, return ID if exists
@@ -206,20 +457,22 @@ class ancDB:
         id = 'satid'
         if anctype is None:
             if filename:
-                query = ' '.join(['select', id, 'from', table, 'where filename =', '"' + filename + '"'])
+                query = ' '.join(['select', id, 'from', table, 'where filename = ?'])
+                params = [filename]
             else:
-                query = ' '.join(['select', id, 'from', table, 'where starttime =', '"' + starttime + '"'])
+                query = ' '.join(['select', id, 'from', table, 'where starttime = ?'])
+                params = [starttime]
 
         else:
             table = 'ancfiles'
             id = 'ancid'
             if filename:
-                query = ' '.join(['select', id, 'from', table, 'where filename =', '"' + filename + '"', " and type = ",
-                              '"' + anctype + '"'])
+                query = ' '.join(['select', id, 'from', table, 'where filename = ? and type = ?'])
+                params = [filename, anctype]
             else:
                 return None
 
-        result = c.execute(query)
+        result = c.execute(query, params)
         r = result.fetchone()
 
         if r is None:
@@ -229,6 +482,7 @@ class ancDB:
                 print('more than one entry for this starttime - this may be a problem.?')
             return r[0]
 
+    @synchronized
     def get_status(self, filename, atteph=False, starttime=None):
         """
         Check the stored database return status
@@ -238,18 +492,17 @@ class ancDB:
             return 110
 
         c = self.cursor
+        column = 'status'
         if atteph:
-            if filename:
-                query = ' '.join(['select attephstat from satfiles where filename =', '"' + filename + '"'])
-            else:
-                query = ' '.join(['select attephstat from satfiles where starttime =', '"' + starttime + '"'])
+            column = 'attephstat'
+        if filename:
+            query = ' '.join(['select', column, 'from satfiles where filename = ?'])
+            params = [filename]
         else:
-            if filename:
-                query = ' '.join(['select status from satfiles where filename =', '"' + filename + '"'])
-            else:
-                query = ' '.join(['select status from satfiles where starttime =', '"' + starttime + '"'])
+            query = ' '.join(['select', column, 'from satfiles where starttime = ?'])
+            params = [starttime]
 
-        result = c.execute(query)
+        result = c.execute(query, params)
         r = result.fetchone()
 
         if r is None:
@@ -257,6 +510,7 @@ class ancDB:
         else:
             return r[0]
 
+    @synchronized
     def get_filetime(self, filename, starttime=None):
         """
         return the stored file start and stop times
@@ -267,14 +521,14 @@ class ancDB:
 
         c = self.cursor
         if filename:
-            query = ' '.join(['select starttime,stoptime from satfiles where filename =', '"' + filename + '"'])
+            result = c.execute('select starttime,stoptime from satfiles where filename = ?', [filename])
         else:
-            query = ' '.join(['select starttime,stoptime from satfiles where starttime =', '"' + starttime + '"'])
+            result = c.execute('select starttime,stoptime from satfiles where starttime = ?', [starttime])
 
-        result = c.execute(query)
         r = result.fetchone()
         return [r[0],r[1]]
 
+    @synchronized
     def get_ancfiles(self, filename, atteph=False, starttime=None):
         """
         Return the ancillary files associated with a given input file
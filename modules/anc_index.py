@@ -0,0 +1,154 @@
+"""
+A persistent index of the files in the local ancillary repository
+($OCVARROOT/anc/YYYY/DDD), so that getanc can check which files it already
+has without a stat for each one (each a round trip on an NFS mounted tree).
+
+The names in each directory are stored along with the directory's
+modification time.  A directory is only listed again when its modification
+time has changed, i.e. when files have been added, removed or renamed in it,
+and the modification time is only checked once per REFRESH_SECONDS in a
+process.  A name not in the index is still looked for on disk, so an out of
+date index costs a stat, never a missed file.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_INDEX_NAME = 'anc_index.db'
+
+REFRESH_SECONDS = 60
+
+# A directory modified this recently may still be changing within the
+# resolution of its modification time, so its listing is not trusted beyond
+# the current process.
+SETTLE_SECONDS = 2
+
+_indexes_lock = threading.Lock()
+_indexes = {}
+
+def get_index(dbfile):
+    """
+    Returns the AncIndex for dbfile, shared by everything in this process, or
+    None if the index cannot be opened.
+    """
+    with _indexes_lock:
+        if dbfile not in _indexes:
+            try:
+                _indexes[dbfile] = AncIndex(dbfile)
+            except sqlite3.Error:
+                _indexes[dbfile] = None
+        return _indexes[dbfile]
+
+class AncIndex(object):
+    """
+    SQLite backed index of the names of the files in each ancillary
+    directory.  Errors from the database are not fatal; the directory is
+    then just listed.
+    """
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(dbfile, timeout=30,
+                                    check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS dirs
+            (path TEXT PRIMARY KEY,
+            mtime REAL)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS files
+            (dir TEXT,
+            name TEXT,
+            PRIMARY KEY (dir, name))''')
+        self.conn.commit()
+        # dir path: (time checked, set of names), for this process
+        self.checked = {}
+
+    def _stored_listing(self, dir_path, mtime):
+        """
+        Returns the stored names for dir_path if they were listed at mtime,
+        otherwise None.
+        """
+        try:
+            row = self.conn.execute('SELECT mtime FROM dirs WHERE path = ?',
+                                    [dir_path]).fetchone()
+            if row is None or row[0] != mtime:
+                return None
+            return set(name for (name,) in self.conn.execute(
+                'SELECT name FROM files WHERE dir = ?', [dir_path]))
+        except sqlite3.Error:
+            return None
+
+    def _store_listing(self, dir_path, mtime, names):
+        """
+        Replaces the stored names for dir_path.
+        """
+        try:
+            with self.conn:
+                self.conn.execute('DELETE FROM files WHERE dir = ?',
+                                  [dir_path])
+                self.conn.executemany('INSERT INTO files VALUES (?, ?)',
+                                      [(dir_path, name) for name in names])
+                self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                                  [dir_path, mtime])
+        except sqlite3.Error:
+            # A read-only or locked index just means listing again later.
+            pass
+
+    def list_dir(self, dir_path):
+        """
+        Returns the set of names in dir_path (empty if it does not exist).
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.checked.get(dir_path)
+            if entry is not None and now - entry[0] < REFRESH_SECONDS:
+                return entry[1]
+            try:
+                mtime = os.stat(dir_path).st_mtime
+            except OSError:
+                names = set()
+            else:
+                names = self._stored_listing(dir_path, mtime)
+                if names is None:
+                    try:
+                        names = set(os.listdir(dir_path))
+                    except OSError:
+                        names = set()
+                    if now - mtime > SETTLE_SECONDS:
+                        self._store_listing(dir_path, mtime, names)
+            self.checked[dir_path] = (now, names)
+            return names
+
+    def add(self, path):
+        """
+        Records that path now exists, e.g. once it has been downloaded.  The
+        stored listing of its directory is left to be refreshed, as writing
+        the file changed the directory's modification time.
+        """
+        dir_path, name = os.path.split(path)
+        with self.lock:
+            entry = self.checked.get(dir_path)
+            if entry is not None:
+                entry[1].add(name)
+
+    def exists(self, path):
+        """
+        Returns True if path exists, from the index if it is listed there,
+        otherwise from the filesystem.
+        """
+        dir_path, name = os.path.split(path)
+        if name in self.list_dir(dir_path):
+            return True
+        if os.path.exists(path):
+            self.add(path)
+            return True
+        return False
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
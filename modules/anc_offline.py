@@ -0,0 +1,236 @@
+"""
+Offline ancillary file resolution: chooses the MET, OZONE, SST, NO2 and ICE
+files for a granule from a local copy of the ancillary tree
+($OCVARROOT/anc/YYYY/DDD), without querying the OBPG server.
+
+The files in each day directory are indexed by parsing the time stamps in
+their names, in the same [NS]YYYYDDDHH form handled by getanc.yearday.  The
+names are taken from the persistent anc_index.AncIndex if one is given
+(which notices new files every anc_index.REFRESH_SECONDS), rather than
+listing each directory; otherwise a directory is listed again whenever its
+modification time changes, so a long running process (e.g. --watch) sees
+the files which arrive.  The status bits are those the server would return: a type's
+bit is set if its files are missing, incomplete (a gap in the bracketing
+files) or from a non-optimal source (e.g. a forecast or near real time file).
+"""
+
+import datetime
+import os
+import re
+import threading
+import time
+
+import modules.anc_index as anc_index
+
+# Bits of the status, as returned by the server
+STATUS_BITS = {'met': 1, 'ozone': 2, 'sst': 4, 'no2': 8, 'ice': 16}
+NO_FILES_STATUS = 31
+
+# opt_flag bits turning on the optional types
+OPTIONAL_TYPES = {'sst': 1, 'no2': 2, 'ice': 4}
+
+# type: (interval between files in hours, days to search back for the most
+# recent file of a single file type)
+ANC_TYPES = {
+    'met': (6, 1),
+    'ozone': (24, 1),
+    'sst': (24, 8),
+    'no2': (24, 31),
+    'ice': (24, 8)
+}
+
+FILE_PATTERNS = [
+    re.compile(r'^[NS](?P<yyyyddd>\d{7})(?P<hour>\d{2})?_'
+               r'(?P<kind>MET|O3|SST|SEAICE|NO2)_(?P<source>[A-Za-z0-9]+)'
+               r'(?P<rest>.*)$'),
+    # older names, e.g. S199800106_NCEP.MET, S19980010000_TOAST.OZONE
+    re.compile(r'^S(?P<yyyyddd>\d{7})(?P<hour>\d{2})\d*_'
+               r'(?P<source>[A-Za-z0-9]+)\.(?P<kind>MET|OZONE)(?P<rest>)$')
+]
+KIND_TYPES = {'MET': 'met', 'O3': 'ozone', 'OZONE': 'ozone', 'SST': 'sst',
+              'NO2': 'no2', 'SEAICE': 'ice'}
+NONOPTIMAL_SOURCES = ['TOAST']
+NONOPTIMAL_MARKERS = re.compile(r'(_f\d{3}|NRT|FCST|forecast)', re.IGNORECASE)
+
+_index_lock = threading.Lock()
+# (ancdir, YYYY, DDD): (directory modification time, entries)
+_day_index = {}
+
+class AncEntry(object):
+    """
+    An ancillary file found in the local tree.
+    """
+    def __init__(self, name, anc_type, time, optimal):
+        self.name = name
+        self.anc_type = anc_type
+        self.time = time
+        self.optimal = optimal
+
+    def __repr__(self):
+        return 'AncEntry({0})'.format(self.name)
+
+def parse_anc_name(name):
+    """
+    Returns an AncEntry for the file name if it is a recognized ancillary
+    file, otherwise None.
+    """
+    for pattern in FILE_PATTERNS:
+        match = pattern.match(name)
+        if match:
+            break
+    else:
+        return None
+    try:
+        file_time = datetime.datetime.strptime(match.group('yyyyddd'),
+                                               '%Y%j')
+    except ValueError:
+        return None
+    if match.group('hour'):
+        file_time += datetime.timedelta(hours=int(match.group('hour')))
+    optimal = match.group('source') not in NONOPTIMAL_SOURCES and \
+              not NONOPTIMAL_MARKERS.search(match.group('rest'))
+    return AncEntry(name, KIND_TYPES[match.group('kind')], file_time, optimal)
+
+def get_day_entries(ancdir, day, index=None):
+    """
+    Returns the AncEntry objects for the files in the directory of day (a
+    date) under ancdir.  Without an index, a directory is only read again
+    once its modification time has changed.
+    """
+    key = (ancdir, day.strftime('%Y'), day.strftime('%j'))
+    day_dir = os.path.join(*key)
+    if index is not None:
+        return parse_names(index.list_dir(day_dir))
+    try:
+        mtime = os.stat(day_dir).st_mtime
+    except OSError:
+        return []
+    with _index_lock:
+        cached = _day_index.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    try:
+        entries = parse_names(os.listdir(day_dir))
+    except OSError:
+        return []
+    # A directory modified this recently may change again without its time
+    # changing, so it is listed again next time.
+    if time.time() - mtime > anc_index.SETTLE_SECONDS:
+        with _index_lock:
+            _day_index[key] = (mtime, entries)
+    return entries
+
+def parse_names(names):
+    """
+    Returns the AncEntry objects for the recognized ancillary files among
+    names.
+    """
+    entries = []
+    for name in names:
+        entry = parse_anc_name(name)
+        if entry is not None:
+            entries.append(entry)
+    return entries
+
+def get_entries(ancdir, anc_type, first_day, last_day, index=None):
+    """
+    Returns the entries of anc_type from first_day through last_day, sorted
+    by time with the optimal file first where there are several for a time.
+    """
+    entries = []
+    day = first_day
+    while day <= last_day:
+        entries.extend(entry for entry in get_day_entries(ancdir, day, index)
+                       if entry.anc_type == anc_type)
+        day += datetime.timedelta(days=1)
+    entries.sort(key=lambda entry: (entry.time, not entry.optimal))
+    unique = []
+    for entry in entries:
+        if not unique or unique[-1].time != entry.time:
+            unique.append(entry)
+    return unique
+
+def choose_bracketing(entries, start, stop, interval):
+    """
+    Returns the three files (before the start, after the start and after the
+    stop) bracketing the granule, or None for each that is not available,
+    and whether the choice is optimal.
+    """
+    before = [entry for entry in entries if entry.time <= start]
+    after = [entry for entry in entries if entry.time > start]
+    first = before[-1] if before else None
+    second = after[0] if after else None
+    after_stop = [entry for entry in entries if entry.time >= stop]
+    third = after_stop[0] if after_stop else None
+    if second is not None and (third is None or third.time < second.time):
+        third = second
+    optimal = first is not None and second is not None and \
+              third is not None and \
+              second.time - first.time == interval and \
+              all(entry.optimal for entry in [first, second, third])
+    if first is None:
+        first = second
+    if second is None:
+        second = first
+    if third is None:
+        third = second
+    return [first, second, third], optimal
+
+def choose_recent(entries, start, interval):
+    """
+    Returns the most recent file at or before start, and whether it is the
+    optimal one (covering start).
+    """
+    before = [entry for entry in entries if entry.time <= start]
+    if not before:
+        return None, False
+    entry = before[-1]
+    return entry, entry.optimal and start - entry.time < interval
+
+def parse_time(time_str):
+    """
+    Converts a YYYYDDDHHMMSS time to a datetime.
+    """
+    return datetime.datetime.strptime(time_str[0:13], '%Y%j%H%M%S')
+
+def resolve_local(ancdir, start, stop=None, opt_flag=5, index=None):
+    """
+    Returns a dictionary of the l2gen ancillary file parameters (met1, ...,
+    sstfile, ...) naming the files chosen from the tree under ancdir for a
+    granule from start to stop (YYYYDDDHHMMSS), and the status bits.  The
+    directories are read through index (an anc_index.AncIndex) if given.
+    """
+    start_time = parse_time(start)
+    stop_time = parse_time(stop) if stop else start_time
+    files = {}
+    status = 0
+    for anc_type in ['met', 'ozone']:
+        interval = datetime.timedelta(hours=ANC_TYPES[anc_type][0])
+        entries = get_entries(ancdir, anc_type,
+                              start_time - datetime.timedelta(days=1),
+                              stop_time + datetime.timedelta(days=1), index)
+        chosen, optimal = choose_bracketing(entries, start_time, stop_time,
+                                            interval)
+        if chosen[0] is None:
+            status |= STATUS_BITS[anc_type]
+            continue
+        if not optimal:
+            status |= STATUS_BITS[anc_type]
+        for num, entry in enumerate(chosen):
+            files['{0}{1}'.format(anc_type, num + 1)] = entry.name
+    for anc_type in ['sst', 'no2', 'ice']:
+        if not opt_flag & OPTIONAL_TYPES[anc_type]:
+            continue
+        interval = datetime.timedelta(hours=ANC_TYPES[anc_type][0])
+        entries = get_entries(
+            ancdir, anc_type,
+            start_time - datetime.timedelta(days=ANC_TYPES[anc_type][1]),
+            start_time, index)
+        entry, optimal = choose_recent(entries, start_time, interval)
+        if entry is None or not optimal:
+            status |= STATUS_BITS[anc_type]
+        if entry is not None:
+            files[anc_type + 'file'] = entry.name
+    if not files:
+        status = NO_FILES_STATUS
+    return files, status
@@ -0,0 +1,131 @@
+"""
+An on-disk cache of the responses to the OBPG ancillary file queries
+(/api/anc/... and /api/atteph/...) made by getanc.findweb.
+
+Responses are keyed on the query type, mission, exact start and stop times
+and option flag: the files the server picks depend on where a granule falls
+in each file's interval, so two queries are only answered alike when their
+times are identical.  Optimal answers (status 0) are kept for a long time;
+non-optimal answers expire quickly, so that near real time reruns pick up
+the optimal files once they become available.
+"""
+
+import sqlite3
+import time
+
+DEFAULT_CACHE_NAME = 'anc_query_cache.db'
+
+OPTIMAL_TTL = 30 * 86400        # seconds
+NONOPTIMAL_TTL = 3600           # seconds
+
+
+class AncQueryCache:
+    """
+    SQLite backed store of ancillary query responses.
+    """
+    def __init__(self, dbfile, optimal_ttl=OPTIMAL_TTL,
+                 nonoptimal_ttl=NONOPTIMAL_TTL):
+        self.dbfile = dbfile
+        self.optimal_ttl = optimal_ttl
+        self.nonoptimal_ttl = nonoptimal_ttl
+        self.conn = sqlite3.connect(dbfile, timeout=30)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS responses
+            (anctype TEXT,
+            mission TEXT,
+            start TEXT,
+            stop TEXT,
+            opt_flag TEXT,
+            status INTEGER,
+            response TEXT,
+            created REAL,
+            expires REAL,
+            PRIMARY KEY (anctype, mission, start, stop, opt_flag))''')
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(anctype, mission, start, stop, opt_flag):
+        """
+        Returns the key under which a query's response is stored.
+        """
+        return (str(anctype), str(mission).lower(), str(start), str(stop),
+                str(opt_flag))
+
+    def get(self, key):
+        """
+        Returns the cached response text for key, or None if there is no
+        unexpired entry.
+        """
+        row = self.conn.execute('''SELECT response FROM responses
+            WHERE anctype = ? AND mission = ? AND start = ? AND stop = ?
+            AND opt_flag = ? AND expires > ?''',
+                                list(key) + [time.time()]).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put(self, key, response, status):
+        """
+        Stores the response text for key, with a lifetime set by status.
+        """
+        now = time.time()
+        if status == 0:
+            expires = now + self.optimal_ttl
+        else:
+            expires = now + self.nonoptimal_ttl
+        try:
+            self.conn.execute('''INSERT OR REPLACE INTO responses
+                VALUES (?,?,?,?,?,?,?,?,?)''',
+                              list(key) + [status, response, now, expires])
+            self.conn.commit()
+        except sqlite3.Error:
+            # A read-only or locked cache just means the query is repeated.
+            self.conn.rollback()
+
+    def list_entries(self):
+        """
+        Returns (anctype, mission, start, stop, opt_flag, status, created,
+        expires) for each entry.
+        """
+        return self.conn.execute('''SELECT anctype, mission, start, stop,
+            opt_flag, status, created, expires FROM responses
+            ORDER BY start, anctype, mission''').fetchall()
+
+    def purge(self, expired_only=False):
+        """
+        Removes all entries (or only the expired ones), returning the number
+        removed.
+        """
+        if expired_only:
+            cur = self.conn.execute('DELETE FROM responses WHERE expires <= ?',
+                                    [time.time()])
+        else:
+            cur = self.conn.execute('DELETE FROM responses')
+        self.conn.commit()
+        return cur.rowcount
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+def print_entries(cache):
+    """
+    Prints a table of the entries in cache.
+    """
+    now = time.time()
+    print('{0:<7} {1:<8} {2:<13} {3:<13} {4:<4} {5:>6}  {6}'.format(
+        'type', 'mission', 'start', 'stop', 'opt', 'status', 'expires'))
+    for entry in cache.list_entries():
+        if entry[7] <= now:
+            expiry = 'expired'
+        else:
+            expiry = time.strftime('%Y-%m-%d %H:%M:%S',
+                                   time.localtime(entry[7]))
+        print('{0:<7} {1:<8} {2:<13} {3:<13} {4:<4} {5:>6}  {6}'.format(
+            entry[0], entry[1], entry[2], entry[3], entry[4], entry[5],
+            expiry))
+
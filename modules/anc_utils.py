@@ -1,14 +1,20 @@
 
 
 import gc
+import sqlite3
 import xml.etree.ElementTree as ElementTree
 from operator import sub
 from collections import OrderedDict
 
+import modules.anc_index as anc_index
+import modules.anc_offline as anc_offline
+import modules.anc_query_cache as anc_query_cache
+import modules.http_cache as http_cache
 import modules.MetaUtils as MetaUtils
 import modules.ProcUtils as ProcUtils
 
 DEFAULT_ANC_DIR_TEXT = "$OCVARROOT"
+DEFAULT_DOWNLOAD_WORKERS = 4
 
 
 class getanc:
@@ -29,7 +35,12 @@ class getanc:
                  printlist=True,
                  download=True,
                  timeout=10,
-                 refreshDB=False):
+                 refreshDB=False,
+                 download_workers=DEFAULT_DOWNLOAD_WORKERS,
+                 shared_db=True,
+                 query_cache=True,
+                 offline=False,
+                 use_index=True):
         self.file = file
         self.start = start
         self.stop = stop
@@ -46,6 +57,14 @@ class getanc:
         self.printlist = printlist
         self.verbose = verbose
         self.timeout = timeout
+        self.download_workers = download_workers
+        self.shared_db = shared_db
+        self.query_cache = query_cache
+        self.offline = offline
+        self.use_index = use_index
+        if self.offline:
+            # everything must already be in the local tree
+            self.dl = False
         self.server_status = None
         self.db_status = None
         self.proctype = None
@@ -340,14 +359,15 @@ Using current working directory for storing the ancillary database file: %s''' %
         if self.atteph:
             anctype = 'atteph'
 
-        ancdatabase = db.ancDB(dbfile=self.ancdb)
+        ancdatabase = db.ancDB(dbfile=self.ancdb, shared=self.shared_db)
         if not os.path.getsize(self.ancdb):
             if self.verbose:
                 print("Creating database: %s " % self.ancdb)
             ancdatabase.openDB()
             ancdatabase.create_db()
         else:
-            ancdatabase.openDB()
+            # only lookups are needed unless the records are to be refreshed
+            ancdatabase.openDB(readonly=not self.refreshDB)
             if self.verbose:
                 print("Searching database: %s " % self.ancdb)
 
@@ -367,7 +387,7 @@ Using current working directory for storing the ancillary database file: %s''' %
             else:
                 ancdatabase.delete_record(filekey, starttime=self.start)
 
-            ancdatabase.closeDB()
+        ancdatabase.closeDB()
 
         if status and self.db_status:
             if not self.refreshDB:
@@ -384,9 +404,58 @@ Using current working directory for storing the ancillary database file: %s''' %
         """
         Execute the display_ancillary_files search and populate the locate cache database
         """
+        self.query_server()
+        self.record_files()
+
+    def findlocal(self):
+        """
+        Choose the ancillary files from the local ancillary tree, without
+        querying the server (offline mode)
+        """
+        import sys
+
+        if self.atteph or self.sensor == 'aquarius':
+            print("ERROR: Offline mode only supports MET, OZONE, SST, NO2 and ICE files.")
+            sys.exit(99)
+        if self.curdir:
+            print("ERROR: Offline mode needs the YYYY/DDD ancillary directory tree (no --curdir).")
+            sys.exit(99)
+        ancdir = self.dirs['anc']
+        self.files, self.db_status = anc_offline.resolve_local(ancdir, self.start, self.stop,
+                                                               self.opt_flag, self.get_anc_index())
+        if self.verbose:
+            print("Resolved ancillary files offline from %s" % ancdir)
+
+        if self.db_status == anc_offline.NO_FILES_STATUS:
+            ProcUtils.remove(self.anc_file)
+            print("No ancillary files exist in %s that correspond to the start time %s" %
+                  (ancdir, self.start))
+            print("No parameter file created (l2gen defaults to the climatologies).")
+            sys.exit(31)
+
+    def query_key(self):
+        """
+        Returns the parameters which determine the result of the server query
+        (type, mission, options and the exact start and stop), so granules
+        with the same key can share one query; the files the server picks
+        depend on where the times fall in each file's interval, so granules
+        with other times get a query of their own
+        """
+        anctype = 'anc'
+        opt_flag = self.opt_flag
+        if self.atteph:
+            anctype = 'atteph'
+            opt_flag = ''
+        if self.sensor == 'aquarius':
+            opt_flag = ''
+        return (anctype, str(self.sensor).lower(), opt_flag, self.start, self.stop)
+
+    def query_server(self):
+        """
+        Query the OBPG server for the ancillary file list, setting files and db_status
+        """
         import os
         import sys
-        import modules.ancDB as db
         import json
 
         #        import modules.ancDBmysql as db
@@ -412,12 +481,38 @@ Using current working directory for storing the ancillary database file: %s''' %
         if str(self.sensor).lower() in msn:
             msnchar = msn[str(self.sensor).lower()]
 
-        if self.stop is None:
+        # Identical queries made recently are answered from the query cache
+        cache = None
+        response = None
+        if self.query_cache:
+            try:
+                cache = anc_query_cache.AncQueryCache(self.query_cache_file())
+                cache_key = cache.make_key(anctype, msnchar, self.start, self.stop, opt_flag)
+                if not self.refreshDB:
+                    response = cache.get(cache_key)
+            except sqlite3.Error:
+                cache = None
+
+        # The HTTP cache revalidates the server's answer (and supplies it with
+        # --stale-if-error); it is bypassed along with the query cache, so a
+        # refresh always gets a new answer.
+        response_cache = None
+        if self.query_cache and not self.refreshDB:
+            response_cache = http_cache.get_default_cache()
+
+        if response is not None:
+            if self.verbose:
+                print("Using cached ancillary file list")
+            with open(self.server_file, 'w') as data_file:
+                data_file.write(response)
+            dlstat = 0
+        elif self.stop is None:
             dlstat = ProcUtils.httpdl(self.query_site, '/'.join(['/api', anctype, msnchar, self.start, '', opt_flag]),
                                       os.path.abspath(os.path.dirname(self.server_file)),
                                       outputfilename=self.server_file,
                                       timeout=self.timeout,
-                                      verbose=self.verbose
+                                      verbose=self.verbose,
+                                      http_cache=response_cache
                                       )
         else:
             dlstat = ProcUtils.httpdl(self.query_site,
@@ -425,7 +520,8 @@ Using current working directory for storing the ancillary database file: %s''' %
                                       os.path.abspath(os.path.dirname(self.server_file)),
                                       outputfilename=self.server_file,
                                       timeout=self.timeout,
-                                      verbose=self.verbose
+                                      verbose=self.verbose,
+                                      http_cache=response_cache
                                       )
         gc.collect()
 
@@ -485,7 +581,61 @@ Using current working directory for storing the ancillary database file: %s''' %
                 print("ERROR: display_ancillary_files.cgi script returned blank entry for %s. Exiting." % f)
                 sys.exit(99)
 
-        ancdatabase = db.ancDB(dbfile=self.ancdb)
+        if cache:
+            if response is None:
+                with open(self.server_file, 'r') as data_file:
+                    cache.put(cache_key, data_file.read(), self.db_status)
+            cache.close()
+
+    def state_file(self, name):
+        """
+        Return the path of the named file kept with the ancillary database
+        """
+        import os
+
+        logdir = os.path.dirname(self.ancdb)
+        if not logdir:
+            logdir = self.dirs['log']
+            if not os.path.exists(logdir):
+                logdir = self.dirs['run']
+        return os.path.join(logdir, name)
+
+    def query_cache_file(self):
+        """
+        Return the path of the query cache, kept with the ancillary database
+        """
+        return self.state_file(anc_query_cache.DEFAULT_CACHE_NAME)
+
+    def get_anc_index(self):
+        """
+        Return the index of the local ancillary tree, or None if it is not
+        used (or cannot be opened)
+        """
+        if not self.use_index or self.curdir:
+            return None
+        return anc_index.get_index(self.state_file(anc_index.DEFAULT_INDEX_NAME))
+
+    def anc_exists(self, path):
+        """
+        Check whether an ancillary file exists, using the index of the local
+        ancillary tree where possible rather than a stat of the file
+        """
+        import os
+
+        index = self.get_anc_index()
+        if index is None:
+            return os.path.exists(path)
+        return index.exists(path)
+
+    def record_files(self):
+        """
+        Store the files found by query_server in the local database and drop
+        the missing entries
+        """
+        import os
+        import modules.ancDB as db
+
+        ancdatabase = db.ancDB(dbfile=self.ancdb, shared=self.shared_db)
 
         if not os.path.exists(ancdatabase.dbfile) or os.path.getsize(ancdatabase.dbfile) == 0:
             ancdatabase.openDB()
@@ -495,23 +645,25 @@ Using current working directory for storing the ancillary database file: %s''' %
 
         missing = []
 
-        for anctype in self.files:
-            if self.files[anctype] == 'missing':
-                missing.append(anctype)
-                continue
-            if (self.file and self.dl) or (self.start and self.dl):
-                path = self.dirs['anc']
-                if not self.curdir:
-                    year, day = self.yearday(self.files[anctype])
-                    path = os.path.join(path, year, day)
-
-                if self.file:
-                    filekey = os.path.basename(self.file)
-                else:
-                    filekey = None
-                ancdatabase.insert_record(satfile=filekey, starttime=self.start, stoptime=self.stop, anctype=anctype,
-                                          ancfile=self.files[anctype], ancpath=path, dbstat=self.db_status,
-                                          atteph=self.atteph)
+        # one transaction for all of the granule's records
+        with ancdatabase:
+            for anctype in self.files:
+                if self.files[anctype] == 'missing':
+                    missing.append(anctype)
+                    continue
+                if (self.file and self.dl) or (self.start and self.dl):
+                    path = self.dirs['anc']
+                    if not self.curdir:
+                        year, day = self.yearday(self.files[anctype])
+                        path = os.path.join(path, year, day)
+
+                    if self.file:
+                        filekey = os.path.basename(self.file)
+                    else:
+                        filekey = None
+                    ancdatabase.insert_record(satfile=filekey, starttime=self.start, stoptime=self.stop,
+                                              anctype=anctype, ancfile=self.files[anctype], ancpath=path,
+                                              dbstat=self.db_status, atteph=self.atteph, commit=False)
 
         ancdatabase.closeDB()
         # remove missing items
@@ -560,6 +712,7 @@ Using current working directory for storing the ancillary database file: %s''' %
         import os
         import re
         import sys
+        import concurrent.futures
 
         FILES = []
         for f in (list(self.files.keys())):
@@ -572,6 +725,8 @@ Using current working directory for storing the ancillary database file: %s''' %
             FILES.append(os.path.basename(self.files[f]))
 
         dl_msg = 1
+        paths = OrderedDict()
+        downloads = []
 
         for FILE in list(OrderedDict.fromkeys(FILES)):
             year, day = self.yearday(FILE)
@@ -590,12 +745,13 @@ Using current working directory for storing the ancillary database file: %s''' %
                 ancdir = self.dirs['anc']
 
                 self.dirs['path'] = os.path.join(ancdir, year, day)
-                if os.path.exists(os.path.join(ancdir, year, day, FILE)) and forcedl is False:
+                if forcedl is False and self.anc_exists(os.path.join(ancdir, year, day, FILE)):
                     download = 0
                     if self.verbose:
                         print("  Found: %s/%s" % (self.dirs['path'], FILE))
                 else:
                     download = 1
+            paths[FILE] = self.dirs['path']
 
             # Not on hard disk, download the file
 
@@ -608,33 +764,45 @@ Using current working directory for storing the ancillary database file: %s''' %
                     if self.verbose:
                         print("  " + FILE)
                 else:
-
                     if self.verbose:
                         print("Downloading '" + FILE + "' to " + self.dirs['path'])
-                    status = ProcUtils.httpdl(self.data_site, ''.join(['/ob/getfile/', FILE]),
-                            self.dirs['path'], timeout=self.timeout, uncompress=True,
-                            verbose=self.verbose)
-                    gc.collect()
-                    if status:
-                        if status == 401:
-                            print("*** ERROR: Authentication Failue retrieving:")
-                            print("*** " + '/'.join([self.data_site, 'ob/getfile', FILE]))
-                            print("*** Please check that your ~/.netrc file is setup correctly and has proper permissions.")
-                            print("***")
-                            print("*** see: https://oceancolor.gsfc.nasa.gov/data/download_methods/")
-                            print("***\n")
-                        else:
-                            print("*** ERROR: The HTTP transfer failed with status code " + str(status) + ".")
-                            print("*** Please check your network connection and for the existence of the remote file:")
-                            print("*** " + '/'.join([self.data_site, 'ob/getfile', FILE]))
-                            print("***")
-                            print("*** Also check to make sure you have write permissions under the directory:")
-                            print("*** " + self.dirs['path'])
-                            print()
-                        ProcUtils.remove(os.path.join(self.dirs['path'], FILE))
-                        ProcUtils.remove(self.server_file)
-                        sys.exit(1)
+                    downloads.append(FILE)
+
+        if downloads:
+            # Start the shared session here, so the worker threads reuse it
+            # rather than racing to create their own.
+            ProcUtils.getSession(verbose=self.verbose)
+            workers = max(1, min(self.download_workers, len(downloads)))
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                statuses = list(pool.map(lambda FILE: self._download(FILE, paths[FILE]),
+                                         downloads))
+            gc.collect()
+
+            failed = False
+            for FILE, status in zip(downloads, statuses):
+                if not status:
+                    continue
+                failed = True
+                if status == 401:
+                    print("*** ERROR: Authentication Failue retrieving:")
+                    print("*** " + '/'.join([self.data_site, 'ob/getfile', FILE]))
+                    print("*** Please check that your ~/.netrc file is setup correctly and has proper permissions.")
+                    print("***")
+                    print("*** see: https://oceancolor.gsfc.nasa.gov/data/download_methods/")
+                    print("***\n")
+                else:
+                    print("*** ERROR: The HTTP transfer failed with status code " + str(status) + ".")
+                    print("*** Please check your network connection and for the existence of the remote file:")
+                    print("*** " + '/'.join([self.data_site, 'ob/getfile', FILE]))
+                    print("***")
+                    print("*** Also check to make sure you have write permissions under the directory:")
+                    print("*** " + paths[FILE])
+                    print()
+            if failed:
+                ProcUtils.remove(self.server_file)
+                sys.exit(1)
 
+        for FILE in paths:
             for f in (list(self.files.keys())):
                 if self.atteph:
                     if re.search('met|ozone|file', f):
@@ -643,7 +811,48 @@ Using current working directory for storing the ancillary database file: %s''' %
                     if re.search('att|eph', f):
                         continue
                 if FILE == self.files[f]:
-                    self.files[f] = os.path.join(self.dirs['path'], FILE)
+                    self.files[f] = os.path.join(paths[FILE], FILE)
+
+    def _download(self, FILE, path):
+        """
+        Download FILE into path.  The transfer (and any decompression) is done
+        in a temporary directory alongside the destination, and the result is
+        only renamed into place once complete, so an interrupted or failed
+        download never leaves a partial file in the ancillary tree.
+        Returns the httpdl status.
+        """
+        import os
+        import shutil
+        import tempfile
+
+        if not os.path.exists(path):
+            os.umask(0o02)
+            try:
+                os.makedirs(path, mode=0o2775)
+            except OSError:
+                if not os.path.isdir(path):
+                    return 1
+        try:
+            tmpdir = tempfile.mkdtemp(prefix='.getanc_', dir=path)
+        except OSError:
+            return 1
+        try:
+            try:
+                status = ProcUtils.httpdl(self.data_site, ''.join(['/ob/getfile/', FILE]),
+                                          tmpdir, timeout=self.timeout, uncompress=True,
+                                          verbose=self.verbose)
+            except Exception as e:
+                print("*** ERROR: Exception retrieving %s: %s" % (FILE, e))
+                status = 1
+            if not status:
+                index = self.get_anc_index()
+                for dlfile in os.listdir(tmpdir):
+                    os.rename(os.path.join(tmpdir, dlfile), os.path.join(path, dlfile))
+                    if index is not None:
+                        index.add(os.path.join(path, dlfile))
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        return status
 
     def write_anc_par(self):
         """
@@ -772,3 +981,136 @@ Using current working directory for storing the ancillary database file: %s''' %
                 self.db_status = sub(self.db_status, 8)
             if self.db_status & 16 and self.opt_flag & 4:
                 self.db_status = sub(self.db_status, 16)
+
+
+def _exit_status(sys_exit):
+    """
+    Convert a SystemExit raised while processing a granule to a status code
+    """
+    if sys_exit.code is None:
+        return 0
+    if isinstance(sys_exit.code, int):
+        return sys_exit.code
+    print(sys_exit.code)
+    return 1
+
+
+def resolve(g, forcedl=False):
+    """
+    Resolve the ancillary files for the single granule set up in the getanc
+    object g, as getanc.py does, and write its .anc file.
+
+    Returns the db_status, or the status the run would have exited with if
+    an error was encountered.
+    """
+    from modules.setupenv import env
+
+    try:
+        env(g)
+        g.chk()
+        if (g.file and g.finddb()) or (g.start and g.finddb()):
+            g.setup()
+        elif g.offline:
+            g.setup()
+            g.findlocal()
+        else:
+            g.setup()
+            g.findweb()
+        g.locate(forcedl=forcedl)
+        g.write_anc_par()
+        g.cleanup()
+    except SystemExit as e:
+        return _exit_status(e)
+    return g.db_status
+
+
+def resolve_many(granules, forcedl=False):
+    """
+    Resolve the ancillary files for many granules in one pass.
+
+    granules is a list of getanc objects, set up as they would be for a single
+    granule run.  Granules whose file lists are already in the local database
+    are not queried, granules with identical queries (same type, mission,
+    options and exact start and stop; see getanc.query_key) share a single
+    server query, and each ancillary file
+    needed by any of the granules is downloaded only once.  The .anc files
+    are then written for every granule.
+
+    Returns a list holding the exit status of each granule: the db_status if
+    it was resolved, or the status it would have exited with otherwise.
+    """
+    import os
+    from modules.setupenv import env
+
+    statuses = [None] * len(granules)
+
+    # Check the local database and set up each granule
+    queries = OrderedDict()
+    for ndx, g in enumerate(granules):
+        try:
+            env(g)
+            g.chk()
+            found = g.finddb()
+            g.setup()
+            if not found:
+                if g.offline:
+                    g.findlocal()
+                else:
+                    queries.setdefault(g.query_key(), []).append(ndx)
+        except SystemExit as e:
+            statuses[ndx] = _exit_status(e)
+
+    # One server query per distinct query key
+    for key, members in queries.items():
+        leader = granules[members[0]]
+        try:
+            leader.query_server()
+        except SystemExit as e:
+            for ndx in members:
+                statuses[ndx] = _exit_status(e)
+            continue
+        found_files = dict(leader.files)
+        for ndx in members:
+            g = granules[ndx]
+            try:
+                if g is not leader:
+                    g.files = dict(found_files)
+                    g.db_status = leader.db_status
+                g.record_files()
+            except SystemExit as e:
+                statuses[ndx] = _exit_status(e)
+
+    # Download the union of the needed files, grouped by destination tree
+    groups = OrderedDict()
+    for ndx, g in enumerate(granules):
+        if statuses[ndx] is None and g.dl:
+            groups.setdefault((g.atteph, g.curdir, g.dirs.get('anc')), []).append(g)
+    for members in groups.values():
+        first = members[0]
+        bulk = getanc(ancdir=first.ancdir, curdir=first.curdir, atteph=first.atteph,
+                      verbose=first.verbose, timeout=first.timeout,
+                      download_workers=first.download_workers,
+                      use_index=first.use_index)
+        bulk.dirs = first.dirs
+        bulk.server_file = ''
+        for gnum, g in enumerate(members):
+            for anckey in g.files:
+                bulk.files['_'.join([anckey, str(gnum)])] = os.path.basename(g.files[anckey])
+        try:
+            bulk.locate(forcedl=forcedl)
+        except SystemExit:
+            # the failure is reported again for each granule needing the file
+            pass
+
+    # Point each granule at its files and write the .anc files
+    for ndx, g in enumerate(granules):
+        if statuses[ndx] is not None:
+            continue
+        try:
+            g.locate(forcedl=(forcedl and not g.dl))
+            g.write_anc_par()
+            g.cleanup()
+            statuses[ndx] = g.db_status
+        except SystemExit as e:
+            statuses[ndx] = _exit_status(e)
+    return statuses
@@ -0,0 +1,172 @@
+"""
+A persistent SQLite cache of file typing results (the file type, instrument,
+start/end times and attributes found by ObpgFileTyper), keyed on the real
+path, size and modification time of each file.  A file which is modified or
+replaced gets a new size and/or mtime, so stale entries are never returned.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_NAME = 'file_type_cache.db'
+DEFAULT_MAX_ENTRIES = 100000
+
+_default_cache = None
+
+class FileTypeCache(object):
+    """
+    Stores and retrieves file typing results.  The least recently used
+    entries are removed when the cache holds more than max_entries files.
+    """
+    def __init__(self, dbfile, max_entries=DEFAULT_MAX_ENTRIES, refresh=False):
+        self.dbfile = dbfile
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(dbfile, timeout=30,
+                                    check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS filetypes
+            (path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            file_type TEXT,
+            instrument TEXT,
+            start_time TEXT,
+            end_time TEXT,
+            attributes TEXT,
+            last_used REAL)''')
+        self.conn.execute('''CREATE INDEX IF NOT EXISTS filetypes_last_used
+            ON filetypes (last_used)''')
+        self.conn.commit()
+
+    @staticmethod
+    def _file_key(path):
+        """
+        Returns the (real path, size, mtime) triplet identifying path.
+        """
+        real_path = os.path.realpath(path)
+        stat_info = os.stat(real_path)
+        return real_path, stat_info.st_size, stat_info.st_mtime
+
+    def get(self, path):
+        """
+        Returns a dictionary holding the stored file_type, instrument,
+        start_time, end_time and attributes for path, or None if path is
+        not in the cache (or refresh was requested).
+        """
+        if self.refresh:
+            return None
+        try:
+            real_path, size, mtime = self._file_key(path)
+        except OSError:
+            return None
+        with self.lock:
+            try:
+                row = self.conn.execute('''SELECT file_type, instrument,
+                    start_time, end_time, attributes FROM filetypes
+                    WHERE path = ? AND size = ? AND mtime = ?''',
+                                        [real_path, size, mtime]).fetchone()
+                if row is None:
+                    return None
+                self.conn.execute('''UPDATE filetypes SET last_used = ?
+                    WHERE path = ?''', [time.time(), real_path])
+                self.conn.commit()
+            except sqlite3.Error:
+                return None
+        attributes = None
+        if row[4] is not None:
+            attributes = json.loads(row[4])
+        return {'file_type': row[0], 'instrument': row[1],
+                'start_time': row[2], 'end_time': row[3],
+                'attributes': attributes}
+
+    def put(self, path, file_type, instrument, start_time=None,
+            end_time=None, attributes=None):
+        """
+        Stores the typing results for path, replacing any older entry.
+        """
+        try:
+            real_path, size, mtime = self._file_key(path)
+        except OSError:
+            return
+        attr_text = None
+        if attributes is not None:
+            try:
+                attr_text = json.dumps(attributes, default=str)
+            except (TypeError, ValueError):
+                attr_text = None
+        with self.lock:
+            try:
+                self.conn.execute('''INSERT OR REPLACE INTO filetypes
+                    VALUES (?,?,?,?,?,?,?,?,?)''',
+                                  [real_path, size, mtime, file_type,
+                                   instrument, start_time, end_time,
+                                   attr_text, time.time()])
+                self._evict()
+                self.conn.commit()
+            except sqlite3.Error:
+                # A cache which cannot be written to is not fatal; the
+                # file will simply be typed again next time.
+                self.conn.rollback()
+
+    def _evict(self):
+        """
+        Removes the least recently used entries beyond max_entries.
+        """
+        count = self.conn.execute('SELECT COUNT(*) FROM filetypes').\
+            fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute('''DELETE FROM filetypes WHERE path IN
+                (SELECT path FROM filetypes ORDER BY last_used LIMIT ?)''',
+                              [count - self.max_entries])
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        with self.lock:
+            self.conn.execute('DELETE FROM filetypes')
+            self.conn.commit()
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+def get_default_cache_path():
+    """
+    Returns the path of the cache database: $OCVARROOT/log if that exists,
+    otherwise $OCVARROOT.  None is returned if OCVARROOT is not set.
+    """
+    var_root = os.getenv('OCVARROOT')
+    if not var_root or not os.path.isdir(var_root):
+        return None
+    log_dir = os.path.join(var_root, 'log')
+    if os.path.isdir(log_dir):
+        return os.path.join(log_dir, DEFAULT_CACHE_NAME)
+    return os.path.join(var_root, DEFAULT_CACHE_NAME)
+
+def get_default_cache(refresh=False):
+    """
+    Returns the process-wide cache, opening it the first time it is needed.
+    None is returned if the cache database cannot be opened, in which case
+    files are simply typed without caching.
+    """
+    global _default_cache
+    if _default_cache is None:
+        cache_path = get_default_cache_path()
+        if cache_path is None:
+            return None
+        try:
+            _default_cache = FileTypeCache(cache_path, refresh=refresh)
+        except sqlite3.Error:
+            return None
+    elif refresh:
+        _default_cache.refresh = True
+    return _default_cache
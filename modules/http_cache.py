@@ -0,0 +1,447 @@
+"""
+An on-disk cache of HTTP responses (directory listings, ancillary API
+queries, CMR searches) which revalidates stored responses with conditional
+requests: a response with an ETag or Last-Modified header is stored, and the
+next request for the same URL sends If-None-Match/If-Modified-Since, so an
+unchanged response costs a small 304 rather than the whole body again.
+
+The bodies are kept as files in the cache directory, indexed by an SQLite
+database.  The least recently used responses are removed once the bodies
+take more than max_bytes.  With stale_if_error set, a stored response is
+returned (however old) when the server cannot be reached or fails with a 5xx
+status.  The cache is meant for small responses; data files are downloaded
+without it.  A response fetched with stream set is written to the cache as
+the caller reads it, so large listings can still be parsed as they arrive.
+
+The stored responses can be listed or removed with getanc's
+--list-http-cache and --purge-http-cache options, and the tools using the
+cache print its hit and miss counts when run verbosely.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_NAME = 'http_cache'
+DEFAULT_MAX_BYTES = 256 * 1048576
+
+# headers stored with a response, for the callers' checks
+KEPT_HEADERS = ['Content-Type', 'Content-Disposition', 'Content-Length',
+                'ETag', 'Last-Modified']
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+class CachedResponse(object):
+    """
+    A stored response, with the parts of the requests.Response interface
+    used by the callers.
+    """
+    def __init__(self, url, content, headers, stale=False):
+        self.url = url
+        self.status_code = 200
+        self.reason = 'OK (cached)'
+        self.content = content
+        self.headers = headers
+        self.encoding = None
+        self.stale = stale
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class StreamingResponse(object):
+    """
+    A new response fetched with stream set.  Its body is written to the
+    cache as the caller reads it (through iter_content, or content), and is
+    stored once it has all been read.  Everything else is the
+    requests.Response's.
+    """
+    def __init__(self, cache, url, response):
+        self._cache = cache
+        self._url = url
+        self._response = response
+        self._content = None
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def iter_content(self, chunk_size=1):
+        if self._content is not None:
+            for start in range(0, len(self._content), chunk_size):
+                yield self._content[start:start + chunk_size]
+            return
+        tmp_path = self._cache._tmp_path(self._url)
+        try:
+            body_file = open(tmp_path, 'wb')
+        except (IOError, OSError):
+            body_file = None
+        size = 0
+        try:
+            for chunk in self._response.iter_content(chunk_size):
+                if body_file is not None:
+                    size += len(chunk)
+                    if size > self._cache.max_bytes:
+                        # too big to keep
+                        body_file.close()
+                        body_file = None
+                        os.remove(tmp_path)
+                    else:
+                        body_file.write(chunk)
+                yield chunk
+        except BaseException:
+            if body_file is not None:
+                body_file.close()
+                os.remove(tmp_path)
+            raise
+        if body_file is not None:
+            body_file.close()
+            self._cache._index(self._url, self._response, tmp_path, size)
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b''.join(self.iter_content(65536))
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._response.close()
+
+class HttpCache(object):
+    """
+    Stores responses and revalidates them.  Errors from the cache itself are
+    not fatal; the request is then just made without it.
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES,
+                 stale_if_error=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stale_if_error = stale_if_error
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evicted': 0}
+        self.lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'index.db'),
+                                    timeout=30, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS responses
+            (url TEXT PRIMARY KEY,
+            body TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            headers TEXT,
+            size INTEGER,
+            stored REAL,
+            last_used REAL)''')
+        self.conn.execute('''CREATE INDEX IF NOT EXISTS responses_last_used
+            ON responses (last_used)''')
+        self.conn.commit()
+
+    def _body_path(self, body):
+        return os.path.join(self.cache_dir, body)
+
+    def _lookup(self, url):
+        """
+        Returns (etag, last_modified, headers, body path) stored for url, or
+        None.
+        """
+        with self.lock:
+            try:
+                row = self.conn.execute('''SELECT etag, last_modified,
+                    headers, body FROM responses WHERE url = ?''',
+                                        [url]).fetchone()
+            except sqlite3.Error:
+                return None
+        if row is None or not os.path.exists(self._body_path(row[3])):
+            return None
+        return row[0], row[1], json.loads(row[2]), self._body_path(row[3])
+
+    def _cached_response(self, url, entry, stale=False):
+        """
+        Returns the CachedResponse for the stored entry, marking it used.
+        """
+        try:
+            with open(entry[3], 'rb') as body_file:
+                content = body_file.read()
+        except (IOError, OSError):
+            return None
+        with self.lock:
+            try:
+                self.conn.execute('''UPDATE responses SET last_used = ?
+                    WHERE url = ?''', [time.time(), url])
+                self.conn.commit()
+            except sqlite3.Error:
+                pass
+            self.stats['stale' if stale else 'hits'] += 1
+        return CachedResponse(url, content, entry[2], stale)
+
+    def _cacheable(self, response):
+        """
+        Returns True if response can be revalidated later or may be needed
+        if the server fails.
+        """
+        return bool(response.headers.get('ETag') or
+                    response.headers.get('Last-Modified') or
+                    self.stale_if_error)
+
+    @staticmethod
+    def _body_name(url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def _tmp_path(self, url):
+        """
+        Returns the name of the file the body for url is written to before it
+        is stored.
+        """
+        return '{0}.{1}.{2}.tmp'.format(self._body_path(self._body_name(url)),
+                                        os.getpid(),
+                                        threading.current_thread().ident)
+
+    def _index(self, url, response, tmp_path, size):
+        """
+        Stores the body written to tmp_path as the response for url.
+        """
+        headers = dict((name, response.headers.get(name))
+                       for name in KEPT_HEADERS
+                       if response.headers.get(name) is not None)
+        body = self._body_name(url)
+        try:
+            os.rename(tmp_path, self._body_path(body))
+        except OSError:
+            return
+        now = time.time()
+        with self.lock:
+            try:
+                self.conn.execute('''INSERT OR REPLACE INTO responses
+                    VALUES (?,?,?,?,?,?,?,?)''',
+                                  [url, body, response.headers.get('ETag'),
+                                   response.headers.get('Last-Modified'),
+                                   json.dumps(headers), size, now, now])
+                self.conn.commit()
+                self._evict()
+            except sqlite3.Error:
+                self.conn.rollback()
+
+    def _store(self, url, response):
+        """
+        Stores response (a requests.Response) for url, if it can be
+        revalidated later or may be needed if the server fails.
+        """
+        if not self._cacheable(response):
+            return
+        content = response.content
+        if len(content) > self.max_bytes:
+            return
+        tmp_path = self._tmp_path(url)
+        try:
+            with open(tmp_path, 'wb') as body_file:
+                body_file.write(content)
+        except (IOError, OSError):
+            return
+        self._index(url, response, tmp_path, len(content))
+
+    def _evict(self):
+        """
+        Removes the least recently used responses until the stored bodies
+        take no more than max_bytes.  Called with the lock held.
+        """
+        total = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for url, body, size in self.conn.execute('''SELECT url, body, size
+            FROM responses ORDER BY last_used''').fetchall():
+            if total <= self.max_bytes:
+                break
+            self.conn.execute('DELETE FROM responses WHERE url = ?', [url])
+            try:
+                os.remove(self._body_path(body))
+            except OSError:
+                pass
+            total -= size
+            self.stats['evicted'] += 1
+        self.conn.commit()
+
+    def fetch(self, session, url, timeout=None, headers=None, stream=False):
+        """
+        GETs url with session (a requests.Session), revalidating any stored
+        response.  Returns a requests.Response for a new response (a
+        StreamingResponse if stream is set and it is to be stored), or a
+        CachedResponse when the stored one is still current (or is returned
+        after an error, with stale_if_error).
+        """
+        entry = self._lookup(url)
+        request_headers = dict(headers or {})
+        if entry is not None:
+            if entry[0]:
+                request_headers['If-None-Match'] = entry[0]
+            if entry[1]:
+                request_headers['If-Modified-Since'] = entry[1]
+        try:
+            response = session.get(url, timeout=timeout,
+                                   headers=request_headers, stream=stream)
+        except IOError:
+            # requests' exceptions are IOErrors
+            if self.stale_if_error and entry is not None:
+                cached = self._cached_response(url, entry, stale=True)
+                if cached is not None:
+                    return cached
+            raise
+
+        if entry is not None:
+            if response.status_code == 304:
+                response.close()
+                cached = self._cached_response(url, entry)
+                if cached is not None:
+                    return cached
+                # the body went missing; ask again for the whole response
+                return self.fetch(session, url, timeout, headers, stream)
+            if response.status_code >= 500 and self.stale_if_error:
+                cached = self._cached_response(url, entry, stale=True)
+                if cached is not None:
+                    response.close()
+                    return cached
+
+        with self.lock:
+            self.stats['misses'] += 1
+        if response.status_code == 200:
+            if stream:
+                if self._cacheable(response):
+                    return StreamingResponse(self, url, response)
+            else:
+                self._store(url, response)
+        return response
+
+    def get_stats(self):
+        """
+        Returns a dictionary of the hit, miss, stale and eviction counts.
+        """
+        with self.lock:
+            return dict(self.stats)
+
+    def list_entries(self):
+        """
+        Returns (url, size, stored, last_used) for each stored response,
+        most recently used first.
+        """
+        with self.lock:
+            return self.conn.execute('''SELECT url, size, stored, last_used
+                FROM responses ORDER BY last_used DESC''').fetchall()
+
+    def purge(self):
+        """
+        Removes all stored responses (and any bodies left by interrupted
+        writes), returning the number of responses removed.
+        """
+        with self.lock:
+            count = self.conn.execute('DELETE FROM responses').rowcount
+            self.conn.commit()
+            for name in os.listdir(self.cache_dir):
+                if not name.startswith('index.db'):
+                    try:
+                        os.remove(self._body_path(name))
+                    except OSError:
+                        pass
+        return count
+
+    def close(self):
+        """
+        Closes the index database connection.
+        """
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+def print_entries(cache):
+    """
+    Prints a table of the responses stored in cache.
+    """
+    print('{0:>10}  {1:<19}  {2}'.format('bytes', 'last used', 'url'))
+    for url, size, stored, last_used in cache.list_entries():
+        print('{0:>10}  {1:<19}  {2}'.format(
+            size, time.strftime('%Y-%m-%d %H:%M:%S',
+                                time.localtime(last_used)), url))
+
+def print_stats():
+    """
+    Prints the hit, miss, stale and eviction counts of the process-wide
+    cache, if it was used.
+    """
+    with _default_lock:
+        cache = _default_cache
+    if cache is None:
+        return
+    stats = cache.get_stats()
+    if any(stats.values()):
+        print('HTTP cache {0}: {1} hits, {2} misses, {3} stale, '
+              '{4} evicted'.format(cache.cache_dir, stats['hits'],
+                                   stats['misses'], stats['stale'],
+                                   stats['evicted']))
+
+def get_default_cache_dir():
+    """
+    Returns the path of the cache directory: in $OCVARROOT/log if that
+    exists, otherwise in $OCVARROOT.  None is returned if OCVARROOT is not
+    set.
+    """
+    var_root = os.getenv('OCVARROOT')
+    if not var_root or not os.path.isdir(var_root):
+        return None
+    log_dir = os.path.join(var_root, 'log')
+    if os.path.isdir(log_dir):
+        return os.path.join(log_dir, DEFAULT_CACHE_NAME)
+    return os.path.join(var_root, DEFAULT_CACHE_NAME)
+
+def get_default_cache(stale_if_error=None):
+    """
+    Returns the process-wide cache, opening it the first time it is needed,
+    and turns stale_if_error on or off if it is given.  None is returned if
+    the cache cannot be opened, in which case requests are simply made
+    without it.
+    """
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            cache_dir = get_default_cache_dir()
+            if cache_dir is None:
+                return None
+            try:
+                _default_cache = HttpCache(cache_dir)
+            except (sqlite3.Error, OSError):
+                return None
+        if stale_if_error is not None:
+            _default_cache.stale_if_error = stale_if_error
+        return _default_cache
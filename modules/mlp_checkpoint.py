@@ -0,0 +1,166 @@
+"""
+Stage journal for the multilevel_processor.  Each time a processing step
+completes, a line is appended recording a fingerprint of each of its input
+and output files, a hash of its parameters and the version of the program
+run.  When a run is resumed, a step is skipped if all of those still match;
+otherwise it is run again, and since its outputs are inputs to the steps
+which follow, those are invalidated as well.
+
+A file's fingerprint is its size and modification time, plus a checksum for
+each output (read once, as it is produced) and, in runs with --resume, for
+each input as well.  The checksum is only compared when the time has
+changed, so a file which was copied or touched but whose contents are the
+same still matches, while the usual check costs a stat.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+BLOCK_SIZE = 1048576
+
+class StageJournal(object):
+    """
+    An append-only journal (one JSON object per line) of completed steps.
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.resume = resume
+        self.entries = {}
+        self.lock = threading.Lock()
+        self._checksums = {}
+        if resume:
+            self._load()
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _load(self):
+        """
+        Reads the entries already in the journal.  A line left incomplete by
+        a crash is ignored.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rt') as jrnl:
+            for line in jrnl:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries[entry['key']] = entry
+
+    def checksum(self, fname):
+        """
+        Returns the SHA-1 checksum of fname's contents.  Checksums are kept
+        for the run, keyed on the file's path, size and modification time, so
+        each file is only read once.
+        """
+        stat_info = os.stat(fname)
+        cache_key = (os.path.realpath(fname), stat_info.st_size,
+                     stat_info.st_mtime)
+        with self.lock:
+            if cache_key in self._checksums:
+                return self._checksums[cache_key]
+        sha = hashlib.sha1()
+        with open(fname, 'rb') as data_file:
+            for block in iter(lambda: data_file.read(BLOCK_SIZE), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        with self.lock:
+            self._checksums[cache_key] = digest
+        return digest
+
+    def fingerprint(self, fname, with_checksum=False):
+        """
+        Returns the size and modification time of fname, and its checksum if
+        with_checksum is set.
+        """
+        stat_info = os.stat(fname)
+        recorded = {'size': stat_info.st_size, 'mtime': stat_info.st_mtime}
+        if with_checksum:
+            recorded['sha1'] = self.checksum(fname)
+        return recorded
+
+    def matches(self, fname, recorded):
+        """
+        Returns True if fname still matches what was recorded for it: the
+        same size, and the same modification time or (when one was
+        recorded) the same checksum.
+        """
+        if not os.path.exists(fname):
+            return False
+        stat_info = os.stat(fname)
+        if stat_info.st_size != recorded['size']:
+            return False
+        if stat_info.st_mtime == recorded['mtime']:
+            return True
+        return 'sha1' in recorded and \
+               self.checksum(fname) == recorded['sha1']
+
+    @staticmethod
+    def make_key(target_type, input_files):
+        """
+        Returns the key identifying a step: the target type and its inputs.
+        """
+        return '|'.join([target_type] +
+                        sorted(os.path.realpath(f) for f in input_files))
+
+    def build_state(self, input_files, par_data, program_version):
+        """
+        Returns what a step's results depend on: the fingerprints of its
+        input files, a hash of its parameters and the program version.
+        """
+        par_text = json.dumps(par_data, sort_keys=True, default=str)
+        return {'inputs': dict((os.path.realpath(f), self.fingerprint(f))
+                               for f in input_files if os.path.exists(f)),
+                'par_hash': hashlib.sha1(par_text.encode('utf-8')).hexdigest(),
+                'program_version': program_version}
+
+    def is_complete(self, key, state, output_files):
+        """
+        Returns True if the journal shows the step identified by key was
+        completed with the same state and its outputs are still intact.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        for item in ['par_hash', 'program_version']:
+            if entry[item] != state[item]:
+                return False
+        if sorted(entry['inputs']) != sorted(state['inputs']):
+            return False
+        for in_file, recorded in entry['inputs'].items():
+            if not self.matches(in_file, recorded):
+                return False
+        outputs = entry['outputs']
+        for out_file in output_files:
+            real_path = os.path.realpath(out_file)
+            if not real_path in outputs or \
+               not self.matches(out_file, outputs[real_path]):
+                return False
+        return True
+
+    def record(self, key, state, output_files):
+        """
+        Appends an entry for a completed step to the journal.  The outputs
+        are checksummed; the inputs only when resuming.
+        """
+        entry = dict(state)
+        entry['key'] = key
+        if self.resume:
+            entry['inputs'] = dict((f, self.fingerprint(f, True))
+                                   for f in state['inputs']
+                                   if os.path.exists(f))
+        entry['outputs'] = dict((os.path.realpath(f),
+                                 self.fingerprint(f, True))
+                                for f in output_files if os.path.exists(f))
+        entry['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        line = json.dumps(entry, sort_keys=True)
+        with self.lock:
+            self.entries[key] = entry
+            with open(self.path, 'at') as jrnl:
+                jrnl.write(line + '\n')
+                jrnl.flush()
+                os.fsync(jrnl.fileno())
@@ -0,0 +1,215 @@
+"""
+A persistent queue of granules waiting to be processed, kept in an SQLite
+database, for running the multilevel_processor as a service against a
+landing directory.
+
+A worker claims a granule by taking a lease on it for a limited time, which
+it renews while processing continues.  A granule whose lease runs out (e.g.
+because its worker died) can be claimed again, so several workers, on one
+host or on several hosts sharing the directory, can drain the same queue
+without a granule being processed twice.  A granule whose processing failed
+goes back to the end of the queue; either way, a granule is tried at most
+max_attempts times.  The rollback journal (rather than
+WAL, which needs shared memory) is used so that the locking also works for
+a database on a shared filesystem.
+"""
+
+import fnmatch
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+DEFAULT_QUEUE_NAME = '.mlp_queue.db'
+DEFAULT_LEASE = 3600        # seconds
+MAX_ATTEMPTS = 3
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+def get_worker_id():
+    """
+    Returns a string identifying this process: host name and process ID.
+    """
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+class WorkQueue(object):
+    """
+    The queue of granules, with their processing state.
+    """
+    def __init__(self, dbfile, lease=DEFAULT_LEASE, max_attempts=MAX_ATTEMPTS):
+        self.dbfile = dbfile
+        self.lease = lease
+        self.max_attempts = max_attempts
+        # The connection is also used by the thread renewing leases.
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(dbfile, timeout=60,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS granules
+            (path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            state TEXT,
+            owner TEXT,
+            lease_expires REAL,
+            attempts INTEGER DEFAULT 0,
+            enqueued REAL,
+            finished REAL,
+            message TEXT)''')
+        self.conn.execute('''CREATE INDEX IF NOT EXISTS granules_state
+            ON granules (state, enqueued)''')
+
+    def _transaction(self, func, *args):
+        """
+        Runs func(*args) inside an immediate (write locked) transaction.
+        """
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(*args)
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+        return result
+
+    def enqueue(self, path, size, mtime):
+        """
+        Adds path to the queue, returning True if it was added.  A file already
+        in the queue is only queued again if it has since been replaced (its
+        size or mtime changed) and is not currently being processed.
+        """
+        def _enqueue():
+            row = self.conn.execute('''SELECT size, mtime, state
+                FROM granules WHERE path = ?''', [path]).fetchone()
+            if row is not None:
+                if (row[0], row[1]) == (size, mtime) or row[2] == CLAIMED:
+                    return False
+            self.conn.execute('''INSERT OR REPLACE INTO granules
+                (path, size, mtime, state, attempts, enqueued)
+                VALUES (?, ?, ?, ?, 0, ?)''',
+                              [path, size, mtime, PENDING, time.time()])
+            return True
+        return self._transaction(_enqueue)
+
+    def claim(self, owner):
+        """
+        Claims the oldest pending granule (or one whose lease has expired),
+        returning its path, or None if there is nothing to do.
+        """
+        def _claim():
+            now = time.time()
+            self.conn.execute('''UPDATE granules SET state = ?, owner = NULL,
+                message = 'too many attempts', finished = ?
+                WHERE state = ? AND lease_expires <= ? AND attempts >= ?''',
+                              [FAILED, now, CLAIMED, now, self.max_attempts])
+            row = self.conn.execute('''SELECT path FROM granules
+                WHERE state = ? OR (state = ? AND lease_expires <= ?)
+                ORDER BY enqueued LIMIT 1''',
+                                    [PENDING, CLAIMED, now]).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('''UPDATE granules SET state = ?, owner = ?,
+                lease_expires = ?, attempts = attempts + 1 WHERE path = ?''',
+                              [CLAIMED, owner, now + self.lease, row[0]])
+            return row[0]
+        return self._transaction(_claim)
+
+    def renew(self, path, owner):
+        """
+        Extends owner's lease on path, returning False if owner no longer
+        holds it.
+        """
+        with self.lock:
+            cur = self.conn.execute('''UPDATE granules SET lease_expires = ?
+                WHERE path = ? AND owner = ? AND state = ?''',
+                                    [time.time() + self.lease, path, owner,
+                                     CLAIMED])
+        return cur.rowcount == 1
+
+    def finish(self, path, owner, success, message=None):
+        """
+        Records the outcome of processing path, returning the granule's new
+        state (or None if owner no longer holds it).  A failed granule is
+        returned to the end of the queue until it has been tried
+        max_attempts times.
+        """
+        def _finish():
+            row = self.conn.execute('''SELECT attempts FROM granules
+                WHERE path = ? AND owner = ? AND state = ?''',
+                                    [path, owner, CLAIMED]).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if success:
+                state = DONE
+            elif row[0] < self.max_attempts:
+                state = PENDING
+            else:
+                state = FAILED
+            if state == PENDING:
+                self.conn.execute('''UPDATE granules SET state = ?,
+                    owner = NULL, lease_expires = NULL, enqueued = ?,
+                    message = ? WHERE path = ?''',
+                                  [state, now, message, path])
+            else:
+                self.conn.execute('''UPDATE granules SET state = ?,
+                    owner = NULL, lease_expires = NULL, finished = ?,
+                    message = ? WHERE path = ?''',
+                                  [state, now, message, path])
+            return state
+        return self._transaction(_finish)
+
+    def release(self, path, owner):
+        """
+        Returns a claimed granule to the queue without counting the attempt,
+        e.g. when the worker is shut down.
+        """
+        with self.lock:
+            self.conn.execute('''UPDATE granules SET state = ?, owner = NULL,
+                lease_expires = NULL, attempts = attempts - 1
+                WHERE path = ? AND owner = ? AND state = ?''',
+                              [PENDING, path, owner, CLAIMED])
+
+    def get_counts(self):
+        """
+        Returns a dictionary of the number of granules in each state.
+        """
+        with self.lock:
+            return dict(self.conn.execute('''SELECT state, COUNT(*)
+                FROM granules GROUP BY state''').fetchall())
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+def scan_directory(watch_dir, queue, pattern='*', settle=60):
+    """
+    Enqueues the files in watch_dir matching pattern.  Files modified within
+    the last settle seconds are assumed to still be arriving and are left for
+    a later scan.  Returns the paths added to the queue.
+    """
+    added = []
+    now = time.time()
+    for entry in sorted(os.listdir(watch_dir)):
+        if entry.startswith('.') or not fnmatch.fnmatch(entry, pattern):
+            continue
+        path = os.path.realpath(os.path.join(watch_dir, entry))
+        try:
+            stat_info = os.stat(path)
+        except OSError:
+            continue
+        if not os.path.isfile(path) or now - stat_info.st_mtime < settle:
+            continue
+        if queue.enqueue(path, stat_info.st_size, stat_info.st_mtime):
+            added.append(path)
+    return added
@@ -0,0 +1,65 @@
+"""
+Run-scoped registry of the ObpgDataFile objects (file type, sensor, times and
+metadata) of the files used by the multilevel_processor, so that each file is
+only typed once per run: the input files when the run starts, and each
+intermediate file when the step creating it finishes.
+"""
+
+import copy
+import os
+import threading
+
+class DataFileRegistry(object):
+    """
+    Holds an ObpgDataFile for each file, keyed on its real path.  An entry is
+    only returned while the file's size and modification time are unchanged,
+    so a file which is rewritten (e.g. with the overwrite option) is typed
+    again.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+
+    @staticmethod
+    def _file_state(fname):
+        """
+        Returns the (size, mtime) of fname, or None if it cannot be read.
+        """
+        try:
+            stat_info = os.stat(fname)
+        except OSError:
+            return None
+        return stat_info.st_size, stat_info.st_mtime
+
+    def get(self, fname):
+        """
+        Returns a copy of the registered data file object for fname, or None
+        if there is no current entry.  A copy is returned as the name
+        finders change the objects they are given.
+        """
+        real_path = os.path.realpath(fname)
+        with self.lock:
+            entry = self.files.get(real_path)
+        if entry is None or entry[0] != self._file_state(real_path):
+            return None
+        data_file = copy.copy(entry[1])
+        data_file.name = fname
+        return data_file
+
+    def add(self, data_file):
+        """
+        Registers data_file, replacing any earlier entry for the same file.
+        """
+        real_path = os.path.realpath(data_file.name)
+        state = self._file_state(real_path)
+        if state is None:
+            return
+        with self.lock:
+            self.files[real_path] = (state, copy.copy(data_file))
+
+    def __contains__(self, fname):
+        return self.get(fname) is not None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.files)
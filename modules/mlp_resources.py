@@ -0,0 +1,242 @@
+"""
+Admission control for the multilevel_processor: limits on how many copies of
+each program may run at once and on the memory and cores they may use
+between them.
+
+Resource classes are given in the program's section of the par file, e.g.:
+
+    [l2gen]
+    max_concurrent=4
+    mem_gb=6
+
+The memory needed by a program is the larger of its mem_gb setting and the
+peak RSS observed for it in previous runs (plus a margin), which is kept in a
+history database along with its run times.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+import modules.mlp_scheduler as mlp_scheduler
+
+RESOURCE_KEYS = ['max_concurrent', 'mem_gb', 'cpus']
+DEFAULT_HISTORY_NAME = 'mlp_history.db'
+HISTORY_SIZE = 20       # number of recent runs used for estimates
+KB_PER_GB = 1048576
+RSS_MARGIN = 1.1
+
+class ResourceClass(object):
+    """
+    The resource limits and needs of one program.
+    """
+    def __init__(self, max_concurrent=None, mem_kb=0, cpus=1):
+        self.max_concurrent = max_concurrent
+        self.mem_kb = mem_kb
+        self.cpus = cpus
+
+    def __repr__(self):
+        return 'ResourceClass(max_concurrent={0}, mem_kb={1}, cpus={2})'.\
+               format(self.max_concurrent, self.mem_kb, self.cpus)
+
+def extract_resource_class(par_data):
+    """
+    Removes the resource settings from par_data (a program's section of the
+    par file), so they are not passed to the program, and returns them as a
+    ResourceClass.
+    """
+    settings = {}
+    for key in list(par_data.keys()):
+        if key.lower() in RESOURCE_KEYS:
+            settings[key.lower()] = par_data.pop(key)
+    try:
+        res_class = ResourceClass()
+        if 'max_concurrent' in settings:
+            res_class.max_concurrent = int(settings['max_concurrent'])
+            if res_class.max_concurrent < 1:
+                raise ValueError('max_concurrent must be at least 1')
+        if 'mem_gb' in settings:
+            res_class.mem_kb = int(float(settings['mem_gb']) * KB_PER_GB)
+        if 'cpus' in settings:
+            res_class.cpus = int(settings['cpus'])
+    except ValueError as val_err:
+        raise ResourceError('Invalid resource setting: {0}'.format(val_err))
+    return res_class
+
+def get_node_memory_kb():
+    """
+    Returns the total physical memory of this machine, in KB, or None if it
+    cannot be determined.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1024
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def get_node_cpus():
+    """
+    Returns the number of cores available to this process.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def get_default_history_path(fallback_dir):
+    """
+    Returns the path of the run history database: in $OCVARROOT/log (or
+    $OCVARROOT) so that it is shared by every run, or else in fallback_dir.
+    """
+    var_root = os.getenv('OCVARROOT')
+    if var_root and os.path.isdir(var_root):
+        log_dir = os.path.join(var_root, 'log')
+        if os.path.isdir(log_dir):
+            return os.path.join(log_dir, DEFAULT_HISTORY_NAME)
+        return os.path.join(var_root, DEFAULT_HISTORY_NAME)
+    return os.path.join(fallback_dir, DEFAULT_HISTORY_NAME)
+
+class RunHistory(object):
+    """
+    Records the wall clock time, CPU time and peak memory use of each program
+    run.  Errors from the database are not fatal; the history is only used
+    for estimates.
+    """
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(dbfile, timeout=30,
+                                    check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS runs
+            (program TEXT,
+            finished REAL,
+            wall_time REAL,
+            cpu_time REAL,
+            max_rss INTEGER)''')
+        self.conn.execute('''CREATE INDEX IF NOT EXISTS runs_program
+            ON runs (program, finished)''')
+        self.conn.commit()
+
+    def record(self, program, wall_time, cpu_time, max_rss):
+        """
+        Adds a run of program to the history.
+        """
+        with self.lock:
+            try:
+                self.conn.execute('INSERT INTO runs VALUES (?,?,?,?,?)',
+                                  [program, time.time(), wall_time, cpu_time,
+                                   max_rss])
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+
+    def get_recent_runs(self, program, count=HISTORY_SIZE):
+        """
+        Returns (wall_time, cpu_time, max_rss) for the most recent runs of
+        program.
+        """
+        with self.lock:
+            try:
+                return self.conn.execute('''SELECT wall_time, cpu_time,
+                    max_rss FROM runs WHERE program = ?
+                    ORDER BY finished DESC LIMIT ?''',
+                                         [program, count]).fetchall()
+            except sqlite3.Error:
+                return []
+
+    def get_peak_rss(self, program):
+        """
+        Returns the largest peak RSS (KB) of the recent runs of program, or 0
+        if it has not been run.
+        """
+        runs = self.get_recent_runs(program)
+        if not runs:
+            return 0
+        return max(run[2] for run in runs)
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+class ResourceScheduler(mlp_scheduler.DagScheduler):
+    """
+    A DagScheduler which only starts a task when the limits of its program's
+    resource class and the memory and cores of the machine allow.
+    get_program is called with a task and returns the name of its program;
+    can_start_hook, if given, is called with a task and returns False if it
+    must wait for some other reason.
+    """
+    def __init__(self, max_workers, get_program, resource_classes=None,
+                 node_mem_kb=None, node_cpus=None, history=None,
+                 can_start_hook=None):
+        super(ResourceScheduler, self).__init__(max_workers)
+        self.get_program = get_program
+        self.resource_classes = resource_classes or {}
+        self.node_mem_kb = node_mem_kb
+        self.node_cpus = node_cpus
+        self.history = history
+        self.can_start_hook = can_start_hook
+        self.needs = {}
+        self.reserved = {}
+        self.running_counts = {}
+        self.mem_in_use = 0
+        self.cpus_in_use = 0
+
+    def get_needs(self, program):
+        """
+        Returns the ResourceClass for program, with its memory need raised to
+        the peak RSS learned from previous runs if that is larger.
+        """
+        if not program in self.needs:
+            res_class = self.resource_classes.get(program, ResourceClass())
+            learned_kb = 0
+            if self.history:
+                learned_kb = int(self.history.get_peak_rss(program) *
+                                 RSS_MARGIN)
+            self.needs[program] = ResourceClass(
+                res_class.max_concurrent, max(res_class.mem_kb, learned_kb),
+                res_class.cpus)
+        return self.needs[program]
+
+    def _can_start(self, task):
+        program = self.get_program(task)
+        needs = self.get_needs(program)
+        if needs.max_concurrent is not None and \
+           self.running_counts.get(program, 0) >= needs.max_concurrent:
+            return False
+        if self.node_mem_kb and \
+           self.mem_in_use + needs.mem_kb > self.node_mem_kb:
+            return False
+        if self.node_cpus and self.cpus_in_use + needs.cpus > self.node_cpus:
+            return False
+        if self.can_start_hook and not self.can_start_hook(task):
+            return False
+        return True
+
+    def _task_started(self, task):
+        program = self.get_program(task)
+        needs = self.get_needs(program)
+        self.reserved[task.key] = (program, needs)
+        self.running_counts[program] = self.running_counts.get(program, 0) + 1
+        self.mem_in_use += needs.mem_kb
+        self.cpus_in_use += needs.cpus
+
+    def _task_finished(self, task):
+        program, needs = self.reserved.pop(task.key)
+        self.running_counts[program] -= 1
+        self.mem_in_use -= needs.mem_kb
+        self.cpus_in_use -= needs.cpus
+        # The finished run has been added to the history, so the estimate
+        # is worked out again for the next task of the program.
+        self.needs.pop(program, None)
+
+class ResourceError(Exception):
+    """ Exception class for invalid resource settings. """
+    def __init__(self, m):
+        self.msg = m
+    def __str__(self):
+        return repr(self.msg)
@@ -0,0 +1,165 @@
+"""
+Runs child processes for the multilevel_processor, passing their output on a
+line at a time as it is produced (rather than holding all of it until the
+process ends) and collecting the wall clock time, CPU time and peak memory
+used by each.
+
+Each command runs in a process group of its own, so it can be stopped along
+with everything it started.  That also keeps a Ctrl-C or SIGTERM from
+reaching the commands, so whoever handles the interrupt must call
+terminate_all to stop the commands still running.
+"""
+
+import datetime
+import os
+import signal
+import subprocess
+import threading
+import time
+
+DEFAULT_KILL_GRACE = 10     # seconds between SIGTERM and SIGKILL
+
+# process id: Popen, for the commands currently running
+_live_lock = threading.Lock()
+_live = {}
+_stopped = False
+
+class CommandResult(object):
+    """
+    The exit status and resource use of a finished command.
+    """
+    def __init__(self, command, status, wall_time, user_time, sys_time,
+                 max_rss, timed_out=False):
+        self.command = command
+        self.status = status
+        self.wall_time = wall_time
+        self.user_time = user_time
+        self.sys_time = sys_time
+        self.max_rss = max_rss      # kilobytes
+        self.timed_out = timed_out
+
+    @property
+    def cpu_time(self):
+        """ Total (user + system) CPU time, in seconds. """
+        return self.user_time + self.sys_time
+
+    def __str__(self):
+        return 'status {0}, wall {1:.2f} s, CPU {2:.2f} s ' \
+               '(user {3:.2f} s, sys {4:.2f} s), max RSS {5} KB{6}'.\
+               format(self.status, self.wall_time, self.cpu_time,
+                      self.user_time, self.sys_time, self.max_rss,
+                      ', timed out' if self.timed_out else '')
+
+def _pump(pipe, stream_name, line_handler):
+    """
+    Reads pipe a line at a time, passing each (time stamped) line to
+    line_handler, until the pipe is closed.
+    """
+    with pipe:
+        for raw_line in iter(pipe.readline, b''):
+            line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+            stamp = datetime.datetime.now().strftime('%H:%M:%S')
+            line_handler(stream_name, stamp, line)
+
+def _exit_status(wait_status):
+    """
+    Converts a status from os.wait4 to an exit code, with the negative
+    signal number (as used by subprocess) for a process that was killed.
+    """
+    if os.WIFSIGNALED(wait_status):
+        return -os.WTERMSIG(wait_status)
+    return os.WEXITSTATUS(wait_status)
+
+def _stop_groups(subprocs, kill_grace):
+    """
+    Stops the process groups of subprocs: SIGTERM, then SIGKILL for those
+    which have not exited within kill_grace seconds.
+    """
+    signalled = []
+    for subproc in subprocs:
+        try:
+            os.killpg(subproc.pid, signal.SIGTERM)
+            signalled.append(subproc)
+        except OSError:
+            pass
+    deadline = time.time() + kill_grace
+    while time.time() < deadline and \
+          any(subproc.returncode is None for subproc in signalled):
+        time.sleep(0.1)
+    for subproc in signalled:
+        if subproc.returncode is None:
+            try:
+                os.killpg(subproc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+def _terminate(subproc, kill_grace, timed_out):
+    """
+    Stops a command which has run past its timeout.
+    """
+    timed_out.set()
+    _stop_groups([subproc], kill_grace)
+
+def terminate_all(kill_grace=DEFAULT_KILL_GRACE):
+    """
+    Stops every command still running, along with everything each started,
+    e.g. when the multilevel_processor is interrupted.  Commands started
+    afterwards (by a thread which has not yet seen the interrupt) are killed
+    at once.
+    """
+    global _stopped
+    with _live_lock:
+        _stopped = True
+        subprocs = list(_live.values())
+    _stop_groups(subprocs, kill_grace)
+
+def run_command(command, line_handler, timeout=None,
+                kill_grace=DEFAULT_KILL_GRACE):
+    """
+    Runs command (a shell command line), calling line_handler(stream_name,
+    time_stamp, line) for each line written to stdout or stderr.  If timeout
+    (seconds) is given, the command and everything it started are killed
+    once it is exceeded.  Returns a CommandResult.
+    """
+    start_time = time.time()
+    subproc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, start_new_session=True)
+    with _live_lock:
+        _live[subproc.pid] = subproc
+        if _stopped:
+            os.killpg(subproc.pid, signal.SIGKILL)
+    pumps = [threading.Thread(target=_pump,
+                              args=(subproc.stdout, 'stdout', line_handler)),
+             threading.Thread(target=_pump,
+                              args=(subproc.stderr, 'stderr', line_handler))]
+    for pump in pumps:
+        pump.daemon = True
+        pump.start()
+    timed_out = threading.Event()
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, _terminate,
+                                args=(subproc, kill_grace, timed_out))
+        timer.daemon = True
+        timer.start()
+    try:
+        while True:
+            try:
+                _, wait_status, rusage = os.wait4(subproc.pid, 0)
+                break
+            except InterruptedError:
+                continue
+        wall_time = time.time() - start_time
+        # Tell subprocess the process has been reaped, so it does not try
+        # again.
+        subproc.returncode = _exit_status(wait_status)
+    finally:
+        with _live_lock:
+            del _live[subproc.pid]
+    if timer:
+        timer.cancel()
+    for pump in pumps:
+        pump.join()
+    return CommandResult(command, subproc.returncode, wall_time,
+                         rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss,
+                         timed_out.is_set())
@@ -0,0 +1,183 @@
+"""
+Dependency graph scheduler for the multilevel_processor.  Tasks (one per
+granule and processing step) are only started once every task they depend on
+has completed, and at most max_workers tasks are run at the same time.
+"""
+
+import concurrent.futures
+import sys
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+class Task(object):
+    """
+    A single node of the processing graph.
+    """
+    def __init__(self, key, action, deps=None, label=None, data=None):
+        self.key = key
+        self.action = action
+        self.deps = set(deps) if deps else set()
+        self.label = label if label else str(key)
+        self.data = data
+        self.state = PENDING
+        self.result = None
+        self.exc_info = None
+
+    def __repr__(self):
+        return 'Task({0})'.format(self.label)
+
+    def __str__(self):
+        return self.label
+
+class DagScheduler(object):
+    """
+    Runs a graph of Task objects on a bounded pool of worker threads.  The
+    work done by the multilevel_processor is spent in child processes, so
+    threads are sufficient to keep the cores busy.
+    """
+    def __init__(self, max_workers=1):
+        if max_workers < 1:
+            max_workers = 1
+        self.max_workers = max_workers
+        self.tasks = {}
+        self.order = []
+
+    def add_task(self, key, action, deps=None, label=None, data=None):
+        """
+        Adds a task to the graph and returns it.  Dependencies must name
+        tasks which have already been added.
+        """
+        if key in self.tasks:
+            raise SchedulerError('Duplicate task key: {0}'.format(key))
+        for dep in deps or []:
+            if not dep in self.tasks:
+                raise SchedulerError('Task {0} depends on unknown task {1}'.\
+                                     format(key, dep))
+        task = Task(key, action, deps, label, data)
+        self.tasks[key] = task
+        self.order.append(key)
+        return task
+
+    def get_dependents(self, key):
+        """
+        Returns the keys of the tasks which directly depend on key.
+        """
+        return [k for k in self.order if key in self.tasks[k].deps]
+
+    def _is_ready(self, task):
+        return all(self.tasks[dep].state == DONE for dep in task.deps)
+
+    def _is_blocked(self, task):
+        return any(self.tasks[dep].state in (FAILED, SKIPPED)
+                   for dep in task.deps)
+
+    def _can_start(self, task):
+        """
+        Hook for deciding whether a ready task may be started now.  A task
+        refused when no other task is running is started anyway.
+        """
+        return True
+
+    def _task_started(self, task):
+        """
+        Hook called (in the main thread) when a task is submitted.
+        """
+        pass
+
+    def _task_finished(self, task):
+        """
+        Hook called (in the main thread) when a task completes or fails.
+        """
+        pass
+
+    def run(self, on_complete=None, on_interrupt=None):
+        """
+        Runs every task in the graph.  on_complete, if given, is called in the
+        calling thread with each finished task before any of its dependents
+        are started.  If a task raises an exception (including SystemExit),
+        no new tasks are started; the exception is re-raised once the running
+        tasks have finished.  If the calling thread is interrupted,
+        on_interrupt (if given) is called to stop the running tasks before
+        waiting for them.
+        """
+        running = {}
+        failure = None
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            try:
+                while True:
+                    if failure is None:
+                        held = None
+                        for key in self.order:
+                            if len(running) >= self.max_workers:
+                                break
+                            task = self.tasks[key]
+                            if task.state != PENDING:
+                                continue
+                            if self._is_blocked(task):
+                                task.state = SKIPPED
+                                continue
+                            if not self._is_ready(task):
+                                continue
+                            if self._can_start(task):
+                                task.state = RUNNING
+                                self._task_started(task)
+                                running[pool.submit(_run_task, task)] = task
+                            elif held is None:
+                                held = task
+                        if not running and held is not None:
+                            # Nothing running will free up what the task is
+                            # waiting for, so it is started on its own.
+                            held.state = RUNNING
+                            self._task_started(held)
+                            running[pool.submit(_run_task, held)] = held
+                    if not running:
+                        break
+                    finished, _ = concurrent.futures.wait(
+                        running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        task = running.pop(future)
+                        self._task_finished(task)
+                        if task.exc_info:
+                            task.state = FAILED
+                            if failure is None:
+                                failure = task.exc_info
+                            continue
+                        if on_complete:
+                            try:
+                                on_complete(task)
+                            except BaseException:
+                                task.state = FAILED
+                                if failure is None:
+                                    failure = sys.exc_info()
+                                continue
+                        task.state = DONE
+            except KeyboardInterrupt:
+                # The pool waits for the running tasks on the way out, so
+                # they have to be stopped first.
+                if on_interrupt and running:
+                    on_interrupt()
+                raise
+        if failure is not None:
+            raise failure[1].with_traceback(failure[2])
+        return [self.tasks[k] for k in self.order]
+
+def _run_task(task):
+    """
+    Executes a task's action, storing the result or the exception raised.
+    """
+    try:
+        task.result = task.action(task)
+    except BaseException:
+        task.exc_info = sys.exc_info()
+    return task
+
+class SchedulerError(Exception):
+    """ Exception class for the DagScheduler. """
+    def __init__(self, m):
+        self.msg = m
+    def __str__(self):
+        return repr(self.msg)
@@ -13,6 +13,7 @@ import types
 #from lxml.html.diff import start_tag
 
 import get_obpg_file_type
+import modules.file_type_cache as file_type_cache
 import modules.obpg_data_file as obpg_data_file
 import modules.ProcUtils as ProcUtils
 import modules.time_utils as time_utils
@@ -66,17 +67,18 @@ def _get_days_diff(day1, day2):
     return (day1 - day2).days
 
 
-def _get_data_files_info(flf):
+def _get_data_files_info(flf, use_cache=True):
     """
     Returns a list of data files read from the specified input file.
     """
+    cache = file_type_cache.get_default_cache() if use_cache else None
     data_file_list = []
     with open(flf, 'rt') as file_list_file:
         inp_lines = file_list_file.readlines()
     for line in inp_lines:
         filename = line.strip()
         if os.path.exists(filename):
-            file_typer = get_obpg_file_type.ObpgFileTyper(filename)
+            file_typer = get_obpg_file_type.ObpgFileTyper(filename, cache)
             file_type, sensor = file_typer.get_file_type()
             stime, etime = file_typer.get_file_times()
             data_file = obpg_data_file.ObpgDataFile(filename, file_type,
@@ -29,6 +29,7 @@ class Processor(object):
         self.applicable_rules = self._get_applicable_rules(ruleset)
         self.out_directory = out_dir
         self.keepfiles = False
+        self.intermediate = False
 
         self.required_types = self._find_required_types()
 
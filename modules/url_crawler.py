@@ -0,0 +1,213 @@
+"""
+Breadth-first crawler for the OBPG directory listings (e.g. the LUT or
+ancillary trees), used by SessionUtils.spider.
+
+Pages are fetched by a pool of threads, with a limit on the requests made
+to each host at once.  The pages already seen are kept in a set, and each
+page is listed once, with its file sizes and times taken from the listing.
+The result is a manifest of the files found: a list of link dictionaries
+({'href': url, 'mtime': seconds since the epoch, 'size': bytes}, the same
+form as JsonUtils.linkdict, with None where the listing doesn't give a
+value), which SessionUtils.download_manifest and JsonUtils.needs_download
+accept directly; both take a missing size or time from the file's header.
+
+The crawl state (pages seen and still to visit, files found) can be saved
+to a file as the crawl goes on, so an interrupted crawl can be resumed.  The
+file is removed once a crawl finishes with every page listed, so the next
+crawl starts afresh.
+"""
+
+import collections
+import concurrent.futures
+import json
+import os
+import re
+import threading
+
+from SessionUtils import base_url, is_page
+
+try:
+    from urllib.parse import urlsplit  # python 3
+except ImportError:
+    from urlparse import urlsplit  # python 2
+
+DEFAULT_WORKERS = 8
+DEFAULT_PER_HOST = 4
+CHECKPOINT_PAGES = 50       # pages listed between saves of the state
+
+def read_manifest(filename):
+    """
+    Returns the manifest saved in filename.
+    """
+    with open(filename, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+def write_manifest(manifest, filename):
+    """
+    Saves manifest to filename.
+    """
+    _write_json(filename, manifest)
+
+def _write_json(filename, data):
+    """
+    Writes data to filename, replacing it only once complete.
+    """
+    tmp_name = filename + '.tmp'
+    with open(tmp_name, 'w') as out_file:
+        json.dump(data, out_file)
+    os.rename(tmp_name, filename)
+
+class Crawler(object):
+    """
+    Crawls the pages below a starting url.  include and exclude are regular
+    expressions: only files matching include (if given) go into the
+    manifest, and pages or files matching exclude are skipped.  on_visit, if
+    given, is called with each url and its depth as it is found.
+    """
+    def __init__(self, session_utils, include=None, exclude=None,
+                 workers=DEFAULT_WORKERS, per_host=DEFAULT_PER_HOST,
+                 max_depth=None, state_file=None, on_visit=None):
+        self.session_utils = session_utils
+        self.include = re.compile(include) if include else None
+        self.exclude = re.compile(exclude) if exclude else None
+        self.workers = max(1, workers)
+        self.per_host = max(1, per_host)
+        self.max_depth = max_depth
+        self.state_file = state_file
+        self.on_visit = on_visit
+        self.host_limits = {}
+        self.host_lock = threading.Lock()
+        self.seen = set()
+        self.frontier = collections.deque()
+        self.manifest = []
+        self.failed = []
+
+    def _host_limit(self, url):
+        """
+        Returns the semaphore limiting the requests to url's host.
+        """
+        host = urlsplit(url).netloc
+        with self.host_lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = \
+                    threading.BoundedSemaphore(self.per_host)
+            return self.host_limits[host]
+
+    def _list_page(self, url):
+        """
+        Returns the (link, mtime, size) entries of the page at url, or None
+        if it could not be listed.
+        """
+        with self._host_limit(url):
+            try:
+                return self.session_utils.list_pagelinks(url)
+            except Exception as e:
+                print('Exception: {:}'.format(e))
+                return None
+
+    def _load_state(self, start_url):
+        """
+        Restores the state saved by an earlier crawl from start_url,
+        returning True if there was one.
+        """
+        if not (self.state_file and os.path.exists(self.state_file)):
+            return False
+        with open(self.state_file, 'r') as state:
+            saved = json.load(state)
+        if saved.get('start') != start_url:
+            return False
+        self.seen = set(saved['seen'])
+        self.frontier = collections.deque(tuple(page)
+                                          for page in saved['frontier'])
+        self.manifest = saved['manifest']
+        return True
+
+    def _save_state(self, start_url, in_flight=()):
+        """
+        Saves the state of the crawl; pages being listed are saved as still
+        to visit.
+        """
+        if not self.state_file:
+            return
+        _write_json(self.state_file,
+                    {'start': start_url, 'seen': sorted(self.seen),
+                     'frontier': list(in_flight) + self.failed +
+                                 list(self.frontier),
+                     'manifest': self.manifest})
+
+    def _add_links(self, url, depth, entries):
+        """
+        Queues the new pages and records the files from the listing of url.
+        """
+        for link, mtime, size in entries:
+            if link in self.seen or link == url:
+                continue
+            if self.exclude and self.exclude.search(link):
+                continue
+            if is_page(link):
+                # only go down the tree
+                if base_url(url) not in link:
+                    continue
+                self.seen.add(link)
+                if self.max_depth is None or depth + 1 <= self.max_depth:
+                    self.frontier.append((link, depth + 1))
+                    if self.on_visit:
+                        self.on_visit(link, depth + 1)
+            else:
+                self.seen.add(link)
+                if self.include and not self.include.search(link):
+                    continue
+                self.manifest.append({'href': link, 'mtime': mtime,
+                                      'size': size})
+                if self.on_visit:
+                    self.on_visit(link, depth + 1)
+
+    def crawl(self, start_url):
+        """
+        Crawls the tree from start_url, returning the manifest of the files
+        found.  The (url, depth) of each page which could not be listed is
+        left in self.failed, and is tried again if the crawl is resumed; if
+        there are none, the saved state is removed.
+        """
+        self.failed = []
+        if not self._load_state(start_url):
+            self.seen = set([start_url])
+            self.frontier = collections.deque([(start_url, 0)])
+            self.manifest = []
+            if self.on_visit:
+                self.on_visit(start_url, 0)
+
+        listed = 0
+        in_flight = {}
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            try:
+                while self.frontier or in_flight:
+                    # the frontier is taken in order, so the tree is
+                    # visited breadth first
+                    while self.frontier and len(in_flight) < self.workers:
+                        url, depth = self.frontier.popleft()
+                        in_flight[pool.submit(self._list_page, url)] = \
+                            (url, depth)
+                    done, _ = concurrent.futures.wait(
+                        in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        url, depth = in_flight.pop(future)
+                        entries = future.result()
+                        if entries is None:
+                            self.failed.append((url, depth))
+                            continue
+                        self._add_links(url, depth, entries)
+                        listed += 1
+                        if listed % CHECKPOINT_PAGES == 0:
+                            self._save_state(start_url, in_flight.values())
+            except BaseException:
+                # keep what has been done for a later resume
+                for future in in_flight:
+                    future.cancel()
+                self._save_state(start_url, in_flight.values())
+                raise
+        if self.failed:
+            self._save_state(start_url)
+        elif self.state_file and os.path.exists(self.state_file):
+            os.remove(self.state_file)
+        return self.manifest
@@ -10,20 +10,38 @@ try:
 except ImportError:
     import ConfigParser as configparser
     
+import concurrent.futures
+import copy
 import datetime
+import hashlib
+import heapq
+import json
 import logging
 import optparse
 import os
 import re
+import shutil
+import signal
+import sqlite3
 import subprocess
 import sys
 import tarfile
+import tempfile
+import threading
 import time
 import traceback
 
 import get_obpg_file_type
 import modules.mlp_utils as mlp_utils
+import modules.mlp_checkpoint as mlp_checkpoint
+import modules.mlp_queue as mlp_queue
+import modules.mlp_registry as mlp_registry
+import modules.mlp_resources as mlp_resources
+import modules.mlp_runner as mlp_runner
+import modules.mlp_scheduler as mlp_scheduler
+import modules.anc_utils as anc_utils
 import modules.benchmark_timer as benchmark_timer
+import modules.file_type_cache as file_type_cache
 import modules.MetaUtils as MetaUtils
 import modules.name_finder_utils as name_finder_utils
 import modules.obpg_data_file as obpg_data_file
@@ -43,7 +61,9 @@ class ProcessorConfig(object):
     """
     SECS_PER_DAY = 86400
     def __init__(self, hidden_dir, ori_dir, verbose, overwrite, use_existing,
-                 tar_name=None, timing=False, out_dir=None):
+                 tar_name=None, timing=False, out_dir=None, jobs=1,
+                 resume=False, timeout=None, getanc_subprocess=False,
+                 plan=False):
         self.prog_name = os.path.basename(sys.argv[0])
 
         if not os.path.exists(hidden_dir):
@@ -61,8 +81,18 @@ class ProcessorConfig(object):
         self.overwrite = overwrite
         self.use_existing = use_existing
         self.get_anc = True
+        self.getanc_subprocess = getanc_subprocess
+        self.offline_anc = False
+        self.plan = plan
         self.tar_filename = tar_name
         self.timing = timing
+        self.jobs = jobs
+        self.file_type_cache = None
+        self.resume = resume
+        self.timeout = timeout
+        self.run_history = None
+        self.scratch_dir = None
+        self.scratch_min_free = 0
         if out_dir:
             self.output_dir = out_dir
             self.output_dir_is_settable = False
@@ -128,18 +158,71 @@ class ProcessorConfig(object):
             cfg_file.write('[main]\n')
             cfg_file.write('par_file_age=30  # units are days\n')
 
+class RunState(object):
+    """
+    The state of one call of do_processing: the data files typed and the
+    files created, and the stage journal.  With --watch, several granules
+    are processed at once, so this is kept for each thread (see
+    get_run_state) rather than in cfg_data.
+    """
+    def __init__(self):
+        self.data_file_registry = mlp_registry.DataFileRegistry()
+        self.created_files = set()
+        self.journal = None
+
+def get_run_state():
+    """
+    Returns the RunState of the processing being done by this thread, or
+    None outside of do_processing.
+    """
+    return getattr(_thread_data, 'run_state', None)
+
+def get_name_finder_options(proc):
+    """
+    Returns the options (suite, resolution and output format) from proc's
+    parameters which affect the names of the files it creates.
+    """
+    finder_opts = {}
+    if 'suite' in proc.par_data:
+        finder_opts['suite'] = proc.par_data['suite']
+    elif 'prod' in proc.par_data:
+        finder_opts['suite'] = proc.par_data['prod']
+    if 'resolution' in proc.par_data:
+        finder_opts['resolution'] = proc.par_data['resolution']
+    if 'oformat' in proc.par_data:
+        finder_opts['oformat'] = proc.par_data['oformat']
+    return finder_opts
+
 def get_obpg_data_file_object(file_specification):
     """
     Returns an obpg_data_file object for the file named in file_specification.
-    """
-    ftyper = get_obpg_file_type.ObpgFileTyper(file_specification)
+    Files already typed during this run are taken from the registry.
+    """
+    run_state = get_run_state()
+    registry = run_state.data_file_registry if run_state else None
+    if registry is not None:
+        obpg_data_file_obj = registry.get(file_specification)
+        if obpg_data_file_obj is not None:
+            return obpg_data_file_obj
+    ftyper = get_obpg_file_type.ObpgFileTyper(file_specification,
+                                              cfg_data.file_type_cache)
     (ftype, sensor) = ftyper.get_file_type()
     (stime, etime) = ftyper.get_file_times()
     obpg_data_file_obj = obpg_data_file.ObpgDataFile(file_specification, ftype,
                                                      sensor, stime, etime,
                                                      ftyper.attributes)
+    if registry is not None:
+        registry.add(obpg_data_file_obj)
     return obpg_data_file_obj
 
+def register_output_file(out_file):
+    """
+    Types a file created during processing and adds it to the registry, so
+    the later steps using it don't each type it again.
+    """
+    if get_run_state() is not None and out_file and os.path.exists(out_file):
+        get_obpg_data_file_object(out_file)
+
 def build_executable_path(prog_name):
     """
     Returns the directory in which the program named in prog_name is found.
@@ -154,6 +237,86 @@ def build_executable_path(prog_name):
             break
     return exe_path
 
+def get_program_version(proc):
+    """
+    Returns a string identifying the version of the program run by proc: the
+    name of the program with the size and modification time of its
+    executable (when it can be found), plus the version of this program.
+    """
+    action = proc.rule_set.rules[proc.target_type].action
+    prog_name = action.__name__
+    if prog_name.startswith('run_'):
+        prog_name = prog_name[4:]
+    version = [prog_name, __version__]
+    for cand_name in [prog_name, prog_name + '.py']:
+        exe_path = os.path.join(proc.ocssw_bin, cand_name)
+        if not os.path.exists(exe_path):
+            exe_path = build_executable_path(cand_name)
+        if exe_path:
+            stat_info = os.stat(exe_path)
+            version.extend([str(stat_info.st_size), str(stat_info.st_mtime)])
+            break
+    return ' '.join(version)
+
+def execute_processor(proc, input_files):
+    """
+    Runs proc and records the completed step in the journal.  When resuming,
+    the step is skipped (and 0 returned) if the journal shows proc's output
+    was already created from the same inputs, parameters and program.
+    """
+    run_state = get_run_state()
+    journal = run_state.journal
+    if journal is None:
+        proc_status = run_and_measure(proc)
+        if not proc_status and os.path.exists(proc.output_file):
+            run_state.created_files.add(os.path.realpath(proc.output_file))
+        return proc_status
+    key = journal.make_key(proc.target_type, input_files)
+    state = journal.build_state(input_files, proc.par_data,
+                                get_program_version(proc))
+    if cfg_data.resume and \
+       journal.is_complete(key, state, [proc.output_file]):
+        msg = 'Resuming: {0} is up to date, skipping {1}.'.\
+              format(proc.output_file, proc.target_type)
+        logging.info(msg)
+        if cfg_data.verbose:
+            print (msg)
+        return 0
+    proc_status = run_and_measure(proc)
+    if not proc_status and os.path.exists(proc.output_file):
+        journal.record(key, state, [proc.output_file])
+        run_state.created_files.add(os.path.realpath(proc.output_file))
+    return proc_status
+
+def journal_has_step(proc, input_files):
+    """
+    Returns True if the stage journal has an entry for proc run on
+    input_files.
+    """
+    run_state = get_run_state()
+    if run_state is None or run_state.journal is None:
+        return False
+    key = run_state.journal.make_key(proc.target_type, input_files)
+    return key in run_state.journal.entries
+
+def run_and_measure(proc):
+    """
+    Runs proc, adding the time and peak memory used by the commands it ran
+    to the run history.  Returns the status from proc.
+    """
+    _thread_data.results = []
+    try:
+        proc_status = proc.execute()
+        results = _thread_data.results
+    finally:
+        _thread_data.results = None
+    if results and cfg_data.run_history and not proc_status:
+        cfg_data.run_history.record(proc.target_type,
+                                    sum(r.wall_time for r in results),
+                                    sum(r.cpu_time for r in results),
+                                    max(r.max_rss for r in results))
+    return proc_status
+
 def build_file_list_file(filename, file_list):
     """
     Create a file listing the names of the files to be processed.
@@ -255,9 +418,11 @@ def build_l2gen_par_file(par_contents, input_file, geo_file, output_file):
     Build the parameter file for L2 processing.
     """
     dt_stamp = datetime.datetime.today()
-    par_name = ''.join(['L2_', dt_stamp.strftime('%Y%m%d%H%M%S'), '.par'])
-    par_path = os.path.join(cfg_data.hidden_dir, par_name)
-    with open(par_path, 'wt') as par_file:
+    # A unique name, as concurrent jobs may build par files in the same second.
+    par_fd, par_path = tempfile.mkstemp(
+        dir=cfg_data.hidden_dir, suffix='.par',
+        prefix=''.join(['L2_', dt_stamp.strftime('%Y%m%d%H%M%S'), '_']))
+    with os.fdopen(par_fd, 'wt') as par_file:
         par_file.write('# Automatically generated par file for l2gen\n')
         par_file.write('ifile=' + input_file + '\n')
         if not geo_file is None:
@@ -444,6 +609,251 @@ def build_viirs_rules():
     rules = processing_rules.RuleSet('VIIRS Rules', rules_dict, rules_order)
     return rules
 
+def build_granule_file_lists(src_files):
+    """
+    Splits the source files into one dictionary per granule.  As when pairing
+    source files for processors requiring more than one input type, the n-th
+    file of each type is taken to belong to the n-th granule.
+    """
+    granule_count = 0
+    for src_type in src_files:
+        granule_count = max(granule_count, len(src_files[src_type]))
+    granules = []
+    for gnum in range(granule_count):
+        granule = {}
+        for src_type in src_files:
+            if gnum < len(src_files[src_type]):
+                granule[src_type] = [src_files[src_type][gnum]]
+        granules.append(granule)
+    return granules
+
+def build_plan(scheduler, processors, src_files, par_file, instrument):
+    """
+    Works through the processing graph without running anything, returning
+    a dictionary describing the stages which would run, the inputs and
+    output name of each program run and the estimated time needed.  Output
+    files which do not exist yet are described by the data file objects of
+    their inputs.
+    """
+    planned_files = {}
+    durations = {}
+    stages = [{'program': proc.target_type, 'tasks': [],
+               'estimated_seconds': 0.0} for proc in processors]
+    run_estimates = {}
+    for key in scheduler.order:
+        task = scheduler.tasks[key]
+        ndx = task.data['ndx']
+        proc = processors[ndx]
+        files = task.data['files']
+        if not proc.target_type in run_estimates:
+            run_estimates[proc.target_type] = estimate_run_time(
+                proc.target_type)
+        task_plan = {'label': task.label,
+                     'granule': key[1] if task.data['per_granule'] else None,
+                     'depends_on': sorted(scheduler.tasks[dep].label
+                                          for dep in task.deps),
+                     'runs': []}
+        src_key = get_source_key(ndx, processors, files)
+        file_sets = []
+        if src_key is None:
+            task_plan['note'] = 'no source files available'
+        elif proc.requires_batch_processing():
+            file_sets = [sorted(files[src_key])]
+        elif proc.rule_set.rules[proc.target_type].action:
+            proc_src_types = proc.rule_set.rules[proc.target_type].\
+                             src_file_types
+            file_sets = get_source_file_sets(
+                proc_src_types, files, src_key,
+                proc.rule_set.rules[proc.target_type].requires_all_sources)
+        for file_set in file_sets:
+            if isinstance(file_set, (list, tuple)):
+                inputs = [fname for fname in file_set if fname]
+            else:
+                inputs = [file_set]
+            if proc.requires_batch_processing():
+                named_from = inputs
+            else:
+                named_from = inputs[:1]
+            data_files = [get_planned_data_file(fname, planned_files)
+                          for fname in named_from]
+            name_finder = name_finder_utils.get_level_finder(
+                data_files, proc.target_type, get_name_finder_options(proc))
+            output = os.path.join(proc.out_directory,
+                                  name_finder.get_next_level_name())
+            start_times = [df.start_time for df in data_files
+                           if df.start_time]
+            end_times = [df.end_time for df in data_files if df.end_time]
+            planned_files[output] = obpg_data_file.ObpgDataFile(
+                output, proc.target_type, data_files[0].sensor,
+                min(start_times) if start_times else None,
+                max(end_times) if end_times else None,
+                data_files[0].metadata)
+            task_plan['runs'].append({'inputs': inputs, 'output': output})
+            # As record_outputs does when processing, so later stages see
+            # the (planned) outputs.
+            for file_dict in [files, src_files]:
+                file_dict.setdefault(proc.target_type, [])
+                if not output in file_dict[proc.target_type]:
+                    file_dict[proc.target_type].append(output)
+        estimate = run_estimates[proc.target_type]
+        if estimate is None:
+            task_plan['estimated_seconds'] = None
+            stages[ndx]['estimated_seconds'] = None
+        else:
+            task_plan['estimated_seconds'] = estimate * len(task_plan['runs'])
+            if stages[ndx]['estimated_seconds'] is not None:
+                stages[ndx]['estimated_seconds'] += \
+                    task_plan['estimated_seconds']
+        durations[key] = task_plan['estimated_seconds'] or 0.0
+        stages[ndx]['tasks'].append(task_plan)
+    unknown = sorted(prog for prog in run_estimates
+                     if run_estimates[prog] is None)
+    return {'par_file': os.path.realpath(par_file),
+            'instrument': instrument,
+            'jobs': cfg_data.jobs,
+            'stages': stages,
+            'estimated_serial_seconds': sum(durations.values()),
+            'estimated_wall_seconds': estimate_wall_time(scheduler, durations,
+                                                         cfg_data.jobs),
+            'programs_without_history': unknown}
+
+def estimate_run_time(program):
+    """
+    Returns the median wall clock time (seconds) of the recent runs of
+    program, or None if there is no history for it.
+    """
+    if not cfg_data.run_history:
+        return None
+    wall_times = sorted(run[0] for run in
+                        cfg_data.run_history.get_recent_runs(program))
+    if not wall_times:
+        return None
+    return wall_times[len(wall_times) // 2]
+
+def estimate_wall_time(scheduler, durations, workers):
+    """
+    Returns the estimated time to run every task in the scheduler's graph,
+    given the duration of each task, with at most workers tasks running at
+    once (resource limits are not taken into account).
+    """
+    worker_free = [0.0] * max(workers, 1)
+    finish_times = {}
+    for key in scheduler.order:
+        task = scheduler.tasks[key]
+        ready = max([finish_times[dep] for dep in task.deps] + [0.0])
+        start = max(heapq.heappop(worker_free), ready)
+        finish_times[key] = start + durations[key]
+        heapq.heappush(worker_free, finish_times[key])
+    return max(list(finish_times.values()) + [0.0])
+
+def get_planned_data_file(fname, planned_files):
+    """
+    Returns the data file object for fname: the planned output if it will be
+    created during processing, otherwise the file itself.
+    """
+    if fname in planned_files:
+        return planned_files[fname]
+    return get_obpg_data_file_object(fname)
+
+def build_processing_graph(processors, src_files, resource_classes=None,
+                           node_limits=(None, None), jobs=None):
+    """
+    Builds the graph of processing tasks for the processors to be run.
+    Processors whose inputs all come from the input files or from other
+    per-granule processors get one task per granule, so each granule moves
+    through those steps on its own.  Batch processors, and processors
+    depending on their output, get one task which waits for every task of the
+    processors producing its inputs.  Tasks are only started when the
+    resource classes and node_limits (memory in KB, cores) allow, and tasks
+    creating intermediate files wait while the scratch directory is short of
+    space.  At most jobs tasks (by default, the jobs option) run at once.
+    """
+    scheduler = mlp_resources.ResourceScheduler(
+        jobs or cfg_data.jobs, get_task_program, resource_classes, node_limits[0],
+        node_limits[1], cfg_data.run_history, scratch_has_room)
+    granules = build_granule_file_lists(src_files)
+    run_state = get_run_state()
+    remaining = [0] * len(processors)
+    stage_tasks = []
+    per_granule = []
+    for ndx, proc in enumerate(processors):
+        producers = get_producer_indices(ndx, processors)
+        is_per_granule = not proc.requires_batch_processing() and \
+                         all(per_granule[prod] for prod in producers)
+        per_granule.append(is_per_granule)
+        keys = []
+        if is_per_granule:
+            for gnum, granule in enumerate(granules):
+                deps = [(prod, gnum) for prod in producers]
+                label = '{0} (granule {1} of {2})'.format(proc.target_type,
+                                                        gnum + 1,
+                                                        len(granules))
+                task_data = {'ndx': ndx, 'processors': processors,
+                             'files': granule, 'per_granule': True,
+                             'remaining': remaining, 'run_state': run_state}
+                scheduler.add_task((ndx, gnum), run_processing_task, deps,
+                                   label, task_data)
+                keys.append((ndx, gnum))
+        else:
+            deps = [key for prod in producers for key in stage_tasks[prod]]
+            task_data = {'ndx': ndx, 'processors': processors,
+                         'files': src_files, 'per_granule': False,
+                         'remaining': remaining, 'run_state': run_state}
+            scheduler.add_task((ndx, None), run_processing_task, deps,
+                               proc.target_type, task_data)
+            keys.append((ndx, None))
+        remaining[ndx] = len(keys)
+        stage_tasks.append(keys)
+    return scheduler
+
+def scratch_has_room(task):
+    """
+    Returns False if task would write intermediate files to the scratch
+    directory while it has less than the minimum free space; such tasks wait
+    until the tasks using the files already there finish and they are
+    deleted.
+    """
+    proc = task.data['processors'][task.data['ndx']]
+    if not proc.intermediate or not cfg_data.scratch_dir:
+        return True
+    free_kb = shutil.disk_usage(cfg_data.scratch_dir).free // 1024
+    if free_kb < cfg_data.scratch_min_free:
+        logging.debug('Holding {0}: {1} KB free in {2}.'.format(
+            task.label, free_kb, cfg_data.scratch_dir))
+        return False
+    return True
+
+def get_task_program(task):
+    """
+    Returns the name of the program (target type) run by a processing task.
+    """
+    return task.data['processors'][task.data['ndx']].target_type
+
+def get_resource_classes(processors, main_section):
+    """
+    Takes the resource class settings out of each processor's parameters.
+    Returns a dictionary of the ResourceClass of each program, and the
+    memory (KB) and cores of the machine, which the node_mem_gb and
+    node_cpus settings in the main section of the par file override.
+    """
+    resource_classes = {}
+    try:
+        for proc in processors:
+            res_class = mlp_resources.extract_resource_class(proc.par_data)
+            if not proc.target_type in resource_classes:
+                resource_classes[proc.target_type] = res_class
+        node_mem_kb = mlp_resources.get_node_memory_kb()
+        if 'node_mem_gb' in main_section:
+            node_mem_kb = int(float(main_section['node_mem_gb']) *
+                              mlp_resources.KB_PER_GB)
+        node_cpus = mlp_resources.get_node_cpus()
+        if 'node_cpus' in main_section:
+            node_cpus = int(main_section['node_cpus'])
+    except (mlp_resources.ResourceError, ValueError) as res_err:
+        log_and_exit('Error! {0}'.format(res_err))
+    logging.debug('resource classes: ' + str(resource_classes))
+    return resource_classes, (node_mem_kb, node_cpus)
+
 def build_rules():
     """
     Build the processing rules.
@@ -488,7 +898,8 @@ def clean_files(delete_list):
             sys.stdout.flush()
         os.remove(filepath)
         files_deleted += 1
-    # Delete hidden par files older than the cut off age
+    # Delete hidden par files older than the cut off age.  Another granule
+    # being processed (with --watch) may be deleting them too.
     hidden_files = os.listdir(cfg_data.hidden_dir)
     par_files = [f for f in hidden_files if f.endswith('.par')]
     for par_file in par_files:
@@ -498,7 +909,10 @@ def clean_files(delete_list):
             if cfg_data.verbose:
                 print ('Deleting {0}'.format(par_path))
                 sys.stdout.flush()
-            os.remove(par_path)
+            try:
+                os.remove(par_path)
+            except OSError:
+                continue
             files_deleted += 1
     if cfg_data.verbose:
         if not files_deleted:
@@ -511,6 +925,30 @@ def clean_files(delete_list):
             print ('A total of {0} files were deleted.'.format(files_deleted))
             sys.stdout.flush()
 
+def finish_intermediate_file(out_file, keep):
+    """
+    Disposes of an intermediate file no longer needed for processing: a file
+    to be kept is moved from the scratch directory (if one is used) to the
+    output directory; any other is deleted.
+    """
+    if not os.path.exists(out_file):
+        return
+    if keep:
+        if cfg_data.scratch_dir and \
+           os.path.dirname(os.path.realpath(out_file)) == \
+           os.path.realpath(cfg_data.scratch_dir):
+            dest = os.path.join(cfg_data.output_dir,
+                                os.path.basename(out_file))
+            logging.debug('Moving {0} to {1}'.format(out_file, dest))
+            # shutil.move renames if it can, otherwise copies and deletes.
+            shutil.move(out_file, dest)
+    else:
+        if cfg_data.verbose:
+            print ('Deleting {0}'.format(out_file))
+            sys.stdout.flush()
+        logging.debug('Deleting intermediate file ' + out_file)
+        os.remove(out_file)
+
 def create_levels_list(rules_sets):
     """
     Returns a list containing all the levels from all the rules sets.
@@ -587,12 +1025,14 @@ def create_help_message(rules_sets):
     """
     return message
 
-def do_processing(rules_sets, par_file, cmd_line_ifile=None):
+def do_processing(rules_sets, par_file, cmd_line_ifile=None, jobs=None):
     """
-    Perform the processing for each step (element of processor_list) needed.
+    Perform the processing for each step (element of processor_list) needed,
+    running at most jobs steps at once (by default, the jobs option).
     """
-    global input_file_data
     #todo:  Break this up into smaller parts!
+    run_state = RunState()
+    _thread_data.run_state = run_state
     files_to_keep = []
     files_to_delete = []
     input_files_list = []
@@ -650,6 +1090,16 @@ def do_processing(rules_sets, par_file, cmd_line_ifile=None):
     if len(input_files_list) == 1:
         if MetaUtils.is_ascii_file(input_files_list[0]):
             input_files_list = read_file_list_file(input_files_list[0])
+    if not cfg_data.plan:
+        # One journal for each par file and set of input files, so runs on
+        # other files (e.g. other granules with --watch) leave it alone.
+        run_id = '\n'.join([os.path.realpath(par_file)] +
+                           sorted(os.path.realpath(f)
+                                  for f in input_files_list))
+        journal_name = 'mlp_journal_{0}.jsonl'.format(hashlib.sha1(
+            run_id.encode('utf-8')).hexdigest()[:12])
+        run_state.journal = mlp_checkpoint.StageJournal(
+            os.path.join(cfg_data.hidden_dir, journal_name), cfg_data.resume)
     input_file_data = get_input_files_type_data(input_files_list)
     if not input_file_data:
         log_and_exit('No valid data files were specified for processing.')
@@ -668,98 +1118,97 @@ def do_processing(rules_sets, par_file, cmd_line_ifile=None):
     logging.debug("lowest_source_level: " + str(lowest_src_lvl))
     processors = get_processors(instrument, par_contnts, rules, lowest_src_lvl)
     logging.debug("processors: " + str(processors))
+    resource_classes, node_limits = get_resource_classes(processors,
+                                                         par_contnts['main'])
+    if cfg_data.run_history is None:
+        try:
+            cfg_data.run_history = mlp_resources.RunHistory(
+                mlp_resources.get_default_history_path(cfg_data.hidden_dir))
+        except sqlite3.Error:
+            logging.info('Unable to open the run history database.')
+    if 'geofile' in par_contnts['main']:
+        for proc in processors:
+            proc.geo_file = par_contnts['main']['geofile']
+    for proc in processors:
+        if proc.intermediate and cfg_data.scratch_dir:
+            proc.out_directory = cfg_data.scratch_dir
+        else:
+            proc.out_directory = cfg_data.output_dir
+    if cfg_data.plan:
+        scheduler = build_processing_graph(processors, src_files,
+                                           resource_classes, node_limits, jobs)
+        plan = build_plan(scheduler, processors, src_files, par_file,
+                          instrument)
+        print (json.dumps(plan, indent=2))
+        return
     if cfg_data.tar_filename:
         tar_file = tarfile.open(cfg_data.tar_filename, 'w')
     proc_name_list = ', '.join([p.target_type for p in processors])
     print ('{0}: {1} processors to run: {2}'.format(cfg_data.prog_name,
                                                     len(processors),
                                                     proc_name_list))
-    if 'geofile' in par_contnts['main']:
-        for proc in processors:
-            proc.geo_file = par_contnts['main']['geofile']
     sys.stdout.flush()
-    try:
-        for ndx, proc in enumerate(processors):
-            print ('Running {0}: processor {1} of {2}.'.format(
-                proc.target_type, ndx + 1, len(processors)))
-            logging.debug('')
-            log_msg = 'Processing for {0}:'.format(proc.target_type)
-            logging.debug(log_msg)
-            proc.out_directory = cfg_data.output_dir
-            if cfg_data.timing:
-                proc_timer = benchmark_timer.BenchmarkTimer()
-                proc_timer.start()
-            proc_src_types = proc.rule_set.rules[proc.target_type].src_file_types
-            src_key = None
-            if proc_src_types[0] == 'l1':
-                if 'level 1a' in src_files:
-                    src_key = 'level 1a'
-                elif 'level 1b' in src_files:
-                    src_key = 'level 1b'
-            elif proc_src_types[0] in src_files:
-                src_key = proc_src_types[0]
-            else:
-                for cand_proc in reversed(processors[:ndx]):
-                    if SUFFIXES[cand_proc.target_type] == \
-                       proc.rule_set.rules[proc.target_type].src_file_types[0]:
-                        if cand_proc.target_type in src_files:
-                            src_key = cand_proc.target_type
-                            break
-                if src_key is None:
-                    err_msg = 'Error! Cannot find source files for {0}.'.\
-                              format(proc.target_type)
-                    log_and_exit(err_msg)
-            logging.debug('proc_src_types:')
-            logging.debug('\n  '.join([pst for pst in proc_src_types]))
-            if proc.requires_batch_processing():
-                logging.debug('Performing batch processing for ' + str(proc))
-                out_file = run_batch_processor(ndx, processors,
-                                               src_files[src_key])
-                if proc.target_type in src_files:
-                    if not out_file in src_files[proc.target_type]:
-                        src_files[proc.target_type].append(out_file)
-                else:
-                    src_files[proc.target_type] = [out_file]
-            else:
-                if proc.rule_set.rules[proc.target_type].action:
-                    logging.debug('Performing nonbatch processing for ' +
-                                  str(proc))
-                    src_file_sets = get_source_file_sets(proc_src_types,
-                                                         src_files, src_key,
-                                                         proc.rule_set.rules[proc.target_type].requires_all_sources)
-                    success_count = 0
-                    for file_set in src_file_sets:
-                        out_file = run_nonbatch_processor(ndx, processors, file_set)
-                        if out_file:
-                            success_count += 1
-                            if proc.target_type in src_files:
-                                if not out_file in src_files[proc.target_type]:
-                                    src_files[proc.target_type].append(out_file)
-                            else:
-                                src_files[proc.target_type] = [out_file]
-                    if success_count == 0:
-                        msg = 'The {0} processor produced no output files.'.format(proc.target_type)
-                        logging.info(msg)
+    stage_outputs = [0] * len(processors)
+    # Intermediate files created during this run, each with the keys of the
+    # tasks still to use it and whether it is to be kept.
+    pending_intermediates = {}
+
+    def release_intermediates(task):
+        """
+        Deletes (or, if they are to be kept, moves to the output directory)
+        the intermediate files which every task using them has now finished
+        with.
+        """
+        for out_file in list(pending_intermediates.keys()):
+            users, keep = pending_intermediates[out_file]
+            users.discard(task.key)
+            if not users:
+                del pending_intermediates[out_file]
+                finish_intermediate_file(out_file, keep)
+
+    def record_outputs(task):
+        """
+        Adds the files created by a finished task to the source files so the
+        processors which depend on it can find them.
+        """
+        ndx = task.data['ndx']
+        proc = processors[ndx]
+        out_files, keep = task.result
+        release_intermediates(task)
+        for out_file in out_files:
+            if proc.intermediate and \
+               os.path.realpath(out_file) in run_state.created_files:
+                pending_intermediates[out_file] = \
+                    (set(scheduler.get_dependents(task.key)),
+                     cfg_data.keepfiles or keep)
+            for file_dict in [task.data['files'], src_files]:
+                if proc.target_type in file_dict:
+                    if not out_file in file_dict[proc.target_type]:
+                        file_dict[proc.target_type].append(out_file)
                 else:
-                    msg = '-I- There is no way to create {0} files for {1}.'.format(proc.target_type, proc.instrument)
-                    logging.info(msg)
-            if cfg_data.keepfiles or proc.keepfiles:
-                if out_file:
-                    files_to_keep.append(out_file)
-                    if cfg_data.tar_filename:
-                        tar_file.add(out_file)
-                    logging.debug('Added ' + out_file + ' to tar file list')
-            #todo: add "target" files to files_to_keep and other files to files_to_delete, as appropriate
-            if cfg_data.timing:
-                proc_timer.end()
-                timing_msg = 'Time for {0} process: {1}'.format(
-                    proc.target_type, proc_timer.get_total_time_str())
-                print (timing_msg)
-                logging.info(timing_msg)
-#             print ('{0}: processor {1} of {2} complete.'.format(
-#                 cfg_data.prog_name, ndx + 1, len(processors)))
-            sys.stdout.flush()
+                    file_dict[proc.target_type] = [out_file]
+            if cfg_data.keepfiles or keep:
+                files_to_keep.append(out_file)
+                if cfg_data.tar_filename:
+                    tar_file.add(out_file)
+                logging.debug('Added ' + out_file + ' to tar file list')
+        stage_outputs[ndx] += len(out_files)
+        task.data['remaining'][ndx] -= 1
+        if task.data['remaining'][ndx] == 0:
+            if stage_outputs[ndx] == 0 and \
+               proc.rule_set.rules[proc.target_type].action:
+                msg = 'The {0} processor produced no output files.'.format(
+                    proc.target_type)
+                logging.info(msg)
             logging.debug('Processing complete for "%s".', proc.target_type)
+        sys.stdout.flush()
+
+    run_succeeded = False
+    try:
+        scheduler = build_processing_graph(processors, src_files,
+                                           resource_classes, node_limits, jobs)
+        scheduler.run(record_outputs, mlp_runner.terminate_all)
+        run_succeeded = True
     except Exception:
         if DEBUG:
             err_msg = get_traceback_message()
@@ -771,6 +1220,17 @@ def do_processing(rules_sets, par_file, cmd_line_ifile=None):
         if cfg_data.tar_filename:
             tar_file.close()
             logging.debug('closed tar file')
+        # Intermediate files whose users failed or were skipped are left in
+        # place, so that a run with --resume can pick up from them rather
+        # than running the steps which created them again.
+        if pending_intermediates and not run_succeeded:
+            msg = 'Keeping {0} intermediate file(s) for --resume: {1}'.format(
+                len(pending_intermediates),
+                ', '.join(sorted(pending_intermediates.keys())))
+            logging.info(msg)
+        elif run_succeeded:
+            for out_file, (_, keep) in pending_intermediates.items():
+                finish_intermediate_file(out_file, keep)
         # Since the clean_files function will delete hidden files as well as
         # the files in files_to_delete, it should be called regardless of
         # whether files_to_delete contains anything.
@@ -783,23 +1243,36 @@ def do_processing(rules_sets, par_file, cmd_line_ifile=None):
 
 def execute_command(command):
     """
-    Execute what is contained in command and then output the results to log
-    files and the console, as appropriate.
+    Execute what is contained in command, passing its output to the log
+    files and the console, as appropriate, as it is produced.
     """
     if DEBUG:
         print ("Entering execute_command, cfg_data.verbose =",
                cfg_data.verbose)
         log_msg = 'Executing command:\n  {0}'.format(command)
         logging.debug(log_msg)
-    subproc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    std_out, err_out = subproc.communicate()
-    status = subproc.returncode
-    logging.info(std_out)
-    logging.info(err_out)
-    if cfg_data.verbose:
-        print (std_out)
-    return status
+    prog_name = os.path.basename(command.split()[0]) if command.split() else ''
+
+    def log_line(stream_name, stamp, line):
+        """
+        Logs (and in verbose mode, prints) a line of the command's output.
+        """
+        logging.info('{0} {1}: {2}'.format(stamp, prog_name, line))
+        if cfg_data.verbose and stream_name == 'stdout':
+            print (line)
+            sys.stdout.flush()
+
+    result = mlp_runner.run_command(command, log_line, cfg_data.timeout)
+    if getattr(_thread_data, 'results', None) is not None:
+        _thread_data.results.append(result)
+    if result.timed_out:
+        logging.info('Error! {0} was stopped after exceeding the time limit of {1} seconds.'.\
+                     format(prog_name, cfg_data.timeout))
+    stats_msg = '{0} finished: {1}'.format(prog_name, result)
+    logging.info(stats_msg)
+    if cfg_data.timing:
+        print (stats_msg)
+    return result.status
 
 def extract_par_section(par_contents, section):
     """
@@ -997,7 +1470,8 @@ def get_input_files_type_data(input_files_list):
         #     inp_path = os.path.join(os.getcwd(), inp_file)
         # else:
         #     inp_path = inp_file
-        file_typer = get_obpg_file_type.ObpgFileTyper(inp_file)
+        file_typer = get_obpg_file_type.ObpgFileTyper(inp_file,
+                                                      cfg_data.file_type_cache)
         file_type, file_instr = file_typer.get_file_type()
         #if file_type in converter:
         #    file_type = converter[file_type.lower()]
@@ -1006,6 +1480,12 @@ def get_input_files_type_data(input_files_list):
         # 'Error! Cannot process file type {0} of {1}'.format(file_type,
         #  inp_file)
         if file_type.lower() in converter:
+            run_state = get_run_state()
+            if run_state is not None:
+                stime, etime = file_typer.get_file_times()
+                run_state.data_file_registry.add(obpg_data_file.ObpgDataFile(
+                    inp_file, file_type, file_instr, stime, etime,
+                    file_typer.attributes))
             file_type = converter[file_type.lower()]
             input_file_type_data[inp_file] = (file_type, file_instr.lower())
         else:
@@ -1220,11 +1700,31 @@ def get_processors(instrument, par_contents, rules, lowest_source_level):
             processors.append(proc)
     if processors:
         processors.sort()    # needs sorted for get_intermediate_processors
-        processors += get_intermediate_processors(processors, rules,
-                                                  lowest_source_level)
+        intermediate_processors = get_intermediate_processors(
+            processors, rules, lowest_source_level)
+        for proc in intermediate_processors:
+            proc.intermediate = True
+        processors += intermediate_processors
         processors.sort()
     return processors
 
+def get_producer_indices(ndx, processors):
+    """
+    Returns the indices of the processors (preceding processors[ndx]) which
+    create files that processors[ndx] may use as input.
+    """
+    proc = processors[ndx]
+    src_types = proc.rule_set.rules[proc.target_type].src_file_types
+    wanted_types = set(src_types)
+    if 'l1' in wanted_types:
+        wanted_types.update(['level 1a', 'level 1b'])
+    producers = []
+    for cand_ndx, cand_proc in enumerate(processors[:ndx]):
+        if cand_proc.target_type in wanted_types or \
+           SUFFIXES.get(cand_proc.target_type) == src_types[0]:
+            producers.append(cand_ndx)
+    return producers
+
 def get_required_programs(target_program, ruleset, lowest_source_level):
     """
     Returns the programs required too produce the desired final output.
@@ -1341,6 +1841,30 @@ def get_source_files(input_files):
             source_files[ftype] = [file_path]
     return source_files
 
+def get_source_key(ndx, processors, src_files):
+    """
+    Returns the key of src_files holding the files processors[ndx] should
+    use as input, or None if no such files are available.
+    """
+    proc = processors[ndx]
+    proc_src_types = proc.rule_set.rules[proc.target_type].src_file_types
+    src_key = None
+    if proc_src_types[0] == 'l1':
+        if 'level 1a' in src_files:
+            src_key = 'level 1a'
+        elif 'level 1b' in src_files:
+            src_key = 'level 1b'
+    elif proc_src_types[0] in src_files:
+        src_key = proc_src_types[0]
+    else:
+        for cand_proc in reversed(processors[:ndx]):
+            if SUFFIXES[cand_proc.target_type] == \
+               proc.rule_set.rules[proc.target_type].src_file_types[0]:
+                if cand_proc.target_type in src_files:
+                    src_key = cand_proc.target_type
+                    break
+    return src_key
+
 def get_source_products_types(targt_prod, ruleset):
     """
     Return the list of source product types needed to produce the final product.
@@ -1407,14 +1931,30 @@ def main():
         cfg_data = ProcessorConfig('.seadas_data', os.getcwd(),
                                    options.verbose, options.overwrite,
                                    options.use_existing, options.tar_file,
-                                   options.timing, options.odir)
+                                   options.timing, options.odir, options.jobs,
+                                   options.resume, options.timeout,
+                                   options.getanc_subprocess, options.plan)
+        cfg_data.offline_anc = options.offline_anc
+        if options.scratch_dir:
+            cfg_data.scratch_dir = os.path.realpath(options.scratch_dir)
+            cfg_data.scratch_min_free = int(options.scratch_min_free *
+                                            mlp_resources.KB_PER_GB)
+        if not options.no_cache:
+            cfg_data.file_type_cache = file_type_cache.get_default_cache(
+                options.refresh_cache)
         if not os.access(cfg_data.hidden_dir, os.R_OK):
             log_and_exit("Error!  The working directory is not readable!")
         if os.path.exists(args[0]):
             log_timestamp = datetime.datetime.today().strftime('%Y%m%d%H%M%S')
             start_logging(log_timestamp)
+            # Shut down as for an interrupt, so the programs running are
+            # stopped and (with --watch) the granule being processed is
+            # returned to the queue.
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
             try:
-                if cfg_data.timing:
+                if options.watch:
+                    run_watch_loop(rules_sets, args[0], options)
+                elif cfg_data.timing:
                     main_timer = benchmark_timer.BenchmarkTimer()
                     main_timer.start()
                     do_processing(rules_sets, args[0])
@@ -1451,25 +1991,73 @@ def process_command_line(cl_parser):
     """
     cl_parser.add_option('--debug', action='store_true', dest='debug',
                          default=False, help=optparse.SUPPRESS_HELP)
+    cl_parser.add_option('-j', '--jobs', action='store', type='int',
+                         dest='jobs', default=1,
+                         help='number of granules/processing steps to run concurrently (default = 1)')
     cl_parser.add_option('-k', '--keepfiles', action='store_true',
                          dest='keepfiles', default=False,
                          help='keep files created during processing')
+    cl_parser.add_option('--getanc_subprocess', action='store_true',
+                         dest='getanc_subprocess', default=False,
+                         help='run getanc.py as a separate program for each granule')
     cl_parser.add_option('--ifile', action='store', type='string',
                          dest='ifile', help="input file")
+    cl_parser.add_option('--offline_anc', action='store_true',
+                         dest='offline_anc', default=False,
+                         help='choose ancillary files from the local ancillary directory tree, without querying the server')
+    cl_parser.add_option('--no_cache', action='store_true',
+                         dest='no_cache', default=False,
+                         help='do not use the file type cache')
+    cl_parser.add_option('--lease', action='store', type='int',
+                         dest='lease', default=mlp_queue.DEFAULT_LEASE,
+                         help='with --watch, seconds a claimed granule is reserved for this process before it may be claimed by another (renewed while processing; default = %default)')
+    cl_parser.add_option('--max_attempts', action='store', type='int',
+                         dest='max_attempts', default=mlp_queue.MAX_ATTEMPTS,
+                         help='with --watch, times a granule is tried (after failures or lost leases) before it is left as failed (default = %default)')
     cl_parser.add_option('--output_dir', '--odir',
                          action='store', type='string', dest='odir',
                          help="user specified directory for output")
     cl_parser.add_option('--overwrite', action='store_true',
                          dest='overwrite', default=False,
                          help='overwrite files which already exist (default = stop processing if file already exists)')
+    cl_parser.add_option('--plan', action='store_true',
+                         dest='plan', default=False,
+                         help='print (as JSON) the processing which would be done, with estimated run times, without running anything')
+    cl_parser.add_option('--poll_interval', action='store', type='int',
+                         dest='poll_interval', default=60,
+                         help='with --watch, seconds between scans of the watched directory; files modified more recently than this are not queued yet (default = %default)')
+    cl_parser.add_option('--queue_db', action='store', type='string',
+                         dest='queue_db',
+                         help='with --watch, the queue database (default = ' + mlp_queue.DEFAULT_QUEUE_NAME + ' in the watched directory)')
+    cl_parser.add_option('--refresh_cache', action='store_true',
+                         dest='refresh_cache', default=False,
+                         help='ignore and replace cached file type results')
+    cl_parser.add_option('--resume', action='store_true',
+                         dest='resume', default=False,
+                         help='skip steps whose inputs, parameters and outputs are unchanged since the last run')
+    cl_parser.add_option('--scratch_dir', action='store', type='string',
+                         dest='scratch_dir',
+                         help='directory (e.g. on fast local disk) for intermediate files, which are deleted, or moved to the output directory if kept, once no longer needed')
+    cl_parser.add_option('--scratch_min_free', action='store', type='float',
+                         dest='scratch_min_free', default=1.0,
+                         help='with --scratch_dir, free space (GB) below which steps writing to it wait (default = %default)')
     cl_parser.add_option('-t', '--tar', type=str, dest='tar_file',
                          help=optparse.SUPPRESS_HELP)
+    cl_parser.add_option('--timeout', action='store', type='float',
+                         dest='timeout', default=None,
+                         help='seconds after which a program still running is stopped (default = no limit)')
     cl_parser.add_option('--timing', dest='timing', action='store_true',
                          default=False,
                          help='report time required to run each program and total')
     cl_parser.add_option('--use_existing', action='store_true',
                          dest='use_existing', default=False,
                          help='use files which already exist (default = stop processing if file already exists)')
+    cl_parser.add_option('--watch', action='store', type='string',
+                         dest='watch',
+                         help='run as a service, processing the files arriving in the WATCH directory')
+    cl_parser.add_option('--watch_pattern', action='store', type='string',
+                         dest='watch_pattern', default='*',
+                         help='with --watch, only process files matching this pattern (default = %default)')
     cl_parser.add_option('-v', '--verbose',
                          action='store_true', dest='verbose', default=False,
                          help='print status messages to stdout')
@@ -1478,6 +2066,21 @@ def process_command_line(cl_parser):
     for ndx, cl_arg in enumerate(args):
         if cl_arg.startswith('par='):
             args[ndx] = cl_arg.lstrip('par=')
+    if options.jobs < 1:
+        log_and_exit('Error!  The jobs option must be at least 1.')
+    if options.timeout is not None and options.timeout <= 0:
+        log_and_exit('Error!  The timeout option must be greater than 0.')
+    if options.scratch_dir and not (os.path.isdir(options.scratch_dir) and
+                                    os.access(options.scratch_dir, os.W_OK)):
+        log_and_exit('Error!  Scratch directory {0} is not a writable directory.'.\
+                     format(options.scratch_dir))
+    if options.watch:
+        if not os.path.isdir(options.watch):
+            log_and_exit('Error!  {0} is not a directory.'.format(options.watch))
+        if options.ifile or options.plan:
+            log_and_exit('Error!  Option watch cannot be used with ifile or plan.')
+        if options.poll_interval < 1 or options.lease < 1:
+            log_and_exit('Error!  The poll_interval and lease options must be at least 1.')
     if options.overwrite and options.use_existing:
         log_and_exit('Error!  Options overwrite and use_existing cannot be ' + \
                      'used simultaneously.')
@@ -1504,47 +2107,162 @@ def read_file_list_file(flf_name):
         log_and_exit(err_msg)
     return files_list
 
-def run_batch_processor(ndx, processors, file_set):
+def process_queued_granule(rules_sets, par_file, queue, granule, owner,
+                           jobs=None, stopping=None):
+    """
+    Processes a granule claimed from the work queue, renewing the lease on it
+    until processing is finished, then records the outcome in the queue.  If
+    stopping (a threading.Event) is set by then, the granule was interrupted,
+    so it is returned to the queue rather than recorded as failed.
+    """
+    stop_renewing = threading.Event()
+
+    def renew_lease():
+        """
+        Renews the lease at intervals while the granule is being processed.
+        """
+        while not stop_renewing.wait(queue.lease / 3.0):
+            if not queue.renew(granule, owner):
+                logging.info('Warning! Lost the lease on {0}.'.format(granule))
+                return
+
+    renewer = threading.Thread(target=renew_lease)
+    renewer.daemon = True
+    renewer.start()
+    success = False
+    message = None
+    try:
+        do_processing(rules_sets, par_file, granule, jobs)
+        success = True
+    except KeyboardInterrupt:
+        stop_renewing.set()
+        renewer.join()
+        queue.release(granule, owner)
+        raise
+    except SystemExit as exc:
+        message = str(exc.code)
+    except Exception:
+        message = get_traceback_message()
+    stop_renewing.set()
+    renewer.join()
+    if stopping is not None and stopping.is_set() and not success:
+        queue.release(granule, owner)
+        logging.info('Returned {0} to the queue.'.format(granule))
+        return False
+    state = queue.finish(granule, owner, success, message)
+    if success:
+        logging.info('Finished processing {0}.'.format(granule))
+    elif state == mlp_queue.PENDING:
+        logging.info('Error! Processing {0} failed (to be retried): {1}'.\
+                     format(granule, message))
+    else:
+        logging.info('Error! Processing {0} failed: {1}'.format(granule,
+                                                               message))
+    return success
+
+def run_watch_loop(rules_sets, par_file, options):
+    """
+    Runs as a service: new files in the watched directory are added to the
+    work queue, and queued granules are claimed and processed, up to the jobs
+    option at once, until interrupted.  The rules, caches, HTTP session and
+    ancillary database connection are kept between granules.
+    """
+    watch_dir = os.path.realpath(options.watch)
+    if options.queue_db:
+        queue_file = options.queue_db
+    else:
+        queue_file = os.path.join(watch_dir, mlp_queue.DEFAULT_QUEUE_NAME)
+    if os.path.realpath(cfg_data.output_dir) == watch_dir:
+        log_and_exit('Error!  The output directory cannot be the watched directory.')
+    queue = mlp_queue.WorkQueue(queue_file, options.lease,
+                                options.max_attempts)
+    owner = mlp_queue.get_worker_id()
+    msg = '{0} watching {1} as {2}; queue: {3}'.format(cfg_data.prog_name,
+                                                       watch_dir, owner,
+                                                       queue_file)
+    logging.info(msg)
+    print (msg)
+    sys.stdout.flush()
+    stopping = threading.Event()
+    # future: granule, for the granules being processed
+    running = {}
+    # Each granule is processed one step at a time, the jobs option
+    # setting how many granules are processed at once.
+    pool = concurrent.futures.ThreadPoolExecutor(cfg_data.jobs)
+    try:
+        while True:
+            added = mlp_queue.scan_directory(watch_dir, queue,
+                                             options.watch_pattern,
+                                             options.poll_interval)
+            for granule in added:
+                logging.info('Queued ' + granule)
+            while len(running) < cfg_data.jobs:
+                granule = queue.claim(owner)
+                if granule is None:
+                    break
+                print ('Processing ' + granule)
+                sys.stdout.flush()
+                running[pool.submit(process_queued_granule, rules_sets,
+                                    par_file, queue, granule, owner, 1,
+                                    stopping)] = granule
+            if not running:
+                time.sleep(options.poll_interval)
+                continue
+            # Wait for a granule to finish, or until it is time to look for
+            # new files.
+            finished, _ = concurrent.futures.wait(
+                running, timeout=options.poll_interval,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                granule = running.pop(future)
+                if future.exception() is not None:
+                    logging.info('Error! Processing {0} failed: {1}'.format(
+                        granule, future.exception()))
+    except KeyboardInterrupt:
+        # The granules being processed are returned to the queue once the
+        # programs running for them have been stopped.
+        stopping.set()
+        mlp_runner.terminate_all()
+        pool.shutdown(wait=True)
+        logging.info('Stopped watching {0}; queue status: {1}'.\
+                     format(watch_dir, queue.get_counts()))
+    finally:
+        pool.shutdown(wait=True)
+        queue.close()
+
+def run_batch_processor(proc, file_set):
     """
     Run a processor, e.g. l2bin, which processes batches of files.
     """
-    logging.debug('in run_batch_processor, ndx = %d', ndx)
+    logging.debug('in run_batch_processor, proc = %s', str(proc))
     if os.path.exists((file_set[0])) and tarfile.is_tarfile(file_set[0]):
-        processors[ndx].input_file = file_set[0]
+        proc.input_file = file_set[0]
     else:
         timestamp = time.strftime('%Y%m%d_%H%M%S', time.gmtime(time.time()))
-        file_list_name = cfg_data.hidden_dir + os.sep + 'files_' + \
-                         processors[ndx].target_type + '_' + timestamp + '.lis'
-        with open(file_list_name, 'wt') as file_list:
+        list_fd, file_list_name = tempfile.mkstemp(
+            dir=cfg_data.hidden_dir, suffix='.lis',
+            prefix='files_' + proc.target_type + '_' + timestamp + '_')
+        with os.fdopen(list_fd, 'wt') as file_list:
             for fname in file_set:
                 file_list.write(fname + '\n')
-        processors[ndx].input_file = file_list_name
+        proc.input_file = file_list_name
     data_file_list = []
-    finder_opts = {}
     for fspec in file_set:
         dfile = get_obpg_data_file_object(fspec)
         data_file_list.append(dfile)
-    if 'suite' in processors[ndx].par_data:
-        finder_opts['suite'] = processors[ndx].par_data['suite']
-    elif 'prod' in processors[ndx].par_data:
-        finder_opts['suite'] = processors[ndx].par_data['prod']
-    if 'resolution' in processors[ndx].par_data:
-        finder_opts['resolution'] = processors[ndx].par_data['resolution']
-    if 'oformat' in processors[ndx].par_data:
-        finder_opts['oformat'] = processors[ndx].par_data['oformat']
-    name_finder = name_finder_utils.get_level_finder(data_file_list,
-                                                     processors[ndx].target_type,
-                                                     finder_opts)
-    processors[ndx].output_file = os.path.join(processors[ndx].out_directory,
+    name_finder = name_finder_utils.get_level_finder(
+        data_file_list, proc.target_type, get_name_finder_options(proc))
+    proc.output_file = os.path.join(proc.out_directory,
                                                name_finder.get_next_level_name())
     if DEBUG:
         log_msg = "Running {0} with input file {1} to generate {2} ".\
-                  format(processors[ndx].target_type,
-                         processors[ndx].input_file,
-                         processors[ndx].output_file)
+                  format(proc.target_type,
+                         proc.input_file,
+                         proc.output_file)
         logging.debug(log_msg)
-    processors[ndx].execute()
-    return processors[ndx].output_file
+    execute_processor(proc, file_set)
+    register_output_file(proc.output_file)
+    return proc.output_file
 
 def run_bottom_error(proc):
     """
@@ -1747,15 +2465,39 @@ def run_l2extract(proc):
         err_msg = 'Error! Geographical coordinates not specified for l2extract.'
         log_and_exit(err_msg)
 
+def get_anc_files(input_file):
+    """
+    Finds (downloading as needed) the ancillary files for input_file and
+    writes its .anc file, as getanc.py does, but within this process, so
+    that every granule shares the one HTTP session and ancillary database
+    connection.  Returns the getanc status.
+    """
+    with _getanc_lock:
+        # Start the session here, so concurrent granules don't each open one.
+        ProcUtils.getSession()
+    anc_getter = anc_utils.getanc(file=input_file, opt_flag=5,
+                                  verbose=1 if cfg_data.verbose else 0,
+                                  printlist=cfg_data.verbose, shared_db=True,
+                                  offline=cfg_data.offline_anc)
+    logging.debug('running getanc for ' + input_file)
+    status = anc_utils.resolve(anc_getter)
+    logging.info('getanc status for {0}: {1}'.format(input_file, status))
+    return status
+
 def run_l2gen(proc):
     """
     Set up for and perform L2 processing.
     """
     if cfg_data.get_anc:
-        getanc_prog = build_executable_path('getanc.py')
-        getanc_cmd = ' '.join([getanc_prog, proc.input_file])
-        logging.debug('running getanc command: ' + getanc_cmd)
-        execute_command(getanc_cmd)
+        if cfg_data.getanc_subprocess:
+            getanc_prog = build_executable_path('getanc.py')
+            getanc_cmd = ' '.join([getanc_prog, proc.input_file])
+            if cfg_data.offline_anc:
+                getanc_cmd += ' --offline'
+            logging.debug('running getanc command: ' + getanc_cmd)
+            execute_command(getanc_cmd)
+        else:
+            get_anc_files(proc.input_file)
     l2gen_prog = os.path.join(proc.ocssw_bin, 'l2gen')
     if not os.path.exists(l2gen_prog):
         print ("Error!  Cannot find executable needed for {0}".\
@@ -1915,7 +2657,7 @@ def run_modis_l1b(proc):
     logging.debug("\nRunning: " + cmd)
     return execute_command(cmd)
 
-def run_nonbatch_processor(ndx, processors, file_set):
+def run_nonbatch_processor(proc, file_set):
     """
     Run a processor which deals with single input files (or pairs of files in
     the case of MODIS L1B processing in which GEO files are also needed).
@@ -1927,55 +2669,104 @@ def run_nonbatch_processor(ndx, processors, file_set):
         input_file = file_set
         geo_file = None
     dfile = get_obpg_data_file_object(input_file)
-
-    cl_opts = optparse.Values()
-    if 'suite' in processors[ndx].par_data:
-        cl_opts.suite = processors[ndx].par_data['suite']
-    elif 'prod' in processors[ndx].par_data:
-        cl_opts.suite = processors[ndx].par_data['prod']
-    else:
-        cl_opts.suite = None
-    if 'resolution' in processors[ndx].par_data:
-        cl_opts.resolution = processors[ndx].par_data['resolution']
-    else:
-        cl_opts.resolution = None
-    if 'oformat' in processors[ndx].par_data:
-        cl_opts.oformat = processors[ndx].par_data['oformat']
-    else:
-        cl_opts.oformat = None
-    name_finder = name_finder_utils.get_level_finder([dfile],
-                                                     processors[ndx].target_type,
-                                                     cl_opts)
-    output_file = os.path.join(processors[ndx].out_directory,
+    name_finder = name_finder_utils.get_level_finder(
+        [dfile], proc.target_type, get_name_finder_options(proc))
+    output_file = os.path.join(proc.out_directory,
                                name_finder.get_next_level_name())
     if DEBUG:
         print ('in run_nonbatch_processor, output_file = ' + output_file)
-    processors[ndx].input_file = input_file
-    processors[ndx].output_file = output_file
-    processors[ndx].geo_file = geo_file
-    if 'keepfiles' in processors[ndx].par_data:
-        if processors[ndx].par_data['keepfiles']:     # != 0:
-            processors[ndx].keepfiles = True
-    if (not os.path.exists(output_file)) or cfg_data.overwrite:
+    proc.input_file = input_file
+    proc.output_file = output_file
+    proc.geo_file = geo_file
+    if 'keepfiles' in proc.par_data:
+        if proc.par_data['keepfiles']:     # != 0:
+            proc.keepfiles = True
+    input_files = [input_file]
+    if geo_file:
+        input_files.append(geo_file)
+    # When resuming, an existing output is left to the journal to check only
+    # if the journal knows the step; otherwise the usual rules apply.
+    if (not os.path.exists(output_file)) or cfg_data.overwrite or \
+       (cfg_data.resume and journal_has_step(proc, input_files)):
         if cfg_data.verbose:
             print ()
-            print ('\nRunning ' + str(processors[ndx]))
+            print ('\nRunning ' + str(proc))
             sys.stdout.flush()
-        proc_status = processors[ndx].execute()
+        proc_status = execute_processor(proc, input_files)
 
         if proc_status:
             output_file = None
             msg = "Error! Status {0} was returned during {1} {2} processing.".\
-                  format(proc_status, processors[ndx].instrument,
-                         processors[ndx].target_type)
+                  format(proc_status, proc.instrument,
+                         proc.target_type)
             # log_and_exit(msg)
             logging.info(msg)
             # Todo: remove the failed file from future processing
+        else:
+            register_output_file(output_file)
     elif not cfg_data.use_existing:
         log_and_exit('Error! Target file {0} already exists.'.\
                      format(output_file))
     return output_file
 
+def run_processing_task(task):
+    """
+    Runs one node of the processing graph: a processor applied either to a
+    single granule's files or, for batch processors and their dependents, to
+    all files created so far.  Returns a tuple of the list of files created
+    and whether they are to be kept.
+    """
+    ndx = task.data['ndx']
+    processors = task.data['processors']
+    src_files = task.data['files']
+    _thread_data.run_state = task.data['run_state']
+    proc = copy.copy(processors[ndx])
+    print ('Running {0}: processor {1} of {2}.'.format(
+        task.label, ndx + 1, len(processors)))
+    logging.debug('')
+    logging.debug('Processing for {0}:'.format(task.label))
+    out_files = []
+    if cfg_data.timing:
+        proc_timer = benchmark_timer.BenchmarkTimer()
+        proc_timer.start()
+    proc_src_types = proc.rule_set.rules[proc.target_type].src_file_types
+    src_key = get_source_key(ndx, processors, src_files)
+    if src_key is None:
+        if task.data['per_granule']:
+            msg = 'No source files available for {0}; skipping.'.format(
+                task.label)
+            logging.info(msg)
+            return out_files, False
+        err_msg = 'Error! Cannot find source files for {0}.'.\
+                  format(proc.target_type)
+        log_and_exit(err_msg)
+    logging.debug('proc_src_types:')
+    logging.debug('\n  '.join([pst for pst in proc_src_types]))
+    if proc.requires_batch_processing():
+        logging.debug('Performing batch processing for ' + str(proc))
+        out_file = run_batch_processor(proc, sorted(src_files[src_key]))
+        out_files.append(out_file)
+    elif proc.rule_set.rules[proc.target_type].action:
+        logging.debug('Performing nonbatch processing for ' + str(proc))
+        src_file_sets = get_source_file_sets(proc_src_types, src_files, src_key,
+                                             proc.rule_set.rules[proc.target_type].requires_all_sources)
+        for file_set in src_file_sets:
+            out_file = run_nonbatch_processor(proc, file_set)
+            if out_file:
+                out_files.append(out_file)
+    else:
+        msg = '-I- There is no way to create {0} files for {1}.'.format(
+            proc.target_type, proc.instrument)
+        logging.info(msg)
+    if cfg_data.timing:
+        proc_timer.end()
+        timing_msg = 'Time for {0} process: {1}'.format(
+            task.label, proc_timer.get_total_time_str())
+        print (timing_msg)
+        logging.info(timing_msg)
+    sys.stdout.flush()
+    return out_files, proc.keepfiles
+
 def run_script(proc, script_name):
     """
     Build the command to run the processing script which is passed in.
@@ -2072,6 +2863,8 @@ DEBUG = False
 #DEBUG = True
 
 cfg_data = None
+_getanc_lock = threading.Lock()
+_thread_data = threading.local()
 FILE_USE_OPTS = ['keepfiles', 'overwrite', 'use_existing']
 SUFFIXES = {
     'geo': 'GEO',
@@ -2090,7 +2883,6 @@ SUFFIXES = {
     'level 1b': 'L1B_LAC',
     'smigen': 'SMI'
 }
-input_file_data = {}
 #verbose = False
 
 if os.environ['OCSSWROOT']:
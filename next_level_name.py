@@ -14,6 +14,7 @@ import traceback
 import aquarius_next_level_name_finder
 import get_obpg_file_type
 import MetaUtils
+import modules.file_type_cache as file_type_cache
 #import namer_constants
 import name_finder_utils
 import next_level_name_finder
@@ -99,6 +100,12 @@ def get_command_line_data():
                          help='resolution for smigen/l3mapgen')
     cl_parser.add_option('--suite', dest='suite', action='store',
                          type='string', help='data type suite')
+    cl_parser.add_option('--no-cache', action='store_true',
+                         dest='no_cache', default=False,
+                         help='do not use the file type cache')
+    cl_parser.add_option('--refresh-cache', action='store_true',
+                         dest='refresh_cache', default=False,
+                         help='ignore and replace cached file type results')
     # cl_parser.add_option('--product', dest='product', action='store',
     #                      type='string', help='product type (for smigen)')
     (clopts, clargs) = cl_parser.parse_args()
@@ -117,9 +124,10 @@ def get_command_line_data():
     else:
         return clopts, clargs[0], clargs[1]
 
-def get_data_files_info(file_list_file):
+def get_data_files_info(file_list_file, cache=None):
     """
-    Returns a list of of data files.
+    Returns a list of of data files, typed using cache (a
+    file_type_cache.FileTypeCache) if given.
     """
     file_info = []
     with open(file_list_file, 'rt') as file_list_file:
@@ -127,7 +135,7 @@ def get_data_files_info(file_list_file):
     for line in inp_lines:
         filename = line.strip()
         if os.path.exists(filename):
-            file_typer = get_obpg_file_type.ObpgFileTyper(filename)
+            file_typer = get_obpg_file_type.ObpgFileTyper(filename, cache)
             file_type, sensor = file_typer.get_file_type()
             if file_type != 'unknown':
                 stime, etime = file_typer.get_file_times()
@@ -169,14 +177,17 @@ def main():
         err_msg = 'Error!  The target program, "{0}", is not known.'.\
                   format(targ_prog)
         sys.exit(err_msg)
+    cache = None
+    if not clopts.no_cache:
+        cache = file_type_cache.get_default_cache(clopts.refresh_cache)
     if os.path.exists(inp_name):
         try:
-            file_typer = get_obpg_file_type.ObpgFileTyper(inp_name)
+            file_typer = get_obpg_file_type.ObpgFileTyper(inp_name, cache)
             ftype, sensor = file_typer.get_file_type()
             if ftype == 'unknown':
                 if MetaUtils.is_ascii_file(inp_name):
                     # Try treating the input file as a file list file.
-                    data_files_info = get_data_files_info(inp_name)
+                    data_files_info = get_data_files_info(inp_name, cache)
                     if len(data_files_info) > 0:
                         next_level_name = get_multifile_next_level_name(
                             data_files_info, targ_prog, clopts)
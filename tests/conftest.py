@@ -0,0 +1,12 @@
+"""
+Puts the scripts directory (and so the modules package) and the modules
+directory on the path.
+"""
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the modules also import each other by their bare names
+sys.path.insert(0, os.path.join(ROOT_DIR, 'modules'))
+sys.path.insert(0, ROOT_DIR)
@@ -0,0 +1,106 @@
+"""
+A stub HTTP server for the download and cache tests, serving bodies set by
+the test from a thread.  It answers conditional requests (If-None-Match,
+Range with If-Range) as a real server would, and records the method, path and
+headers of each request it receives.
+"""
+
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class StubResource(object):
+    """
+    A body served at one path.  content_length, if set, replaces the real
+    length in the Content-Length header (to simulate a truncated transfer).
+    """
+    def __init__(self, body, etag=None, last_modified=None,
+                 content_length=None, ranges=True):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_length = content_length
+        self.ranges = ranges
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _validator_matches(self, resource, value):
+        return value in (resource.etag, resource.last_modified)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def _respond(self, send_body):
+        stub = self.server.stub
+        stub.requests.append((self.command, self.path,
+                              dict(self.headers.items())))
+        resource = stub.resources.get(self.path)
+        if resource is None:
+            self.send_error(404)
+            return
+        if resource.etag and \
+           self.headers.get('If-None-Match') == resource.etag:
+            self.send_response(304)
+            self.send_header('ETag', resource.etag)
+            self.end_headers()
+            return
+
+        body = resource.body
+        status = 200
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if resource.ranges and range_header and \
+           (if_range is None or self._validator_matches(resource, if_range)):
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start < len(body):
+                status = 206
+                body = body[start:]
+        self.send_response(status)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, len(resource.body) - 1, len(resource.body)))
+        if resource.etag:
+            self.send_header('ETag', resource.etag)
+        if resource.last_modified:
+            self.send_header('Last-Modified', resource.last_modified)
+        if resource.content_length is not None:
+            length = resource.content_length - (len(resource.body) - len(body))
+        else:
+            length = len(body)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+class StubServer(object):
+    """
+    The server, listening on a free port on localhost until stop is called.
+    """
+    def __init__(self):
+        self.resources = {}
+        self.requests = []
+        self.httpd = HTTPServer(('127.0.0.1', 0), _Handler)
+        self.httpd.stub = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{0}{1}'.format(self.httpd.server_port, path)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,119 @@
+"""
+Tests for modules.http_cache.HttpCache, against a stub server.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import requests
+
+import modules.http_cache as http_cache
+from http_stub import StubResource, StubServer
+
+
+class HttpCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = StubServer()
+        self.session = requests.Session()
+        self.cache = http_cache.HttpCache(os.path.join(self.tmp_dir, 'cache'))
+
+    def tearDown(self):
+        self.cache.close()
+        self.session.close()
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def fetch(self, path, stream=False):
+        return self.cache.fetch(self.session, self.server.url(path),
+                                timeout=10, stream=stream)
+
+    def test_revalidation(self):
+        self.server.resources['/list'] = StubResource(b'listing', etag='"v1"')
+        response = self.fetch('/list')
+        self.assertEqual(response.content, b'listing')
+        self.assertNotIn('If-None-Match', self.server.requests[-1][2])
+
+        response = self.fetch('/list')
+        self.assertIsInstance(response, http_cache.CachedResponse)
+        self.assertEqual(response.content, b'listing')
+        self.assertEqual(self.server.requests[-1][2]['If-None-Match'], '"v1"')
+        self.assertEqual(self.cache.get_stats()['hits'], 1)
+
+        # a changed response replaces the stored one
+        self.server.resources['/list'] = StubResource(b'new listing',
+                                                      etag='"v2"')
+        response = self.fetch('/list')
+        self.assertNotIsInstance(response, http_cache.CachedResponse)
+        self.assertEqual(response.content, b'new listing')
+        self.assertEqual(self.fetch('/list').content, b'new listing')
+        self.assertEqual(self.cache.get_stats(),
+                         {'hits': 2, 'misses': 2, 'stale': 0, 'evicted': 0})
+
+    def test_streamed_response_stored(self):
+        self.server.resources['/list'] = StubResource(b'x' * 10000,
+                                                      etag='"v1"')
+        response = self.fetch('/list', stream=True)
+        self.assertEqual(b''.join(response.iter_content(1024)), b'x' * 10000)
+        response.close()
+        response = self.fetch('/list', stream=True)
+        self.assertIsInstance(response, http_cache.CachedResponse)
+        self.assertEqual(len(response.content), 10000)
+
+    def test_not_cacheable(self):
+        self.server.resources['/list'] = StubResource(b'listing')
+        self.fetch('/list')
+        self.fetch('/list')
+        self.assertNotIn('If-None-Match', self.server.requests[-1][2])
+        self.assertEqual(self.cache.get_stats()['misses'], 2)
+
+    def test_lru_eviction(self):
+        self.cache.max_bytes = 250
+        for path in ('/a', '/b', '/c'):
+            self.server.resources[path] = StubResource(b'x' * 100,
+                                                       etag='"' + path + '"')
+        self.fetch('/a')
+        self.fetch('/b')
+        self.fetch('/a')            # /a is now more recently used than /b
+        self.fetch('/c')
+        self.assertEqual(self.cache.get_stats()['evicted'], 1)
+        self.assertIsInstance(self.fetch('/a'), http_cache.CachedResponse)
+        self.assertNotIsInstance(self.fetch('/b'), http_cache.CachedResponse)
+        bodies = [name for name in os.listdir(self.cache.cache_dir)
+                  if name != 'index.db']
+        self.assertEqual(len(bodies), 2)
+
+    def test_list_and_purge(self):
+        for path in ('/a', '/b'):
+            self.server.resources[path] = StubResource(b'x' * 10,
+                                                       etag='"' + path + '"')
+            self.fetch(path)
+        self.assertEqual([(url, size) for url, size, stored, last_used
+                          in self.cache.list_entries()],
+                         [(self.server.url('/b'), 10),
+                          (self.server.url('/a'), 10)])
+        # a body left by an interrupted write
+        open(self.cache._tmp_path(self.server.url('/c')), 'w').close()
+        self.assertEqual(self.cache.purge(), 2)
+        self.assertEqual(self.cache.list_entries(), [])
+        self.assertEqual(os.listdir(self.cache.cache_dir), ['index.db'])
+        self.assertNotIsInstance(self.fetch('/a'), http_cache.CachedResponse)
+
+    def test_stale_if_error(self):
+        self.server.resources['/list'] = StubResource(b'listing', etag='"v1"')
+        self.fetch('/list')
+        url = self.server.url('/list')
+        self.server.stop()
+        self.assertRaises(IOError, self.cache.fetch, self.session, url, 5)
+        self.cache.stale_if_error = True
+        response = self.cache.fetch(self.session, url, 5)
+        self.assertTrue(response.stale)
+        self.assertEqual(response.content, b'listing')
+        self.server = StubServer()
+
+
+if __name__ == '__main__':
+    unittest.main()
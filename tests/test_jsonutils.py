@@ -0,0 +1,65 @@
+"""
+Tests for JsonUtils.needs_download, against a stub server.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import JsonUtils
+from http_stub import StubResource, StubServer
+
+MODIFIED = 'Mon, 05 Oct 2026 10:00:00 GMT'
+
+
+class NeedsDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = StubServer()
+        self.server.resources['/lut.hdf'] = StubResource(
+            b'x' * 100, last_modified=MODIFIED)
+        self.filepath = os.path.join(self.tmp_dir, 'lut.hdf')
+        with open(self.filepath, 'wb') as lut:
+            lut.write(b'x' * 100)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def link(self, size=None, mtime=None):
+        return {'href': self.server.url('/lut.hdf'), 'size': size,
+                'mtime': mtime}
+
+    def test_from_listing(self):
+        now = time.time()
+        self.assertFalse(JsonUtils.needs_download(self.link(100, now - 60),
+                                                  self.filepath, True))
+        self.assertTrue(JsonUtils.needs_download(self.link(100, now + 60),
+                                                 self.filepath, True))
+        self.assertTrue(JsonUtils.needs_download(self.link(99),
+                                                 self.filepath))
+        self.assertEqual(self.server.requests, [])
+
+    def test_missing_values_from_header(self):
+        self.assertFalse(JsonUtils.needs_download(self.link(), self.filepath,
+                                                  True))
+        self.assertEqual(self.server.requests[-1][0], 'HEAD')
+        self.server.resources['/lut.hdf'] = StubResource(
+            b'x' * 200, last_modified=MODIFIED)
+        self.assertTrue(JsonUtils.needs_download(self.link(), self.filepath))
+        # a local file older than the remote one
+        os.utime(self.filepath, (0, 0))
+        self.assertTrue(JsonUtils.needs_download(self.link(100),
+                                                 self.filepath, True))
+
+    def test_missing_file(self):
+        self.assertTrue(JsonUtils.needs_download(
+            self.link(), os.path.join(self.tmp_dir, 'other.hdf')))
+        self.assertEqual(self.server.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+"""
+Tests for LutUtils._fetch_lut.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import LutUtils
+
+
+class FakeSession(object):
+    """
+    Stands in for JsonUtils.SessionUtils, writing contents to the file on
+    success.
+    """
+    def __init__(self, status, contents=b'new lut'):
+        self.status = status
+        self.contents = contents
+
+    def download_file(self, url, filepath):
+        if not self.status:
+            with open(filepath, 'wb') as lut:
+                lut.write(self.contents)
+        return self.status
+
+
+class FakeLuts(object):
+
+    def __init__(self, session):
+        self.session = session
+
+
+class FetchLutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmp_dir, 'xcal.hdf')
+        self.link = {'href': 'https://example.com/xcal.hdf',
+                     'mtime': 1000000000.0, 'size': 7}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fetched(self):
+        luts = FakeLuts(FakeSession(0))
+        self.assertEqual(LutUtils._fetch_lut(luts, self.link, self.filepath),
+                         self.filepath)
+        self.assertEqual(os.path.getmtime(self.filepath), 1000000000.0)
+
+    def test_failed_update_keeps_old_file(self):
+        with open(self.filepath, 'wb') as lut:
+            lut.write(b'old lut')
+        old_mtime = os.path.getmtime(self.filepath)
+        luts = FakeLuts(FakeSession(1))
+        self.assertIsNone(LutUtils._fetch_lut(luts, self.link, self.filepath))
+        self.assertEqual(os.path.getmtime(self.filepath), old_mtime)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Tests for modules.mlp_checkpoint.StageJournal.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import modules.mlp_checkpoint as mlp_checkpoint
+
+
+class StageJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.jrnl_path = os.path.join(self.tmp_dir, 'run.jrnl')
+        self.in_file = self.make_file('granule.L1A', 'level 1a')
+        self.out_file = self.make_file('granule.L1B', 'level 1b')
+        self.par = {'resolution': 1000}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_file(self, name, contents):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as out_file:
+            out_file.write(contents)
+        return path
+
+    def complete_step(self, resume=False):
+        """
+        Records the step in a new journal, then returns a journal reloaded as
+        a resumed run would, with the step's key.
+        """
+        jrnl = mlp_checkpoint.StageJournal(self.jrnl_path, resume)
+        key = jrnl.make_key('l1bgen', [self.in_file])
+        state = jrnl.build_state([self.in_file], self.par, '1.0')
+        jrnl.record(key, state, [self.out_file])
+        return mlp_checkpoint.StageJournal(self.jrnl_path, True), key
+
+    def is_complete(self, jrnl, key, par=None, version='1.0'):
+        state = jrnl.build_state([self.in_file], par or self.par, version)
+        return jrnl.is_complete(key, state, [self.out_file])
+
+    def shift_mtime(self, path):
+        stat_info = os.stat(path)
+        os.utime(path, (stat_info.st_atime, stat_info.st_mtime + 10))
+
+    def test_unchanged_is_skipped(self):
+        jrnl, key = self.complete_step()
+        self.assertTrue(self.is_complete(jrnl, key))
+
+    def test_new_run_discards_journal(self):
+        self.complete_step()
+        jrnl = mlp_checkpoint.StageJournal(self.jrnl_path, False)
+        self.assertEqual(jrnl.entries, {})
+        self.assertFalse(os.path.exists(self.jrnl_path))
+
+    def test_changed_input_reruns(self):
+        jrnl, key = self.complete_step()
+        self.make_file('granule.L1A', 'level 1a, reprocessed')
+        self.assertFalse(self.is_complete(jrnl, key))
+
+    def test_touched_input_reruns_without_checksum(self):
+        jrnl, key = self.complete_step()
+        self.shift_mtime(self.in_file)
+        self.assertFalse(self.is_complete(jrnl, key))
+
+    def test_touched_input_skipped_with_checksum(self):
+        jrnl, key = self.complete_step(resume=True)
+        self.shift_mtime(self.in_file)
+        self.assertTrue(self.is_complete(jrnl, key))
+
+    def test_touched_output_skipped(self):
+        jrnl, key = self.complete_step()
+        self.shift_mtime(self.out_file)
+        self.assertTrue(self.is_complete(jrnl, key))
+
+    def test_changed_output_reruns(self):
+        jrnl, key = self.complete_step()
+        self.make_file('granule.L1B', 'level 1b!')
+        self.shift_mtime(self.out_file)
+        self.assertFalse(self.is_complete(jrnl, key))
+        os.remove(self.out_file)
+        self.assertFalse(self.is_complete(jrnl, key))
+
+    def test_changed_parameters_rerun(self):
+        jrnl, key = self.complete_step()
+        self.assertFalse(self.is_complete(jrnl, key, {'resolution': 500}))
+        self.assertFalse(self.is_complete(jrnl, key, version='1.1'))
+
+    def test_incomplete_line_ignored(self):
+        self.complete_step()
+        with open(self.jrnl_path, 'a') as jrnl_file:
+            jrnl_file.write('{"key": "trunc')
+        jrnl = mlp_checkpoint.StageJournal(self.jrnl_path, True)
+        self.assertEqual(len(jrnl.entries), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Tests for modules.mlp_queue.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import modules.mlp_queue as mlp_queue
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = mlp_queue.WorkQueue(os.path.join(self.tmp_dir, 'q.db'),
+                                         lease=60, max_attempts=2)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def expire_leases(self):
+        self.queue.conn.execute('UPDATE granules SET lease_expires = ?',
+                                [time.time() - 1])
+
+    def get_row(self, path):
+        return self.queue.conn.execute('''SELECT state, owner, attempts, message
+            FROM granules WHERE path = ?''', [path]).fetchone()
+
+    def test_claim_order(self):
+        self.assertTrue(self.queue.enqueue('/a', 1, 1.0))
+        self.assertTrue(self.queue.enqueue('/b', 1, 1.0))
+        self.assertFalse(self.queue.enqueue('/a', 1, 1.0))
+        self.assertEqual(self.queue.claim('w1'), '/a')
+        self.assertEqual(self.queue.claim('w2'), '/b')
+        self.assertIsNone(self.queue.claim('w3'))
+        self.assertEqual(self.get_row('/a')[:3], (mlp_queue.CLAIMED, 'w1', 1))
+
+    def test_claimed_granule_not_requeued(self):
+        self.queue.enqueue('/a', 1, 1.0)
+        self.queue.claim('w1')
+        self.assertFalse(self.queue.enqueue('/a', 2, 2.0))
+
+    def test_finish(self):
+        self.queue.enqueue('/a', 1, 1.0)
+        self.queue.claim('w1')
+        # only the owner can finish it
+        self.assertIsNone(self.queue.finish('/a', 'w2', True))
+        self.assertEqual(self.get_row('/a')[0], mlp_queue.CLAIMED)
+        self.assertEqual(self.queue.finish('/a', 'w1', True), mlp_queue.DONE)
+        self.assertEqual(self.queue.get_counts(), {mlp_queue.DONE: 1})
+
+    def test_failure_requeued(self):
+        self.queue.enqueue('/a', 1, 1.0)
+        self.queue.enqueue('/b', 1, 1.0)
+        self.assertEqual(self.queue.claim('w1'), '/a')
+        self.assertEqual(self.queue.finish('/a', 'w1', False, 'crashed'),
+                         mlp_queue.PENDING)
+        self.assertEqual(self.get_row('/a'),
+                         (mlp_queue.PENDING, None, 1, 'crashed'))
+        # the failed granule goes to the back of the queue
+        self.assertEqual(self.queue.claim('w1'), '/b')
+        self.assertEqual(self.queue.claim('w1'), '/a')
+        self.assertEqual(self.queue.finish('/a', 'w1', False, 'crashed'),
+                         mlp_queue.FAILED)
+        self.assertEqual(self.get_row('/a'),
+                         (mlp_queue.FAILED, None, 2, 'crashed'))
+        self.assertIsNone(self.queue.claim('w1'))
+
+    def test_failure_after_lost_lease(self):
+        self.queue.enqueue('/a', 1, 1.0)
+        self.queue.claim('w1')
+        self.expire_leases()
+        self.queue.claim('w2')
+        self.assertEqual(self.queue.finish('/a', 'w2', False),
+                         mlp_queue.FAILED)
+
+    def test_lease_expiry_and_reclaim(self):
+        self.queue.enqueue('/a', 1, 1.0)
+        self.assertEqual(self.queue.claim('w1'), '/a')
+        self.assertIsNone(self.queue.claim('w2'))
+        self.expire_leases()
+        self.assertEqual(self.queue.claim('w2'), '/a')
+        self.assertEqual(self.get_row('/a')[:3], (mlp_queue.CLAIMED, 'w2', 2))
+        # the first worker has lost its lease
+        self.assertFalse(self.queue.renew('/a', 'w1'))
+        self.assertTrue(self.queue.renew('/a', 'w2'))
+
+    def test_max_attempts(self):
+        self.queue.enqueue('/a', 1, 1.0)
+        self.queue.claim('w1')
+        self.expire_leases()
+        self.queue.claim('w2')
+        self.expire_leases()
+        self.assertIsNone(self.queue.claim('w3'))
+        self.assertEqual(self.get_row('/a'),
+                         (mlp_queue.FAILED, None, 2, 'too many attempts'))
+
+    def test_release_does_not_count(self):
+        self.queue.enqueue('/a', 1, 1.0)
+        self.queue.claim('w1')
+        self.queue.release('/a', 'w1')
+        self.assertEqual(self.get_row('/a')[:3], (mlp_queue.PENDING, None, 0))
+        self.assertEqual(self.queue.claim('w2'), '/a')
+
+    def test_scan_directory(self):
+        watch_dir = os.path.join(self.tmp_dir, 'in')
+        os.mkdir(watch_dir)
+        for name in ('old.L1A', 'new.L1A', '.hidden.L1A', 'old.txt'):
+            with open(os.path.join(watch_dir, name), 'w') as out_file:
+                out_file.write(name)
+        old = time.time() - 120
+        for name in ('old.L1A', '.hidden.L1A', 'old.txt'):
+            os.utime(os.path.join(watch_dir, name), (old, old))
+        added = mlp_queue.scan_directory(watch_dir, self.queue, '*.L1A', 60)
+        self.assertEqual([os.path.basename(p) for p in added], ['old.L1A'])
+        self.assertEqual(mlp_queue.scan_directory(watch_dir, self.queue,
+                                                  '*.L1A', 60), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
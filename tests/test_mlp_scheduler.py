@@ -0,0 +1,115 @@
+"""
+Tests for modules.mlp_scheduler.DagScheduler.
+"""
+
+import threading
+import time
+import unittest
+
+import modules.mlp_scheduler as mlp_scheduler
+
+
+class RecordingScheduler(mlp_scheduler.DagScheduler):
+    """
+    A scheduler refusing to start the tasks named in refused, and recording
+    how many tasks run at once.
+    """
+    def __init__(self, max_workers, refused=()):
+        mlp_scheduler.DagScheduler.__init__(self, max_workers)
+        self.refused = set(refused)
+        self.running = 0
+        self.peak = 0
+
+    def _can_start(self, task):
+        return task.key not in self.refused
+
+    def _task_started(self, task):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+
+    def _task_finished(self, task):
+        self.running -= 1
+
+
+class DagSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.order = []
+
+    def action(self, delay=0.0, fail=False):
+        def run(task):
+            time.sleep(delay)
+            with self.lock:
+                self.order.append(task.key)
+            if fail:
+                raise RuntimeError('{0} failed'.format(task.key))
+            return task.key
+        return run
+
+    def test_dependencies_run_first(self):
+        scheduler = mlp_scheduler.DagScheduler(4)
+        scheduler.add_task('a', self.action(0.05))
+        scheduler.add_task('b', self.action())
+        scheduler.add_task('c', self.action(), deps=['a', 'b'])
+        scheduler.add_task('d', self.action(), deps=['c'])
+        completed = []
+        scheduler.run(lambda task: completed.append(task.key))
+        self.assertEqual(self.order[2:], ['c', 'd'])
+        self.assertEqual(set(self.order[:2]), set(['a', 'b']))
+        self.assertEqual(completed.index('d'), 3)
+        self.assertTrue(all(scheduler.tasks[k].state == mlp_scheduler.DONE
+                            for k in 'abcd'))
+
+    def test_unknown_dependency(self):
+        scheduler = mlp_scheduler.DagScheduler()
+        self.assertRaises(mlp_scheduler.SchedulerError, scheduler.add_task,
+                          'a', self.action(), ['missing'])
+
+    def test_no_new_tasks_after_failure(self):
+        scheduler = mlp_scheduler.DagScheduler(2)
+        scheduler.add_task('bad', self.action(fail=True))
+        scheduler.add_task('slow', self.action(0.2))
+        scheduler.add_task('after_bad', self.action(), deps=['bad'])
+        scheduler.add_task('after_slow', self.action(), deps=['slow'])
+        self.assertRaises(RuntimeError, scheduler.run)
+        # the running task is waited for, but nothing new is started
+        self.assertEqual(sorted(self.order), ['bad', 'slow'])
+        self.assertEqual(scheduler.tasks['bad'].state, mlp_scheduler.FAILED)
+        self.assertEqual(scheduler.tasks['slow'].state, mlp_scheduler.DONE)
+        self.assertEqual(scheduler.tasks['after_slow'].state,
+                         mlp_scheduler.PENDING)
+
+    def test_failure_in_on_complete(self):
+        scheduler = mlp_scheduler.DagScheduler(1)
+        scheduler.add_task('a', self.action())
+        scheduler.add_task('b', self.action(), deps=['a'])
+
+        def on_complete(task):
+            raise ValueError('bad result')
+        self.assertRaises(ValueError, scheduler.run, on_complete)
+        self.assertEqual(self.order, ['a'])
+        self.assertEqual(scheduler.tasks['a'].state, mlp_scheduler.FAILED)
+
+    def test_held_task_runs_alone(self):
+        scheduler = RecordingScheduler(4, refused=['big'])
+        scheduler.add_task('small1', self.action(0.05))
+        scheduler.add_task('big', self.action(0.05))
+        scheduler.add_task('small2', self.action(0.05))
+        scheduler.run()
+        # big was refused while others ran, then started on its own
+        self.assertEqual(self.order[-1], 'big')
+        self.assertEqual(scheduler.tasks['big'].state, mlp_scheduler.DONE)
+        self.assertEqual(scheduler.peak, 2)
+
+    def test_max_workers(self):
+        scheduler = RecordingScheduler(2)
+        for num in range(6):
+            scheduler.add_task(num, self.action(0.02))
+        scheduler.run()
+        self.assertEqual(scheduler.peak, 2)
+        self.assertEqual(sorted(self.order), list(range(6)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+"""
+Tests for the resumable downloads in modules.ProcUtils.httpdl_url, against
+a stub server.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import requests
+
+import modules.ProcUtils as ProcUtils
+from http_stub import StubResource, StubServer
+
+BODY = b''.join(bytes(bytearray([n % 256])) for n in range(5000))
+
+
+class HttpdlUrlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = StubServer()
+        self.session = requests.Session()
+        self.ofile = os.path.join(self.tmp_dir, 'granule.nc')
+
+    def tearDown(self):
+        self.session.close()
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def download(self, **kwargs):
+        return ProcUtils.httpdl_url(self.server.url('/granule.nc'),
+                                    localpath=self.tmp_dir,
+                                    outputfilename='granule.nc', ntries=1,
+                                    session=self.session, **kwargs)
+
+    def write_part(self, contents, validator=None):
+        with open(self.ofile + '.part', 'wb') as part:
+            part.write(contents)
+        if validator:
+            with open(self.ofile + '.part.validator', 'w') as vfile:
+                vfile.write(validator + '\n')
+
+    def read_output(self):
+        with open(self.ofile, 'rb') as out_file:
+            return out_file.read()
+
+    def assert_no_part(self):
+        self.assertFalse(os.path.exists(self.ofile + '.part'))
+        self.assertFalse(os.path.exists(self.ofile + '.part.validator'))
+
+    def test_download(self):
+        self.server.resources['/granule.nc'] = StubResource(BODY, etag='"v1"')
+        self.assertEqual(self.download(), 0)
+        self.assertEqual(self.read_output(), BODY)
+        self.assert_no_part()
+
+    def test_resume_with_if_range(self):
+        self.server.resources['/granule.nc'] = StubResource(BODY, etag='"v1"')
+        self.write_part(BODY[:2000], '"v1"')
+        self.assertEqual(self.download(), 0)
+        headers = self.server.requests[-1][2]
+        self.assertEqual(headers['Range'], 'bytes=2000-')
+        self.assertEqual(headers['If-Range'], '"v1"')
+        self.assertEqual(self.read_output(), BODY)
+        self.assert_no_part()
+
+    def test_resume_with_last_modified(self):
+        modified = 'Mon, 05 Oct 2026 10:00:00 GMT'
+        self.server.resources['/granule.nc'] = StubResource(
+            BODY, last_modified=modified)
+        self.write_part(BODY[:1000], modified)
+        self.assertEqual(self.download(), 0)
+        self.assertEqual(self.server.requests[-1][2]['If-Range'], modified)
+        self.assertEqual(self.read_output(), BODY)
+
+    def test_changed_validator_restarts(self):
+        # the part came from an older version of the file
+        self.server.resources['/granule.nc'] = StubResource(BODY, etag='"v2"')
+        self.write_part(b'\xff' * 2000, '"v1"')
+        self.assertEqual(self.download(), 0)
+        self.assertEqual(self.server.requests[-1][2]['If-Range'], '"v1"')
+        self.assertEqual(self.read_output(), BODY)
+        self.assert_no_part()
+
+    def test_part_without_validator_discarded(self):
+        self.server.resources['/granule.nc'] = StubResource(BODY, etag='"v1"')
+        self.write_part(b'\xff' * 2000)
+        self.assertEqual(self.download(), 0)
+        self.assertNotIn('Range', self.server.requests[-1][2])
+        self.assertEqual(self.read_output(), BODY)
+
+    def test_no_resume_ignores_part(self):
+        self.server.resources['/granule.nc'] = StubResource(BODY, etag='"v1"')
+        self.write_part(b'\xff' * 2000, '"v1"')
+        self.assertEqual(self.download(resume=False), 0)
+        self.assertNotIn('Range', self.server.requests[-1][2])
+        self.assertEqual(self.read_output(), BODY)
+
+    def test_size_mismatch(self):
+        self.server.resources['/granule.nc'] = StubResource(
+            BODY, etag='"v1"', content_length=len(BODY) + 100)
+        self.assertEqual(self.download(), 1)
+        self.assertFalse(os.path.exists(self.ofile))
+        # the part is kept, with its validator, for a later resume
+        self.assertTrue(os.path.exists(self.ofile + '.part'))
+        self.assertEqual(ProcUtils._read_validator(self.ofile + '.part'),
+                         '"v1"')
+
+    def test_size_mismatch_without_resume(self):
+        self.server.resources['/granule.nc'] = StubResource(
+            BODY, etag='"v1"', content_length=len(BODY) + 100)
+        self.assertEqual(self.download(resume=False), 1)
+        self.assertFalse(os.path.exists(self.ofile))
+        self.assert_no_part()
+
+    def test_checksum(self):
+        import hashlib
+        self.server.resources['/granule.nc'] = StubResource(BODY, etag='"v1"')
+        good = 'md5:' + hashlib.md5(BODY).hexdigest()
+        self.assertEqual(self.download(checksum='md5:' + '0' * 32), 1)
+        self.assertFalse(os.path.exists(self.ofile))
+        self.assertEqual(self.download(checksum=good), 0)
+        self.assertEqual(self.read_output(), BODY)
+
+    def test_uncompress(self):
+        import gzip
+        self.server.resources['/granule.nc.gz'] = StubResource(
+            gzip.compress(BODY), etag='"v1"')
+        status = ProcUtils.httpdl_url(self.server.url('/granule.nc.gz'),
+                                      localpath=self.tmp_dir, ntries=1,
+                                      uncompress=True, session=self.session)
+        self.assertEqual(status, 0)
+        self.assertEqual(os.listdir(self.tmp_dir), ['granule.nc'])
+        with open(os.path.join(self.tmp_dir, 'granule.nc'), 'rb') as out_file:
+            self.assertEqual(out_file.read(), BODY)
+
+    def test_uncompress_corrupt(self):
+        import gzip
+        self.server.resources['/granule.nc.gz'] = StubResource(
+            gzip.compress(BODY)[:-100], etag='"v1"')
+        status = ProcUtils.httpdl_url(self.server.url('/granule.nc.gz'),
+                                      localpath=self.tmp_dir, ntries=1,
+                                      uncompress=True, session=self.session)
+        self.assertEqual(status, 1)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_not_found(self):
+        self.assertEqual(self.download(), 404)
+        self.assertFalse(os.path.exists(self.ofile))
+
+
+if __name__ == '__main__':
+    unittest.main()
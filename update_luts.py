@@ -7,6 +7,7 @@ Updates LUTS for the various sensors.
 
 import argparse
 import modules.LutUtils as Lut
+import modules.http_cache as http_cache
 
 
 class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter,
@@ -26,8 +27,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=CustomFormatter,
                                      description=description, add_help=True)
 
-    parser.add_argument('mission', metavar='MISSION',
-                        help='sensor or platform to process; one of:\n%(choices)s',
+    parser.add_argument('mission', metavar='MISSION', nargs='+',
+                        help='sensor(s) or platform(s) to process; any of:\n%(choices)s',
                         choices=sensors + platforms)
 
     parser.add_argument('-e', '--eval', action='store_true', dest='evalluts',
@@ -42,6 +43,9 @@ if __name__ == '__main__':
     parser.add_argument('--timeout', type=float, default=10,
                         help='network timeout in seconds')
 
+    parser.add_argument('-j', '--workers', type=int, default=Lut.DEFAULT_WORKERS,
+                        help='number of listings/downloads to run at once')
+
     # parser.add_argument('--version', action='version',
     #                    version='%(prog)s ' + version)
 
@@ -56,28 +60,27 @@ if __name__ == '__main__':
                             format='%(levelname)s:%(message)s')
 
     # always update the common directory
-    luts = Lut.LutUtils(verbose=args.verbose,
-                        mission='common',
-                        evalluts=False,
-                        timeout=args.timeout,
-                        dry_run=args.dry_run)
-    luts.get_luts()
-    if luts.status != 0:
-        parser.exit(luts.status)
-
-
-    # on to the requested sensor
-    luts = Lut.LutUtils(verbose=args.verbose,
-                        mission=args.mission.lower(),
-                        evalluts=args.evalluts,
-                        timeout=args.timeout,
-                        dry_run=args.dry_run)
+    lut_sets = [Lut.LutUtils(verbose=args.verbose,
+                             mission='common',
+                             evalluts=False,
+                             timeout=args.timeout,
+                             dry_run=args.dry_run)]
 
+    # on to the requested sensors
     valid_sensors = ['Aquarius', 'SeaWiFS', 'MODIS', 'VIIRS']
-    if (luts.sensor and luts.sensor['instrument'] in valid_sensors):
-        luts.get_luts()
-    else:
-        parser.print_help()
-        parser.exit(1)
-
-    parser.exit(luts.status)
+    for mission in args.mission:
+        luts = Lut.LutUtils(verbose=args.verbose,
+                            mission=mission.lower(),
+                            evalluts=args.evalluts,
+                            timeout=args.timeout,
+                            dry_run=args.dry_run)
+        if not (luts.sensor and luts.sensor['instrument'] in valid_sensors):
+            parser.print_help()
+            parser.exit(1)
+        lut_sets.append(luts)
+
+    Lut.sync_luts(lut_sets, workers=args.workers)
+    if args.verbose:
+        http_cache.print_stats()
+
+    parser.exit(max(luts.status for luts in lut_sets))